@@ -0,0 +1,131 @@
+# admission.py
+# Admission control for command (POST) endpoints in service_web.
+#
+# - TokenBucket / RateLimiter: per-client + global request budgets (429 + Retry-After)
+# - CommandCoalescer: last-value-wins batching of slider-style state writes, so a
+#   burst of /setpoint requests becomes one DB write and one gw_tx_seq bump.
+
+import math
+import threading
+import time
+
+import config
+
+
+class TokenBucket:
+    """
+    Classic token bucket.
+
+    Args:
+        rate (float): Tokens refilled per second.
+        burst (float): Bucket capacity (max requests accepted back-to-back).
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def peek(self, now=None):
+        """Seconds until one token is available (0 if available now)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        """Consume one token. Returns True if admitted."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    Per-client and global token buckets.
+
+    A request is admitted only if both its client bucket and the global bucket
+    have a token; tokens are consumed from both together so a rejected request
+    costs nothing.
+    """
+
+    def __init__(self, client_rate, client_burst, global_rate, global_burst, idle_expiry=300.0):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.idle_expiry = idle_expiry
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def check(self, client_id):
+        """Return 0 if admitted, else the number of seconds to wait (Retry-After)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._clients.get(client_id)
+            if bucket is None:
+                bucket = self._clients[client_id] = TokenBucket(self.client_rate, self.client_burst)
+
+            wait = max(bucket.peek(now), self.global_bucket.peek(now))
+            if wait == 0.0:
+                bucket.take(now)
+                self.global_bucket.take(now)
+
+            if now - self._last_prune > self.idle_expiry:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        # Drop buckets that have been full (idle) for a while
+        stale = [cid for cid, b in self._clients.items() if now - b.updated > self.idle_expiry]
+        for cid in stale:
+            del self._clients[cid]
+        self._last_prune = now
+
+
+def retry_after_header(wait):
+    """Retry-After must be an integer number of seconds (at least 1)."""
+    return str(max(1, int(math.ceil(wait))))
+
+
+class CommandCoalescer:
+    """
+    Last-value-wins write batching on top of a StateCache.
+
+    submit() makes the value visible to GET routes immediately (StateCache.stage)
+    and schedules a single flush after `window` seconds; any further submits for
+    the same key inside the window just replace the staged value. A direct
+    StateCache.set() (e.g. the relay-off safety reset) supersedes a staged value.
+    """
+
+    def __init__(self, state, window=None):
+        self.state = state
+        self.window = config.COMMAND_COALESCE_WINDOW if window is None else window
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, key, value):
+        with self._lock:
+            self._pending.add(key)
+            self.state.stage(key, value)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            self._timer = None
+        for key in pending:
+            self.state.commit(key)
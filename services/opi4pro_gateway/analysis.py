@@ -0,0 +1,181 @@
+# analysis.py
+# Vectorized step-response analysis for the Lab 4 / Lab 5 trend data.
+#
+# All metric functions work along the LAST axis, so the same code scores a
+# single trend window (shape (T,)) or a batch of simulated responses
+# (shape (N, T)) without Python loops.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+SETTLING_BAND = 0.02   # ±2 % of the step size
+STEP_MIN_SP = 0.5      # °C: smaller SP changes are not treated as a step
+STEP_MIN_MV = 1.0      # %: smaller MV changes are not treated as a step
+TAIL_FRACTION = 0.1    # last 10 % of the window = "steady state"
+
+# Metrics normalized by the step size; meaningless without a finite, non-zero step
+STEP_DEPENDENT = ("rise_time", "peak", "peak_time", "overshoot_pct", "settling_time")
+
+
+def _first_true(mask, t):
+    """Time of the first True along the last axis (NaN if never True)."""
+    idx = np.argmax(mask, axis=-1)
+    hit = np.take_along_axis(mask, idx[..., None], axis=-1)[..., 0]
+    return np.where(hit, t[idx], np.nan)
+
+
+def _json_number(v, digits=None):
+    """float for JSON, or None for NaN/inf (jsonify would emit a bare NaN)."""
+    v = float(v)
+    if not np.isfinite(v):
+        return None
+    return round(v, digits) if digits is not None else v
+
+
+def integrate(f, t):
+    """Trapezoidal integral of f over t along the last axis (NaN-safe)."""
+    f = np.nan_to_num(f)
+    return np.sum((f[..., 1:] + f[..., :-1]) * np.diff(t) * 0.5, axis=-1)
+
+
+def response_metrics(t, y, r, y0=None, band=SETTLING_BAND):
+    """
+    Step-response metrics, vectorized along the last axis.
+
+    Args:
+        t (ndarray): (T,) time since the step (s), t[0] = 0.
+        y (ndarray): (..., T) process variable.
+        r (ndarray|float): reference after the step, scalar / (...,) / (..., T).
+        y0 (ndarray|float): value before the step (default: y[..., 0]).
+        band (float): settling band as a fraction of the step size.
+
+    Returns:
+        dict of ndarrays with shape (...,).
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    r = np.asarray(r, dtype=float)
+    r_final = r[..., -1] if r.ndim == y.ndim else r
+    y0 = y[..., 0] if y0 is None else np.asarray(y0, dtype=float)
+
+    step = r_final - y0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (y - y0[..., None]) / step[..., None]   # normalized: 0 -> 1
+
+    t10 = _first_true(z >= 0.1, t)
+    t90 = _first_true(z >= 0.9, t)
+
+    zpk = np.nanmax(z, axis=-1)
+    ipk = np.nanargmax(np.where(np.isnan(z), -np.inf, z), axis=-1)
+    peak = np.take_along_axis(y, ipk[..., None], axis=-1)[..., 0]
+    overshoot = np.maximum(0.0, (zpk - 1.0) * 100.0)
+
+    # Settling: time after the last sample outside the band
+    outside = np.abs(y - r_final[..., None]) > band * np.abs(step)[..., None]
+    last_out = outside.shape[-1] - 1 - np.argmax(outside[..., ::-1], axis=-1)
+    any_out = outside.any(axis=-1)
+    settled = ~outside[..., -1]
+    settling_time = np.where(~any_out, 0.0,
+                             np.where(settled, t[np.minimum(last_out + 1, t.size - 1)], np.nan))
+
+    tail = max(1, int(round(y.shape[-1] * TAIL_FRACTION)))
+    steady_state_error = r_final - np.nanmean(y[..., -tail:], axis=-1)
+
+    e = (r if r.ndim == y.ndim else r[..., None]) - y
+    return {
+        "step_size": step,
+        "rise_time": t90 - t10,
+        "peak": peak,
+        "peak_time": t[ipk],
+        "overshoot_pct": overshoot,
+        "settling_time": settling_time,
+        "steady_state_error": steady_state_error,
+        "iae": integrate(np.abs(e), t),
+        "ise": integrate(e * e, t),
+        "itae": integrate(t * np.abs(e), t),
+    }
+
+
+def detect_step(sp, mv):
+    """
+    Locate the step in a trend window.
+
+    Returns:
+        tuple: (index, kind) - kind is "sp" (closed loop) or "mv" (open loop),
+               or (None, None) if there is no step.
+    """
+    dsp = np.abs(np.diff(np.nan_to_num(sp, nan=0.0)))
+    if dsp.size and dsp.max() >= STEP_MIN_SP:
+        return int(np.argmax(dsp)) + 1, "sp"
+    dmv = np.abs(np.diff(np.nan_to_num(mv, nan=0.0)))
+    if dmv.size and dmv.max() >= STEP_MIN_MV:
+        return int(np.argmax(dmv)) + 1, "mv"
+    return None, None
+
+
+def analyze_window(ts, pv, sp, mv, band=SETTLING_BAND):
+    """
+    Step metrics for one trend window (1-D arrays).
+
+    Closed loop (SP step): reference = SP after the step.
+    Open loop (MV step):   reference = steady-state PV at the end of the window.
+    """
+    if ts.size < 3:
+        return {"error": "Not enough samples"}
+    k, kind = detect_step(sp, mv)
+    if k is None:
+        return {"error": "No SP or MV step found in window"}
+
+    y0 = pv[k - 1]
+    t = ts[k:] - ts[k]
+    y = pv[k:]
+    if kind == "sp":
+        r = sp[k:]
+    else:
+        tail = max(1, int(round(y.size * TAIL_FRACTION)))
+        r = np.nanmean(y[-tail:])
+
+    m = response_metrics(t, y, r, y0=y0, band=band)
+    out = {name: _json_number(v, 4) for name, v in m.items()}
+    if not out["step_size"]:
+        # No PV before the step (or no change): nothing to normalize against
+        out.update(dict.fromkeys(STEP_DEPENDENT))
+    out.update({
+        "step_kind": kind,
+        "step_ts": float(ts[k]),
+        "initial_value": _json_number(y0),
+        "final_reference": _json_number(r[-1] if np.ndim(r) else r),
+        "samples": int(y.size),
+    })
+    return out
+
+
+def trend_arrays(rows):
+    """(ts, pv, sp, mv) rows -> four float arrays (None -> NaN)."""
+    data = np.array(list(rows), dtype=float).reshape(-1, 4)
+    return data[:, 0], data[:, 1], data[:, 2], data[:, 3]
+
+
+class ResultCache:
+    """Small LRU cache keyed by (window, data generation)."""
+
+    def __init__(self, size=32):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
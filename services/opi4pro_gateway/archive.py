@@ -0,0 +1,105 @@
+# archive.py
+# Lab-session trend archive.
+#
+# The live trend table is pruned after one hour. The archiver keeps a copy of
+# every sample grouped into sessions (a new session starts whenever the control
+# mode or the archive label - e.g. a booking ID - changes).
+#
+# Storage: each chunk of ARCHIVE_CHUNK_SAMPLES samples is one row in
+# archive_chunks with one blob per column. A column is stored as fixed-point
+# integers (ts in ms, values in 1/1000 units), delta-encoded, then
+# zlib-compressed. Slowly-changing lab signals compress to a few bytes/sample.
+
+import zlib
+from array import array
+from itertools import accumulate
+
+import config
+
+TS_SCALE = 1000      # ts stored in milliseconds
+VALUE_SCALE = 1000   # pv/sp/mv stored with 0.001 resolution
+NULL = -(2 ** 62)    # fixed-point sentinel for missing values (e.g. SP = null)
+
+
+# ---------------- Column codec ----------------
+def encode_column(values, scale):
+    """list[float|None] -> compressed blob of delta-encoded int64."""
+    ints = [NULL if v is None else int(round(v * scale)) for v in values]
+    deltas = array("q", [ints[0]] + [b - a for a, b in zip(ints, ints[1:])]) if ints else array("q")
+    return zlib.compress(deltas.tobytes(), 6)
+
+
+def decode_column(blob, scale):
+    """Inverse of encode_column."""
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(blob))
+    return [None if v == NULL else v / scale for v in accumulate(deltas)]
+
+
+def decode_chunks(chunks):
+    """Archive chunk rows (t0, t1, n, ts, pv, sp, mv blobs) -> dict of column lists."""
+    out = {"ts": [], "pv": [], "sp": [], "mv": []}
+    for _t0, _t1, _n, ts_blob, pv_blob, sp_blob, mv_blob in chunks:
+        out["ts"].extend(decode_column(ts_blob, TS_SCALE))
+        out["pv"].extend(decode_column(pv_blob, VALUE_SCALE))
+        out["sp"].extend(decode_column(sp_blob, VALUE_SCALE))
+        out["mv"].extend(decode_column(mv_blob, VALUE_SCALE))
+    return out
+
+
+# ---------------- Archiver ----------------
+class TrendArchiver:
+    """
+    Buffers samples for the current session and writes compressed chunks.
+
+    Args:
+        db (GatewayDB): Database wrapper.
+        chunk_samples (int): Samples per chunk (default: config.ARCHIVE_CHUNK_SAMPLES).
+    """
+
+    def __init__(self, db, chunk_samples=None):
+        self.db = db
+        self.chunk_samples = chunk_samples or config.ARCHIVE_CHUNK_SAMPLES
+        self.session_id = None
+        self.session_key = None
+        self.last_ts = None
+        self._buf = ([], [], [], [])  # ts, pv, sp, mv
+        # Sessions left open by a previous crash/restart are closed here
+        self.db.close_dangling_archive_sessions()
+
+    def append(self, ts, pv, sp, mv, mode=None, label=None):
+        """Add one sample; opens a new session when (mode, label) changes."""
+        key = (mode, label)
+        if key != self.session_key:
+            self.close()
+            self.session_id = self.db.create_archive_session(ts, mode=mode, label=label)
+            self.session_key = key
+
+        for col, v in zip(self._buf, (ts, pv, sp, mv)):
+            col.append(v)
+        self.last_ts = ts
+
+        if len(self._buf[0]) >= self.chunk_samples:
+            self.flush()
+
+    def flush(self):
+        ts, pv, sp, mv = self._buf
+        if not ts or self.session_id is None:
+            return
+        self.db.add_archive_chunk(
+            self.session_id, ts[0], ts[-1], len(ts),
+            encode_column(ts, TS_SCALE),
+            encode_column(pv, VALUE_SCALE),
+            encode_column(sp, VALUE_SCALE),
+            encode_column(mv, VALUE_SCALE),
+        )
+        self._buf = ([], [], [], [])
+
+    def close(self):
+        """Flush and close the current session (if any)."""
+        if self.session_id is None:
+            return
+        self.flush()
+        self.db.close_archive_session(self.session_id, self.last_ts)
+        self.session_id = None
+        self.session_key = None
@@ -0,0 +1,206 @@
+# backends.py
+# Pluggable sensor backends for service_sensor (config.SENSOR_BACKEND).
+#
+#   hardware  - MAX31865 + MAX31855 on SPI3 (needs spidev/wiringpi)
+#   replay    - streams recorded PV data (CSV export, trend table or an
+#               archived lab session) at real time or accelerated
+#   synthetic - first-order-plus-dead-time plant driven by the live MV
+#
+# The emulated backends subclass the real drivers and only replace the SPI
+# transfer: the PV is turned back into RTD codes, so code conversion, fault
+# handling, filtering and slot scheduling run exactly as on the target.
+
+import bisect
+import collections
+import csv
+import time
+from datetime import datetime
+
+import numpy as np
+
+import archive
+import config
+from simulate import fopdt_coeffs
+from src.max31865 import MAX31865, CONVERSION_TIME, pt100_table, temp_to_code
+from src.max31855 import MAX31855
+
+BACKENDS = ("hardware", "replay", "synthetic")
+
+
+# ---------------- PV sources ----------------
+class ReplaySource:
+    """
+    Plays back (t, pv) samples, interpolated, looping at the end.
+
+    Args:
+        samples (list): (t seconds, pv °C) in time order; pv None = sensor fault.
+        speed (float): Playback rate (1.0 = real time).
+    """
+
+    def __init__(self, samples, speed=1.0):
+        if len(samples) < 2:
+            raise ValueError("Replay needs at least 2 samples")
+        t0 = samples[0][0]
+        self.t = [t - t0 for t, _ in samples]
+        self.pv = [pv for _, pv in samples]
+        self.duration = self.t[-1]
+        self.speed = speed
+        self.start = time.monotonic()
+
+    def __call__(self):
+        pos = ((time.monotonic() - self.start) * self.speed) % self.duration if self.duration else 0.0
+        i = max(1, bisect.bisect_right(self.t, pos))
+        a, b = self.pv[i - 1], self.pv[min(i, len(self.pv) - 1)]
+        if a is None or b is None:
+            return None
+        t_a, t_b = self.t[i - 1], self.t[min(i, len(self.t) - 1)]
+        frac = (pos - t_a) / (t_b - t_a) if t_b > t_a else 0.0
+        return a + frac * (b - a)
+
+
+def load_csv(path):
+    """Trend CSV export (Time,PV(degC),SP(degC),MV(%); 12-hour times) -> (t, pv) samples."""
+    samples = []
+    day = 0.0
+    last = None
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            clock = datetime.strptime(row["Time"].strip(), "%I:%M:%S %p")
+            t = clock.hour * 3600 + clock.minute * 60 + clock.second + day
+            if last is not None and t < last:   # crossed midnight
+                day += 86400
+                t += 86400
+            last = t
+            pv = row["PV(degC)"].strip()
+            samples.append((t, None if pv in ("", "null") else float(pv)))
+    return samples
+
+
+def load_source(spec, db):
+    """
+    "csv:<path>"          trend CSV export
+    "trend"               the live trend table (last hour)
+    "archive:<id>"        an archived lab session
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "csv":
+        return load_csv(arg)
+    if kind == "trend":
+        now = time.time()
+        return [(ts, pv) for ts, pv, _sp, _mv in db.iter_trend(now - 3600, now)]
+    if kind == "archive":
+        cols = archive.decode_chunks(db.get_archive_chunks(int(arg)))
+        return list(zip(cols["ts"], cols["pv"]))
+    raise ValueError(f"Unknown replay source: {spec}")
+
+
+class FopdtPlant:
+    """
+    Synthetic heater: PV = ambient + K e^{-theta s} / (tau s + 1) * MV.
+
+    MV is read from the state table (the PLC output, HR102-103), so the plant
+    closes the loop with the real PLC. Stepped in fixed sub-steps of `dt`
+    plant-seconds with simulate's ZOH coefficients.
+    """
+
+    def __init__(self, db, K=None, tau=None, theta=None, ambient=None, speed=1.0, dt=0.1):
+        self.db = db
+        self.K = config.SYNTH_K if K is None else K
+        self.tau = config.SYNTH_TAU if tau is None else tau
+        self.theta = config.SYNTH_THETA if theta is None else theta
+        self.ambient = config.SYNTH_AMBIENT if ambient is None else ambient
+        self.speed = speed
+        self.dt = dt
+        self.a, self.gain = fopdt_coeffs(self.K, self.tau, dt)
+        delay = max(0, int(round(self.theta / dt)))
+        self.u_hist = collections.deque([0.0] * (delay + 1), maxlen=delay + 1)
+        self.y = 0.0
+        self.sim_t = 0.0
+        self.start = time.monotonic()
+
+    def __call__(self):
+        mv = self.db.get_state("mv", 0.0) or 0.0
+        target = (time.monotonic() - self.start) * self.speed
+        while self.sim_t + self.dt <= target:
+            self.u_hist.append(min(100.0, max(0.0, float(mv))))
+            self.y = self.a * self.y + self.gain * self.u_hist[0]
+            self.sim_t += self.dt
+        return self.ambient + self.y
+
+
+# ---------------- Emulated chips ----------------
+class EmulatedMAX31865(MAX31865):
+    """MAX31865 fed by a PV source; None from the source reads as an open RTD."""
+
+    def __init__(self, source, filter_hz=50, noise=0.0):
+        self.source = source
+        self.noise = noise
+        self.rng = np.random.default_rng()
+        self.continuous = True
+        self.filter_hz = filter_hz
+        self.conversion_time = CONVERSION_TIME[filter_hz]
+        self.table = pt100_table()
+        self.fault = []
+        self.fault_count = 0
+
+    def read_rtd_code(self):
+        pv = self.source()
+        if pv is None:
+            self.fault = ["rtd_high"]
+            self.fault_count += 1
+            return None
+        if self.noise:
+            pv += self.rng.normal(0.0, self.noise)
+        self.fault = []
+        return int(round(float(temp_to_code(pv))))
+
+    def close(self):
+        pass
+
+
+class EmulatedMAX31855(MAX31855):
+    """MAX31855 fed by a PV source (0.25 °C resolution like the chip)."""
+
+    def __init__(self, source, internal=25.0):
+        self.source = source
+        self.internal = internal
+
+    def read_temp(self, verbose=False):
+        pv = self.source()
+        if pv is None:
+            return None, None, True, True, False, False
+        return round(pv * 4) / 4, self.internal, False, False, False, False
+
+    def close(self):
+        pass
+
+
+# ---------------- Factory ----------------
+def open_backend(db, name=None):
+    """
+    Returns:
+        tuple: (rtd_sensor, tc_sensor or None)
+    """
+    name = name or config.SENSOR_BACKEND
+    if name == "hardware":
+        rtd = MAX31865(cs_pin=config.RTD_CS_PIN,
+                       continuous=config.RTD_CONTINUOUS,
+                       filter_hz=config.RTD_FILTER_HZ)
+        try:
+            tc = MAX31855(cs_pin=config.TC_CS_PIN)
+        except Exception as e:
+            # MAX31855 is optional: the RTD keeps working if it is not fitted
+            print(f"MAX31855 not available, thermocouple disabled: {e}")
+            tc = None
+        return rtd, tc
+
+    speed = config.SENSOR_REPLAY_SPEED
+    if name == "replay":
+        source = ReplaySource(load_source(config.SENSOR_REPLAY_SOURCE, db), speed=speed)
+    elif name == "synthetic":
+        source = FopdtPlant(db, speed=speed)
+    else:
+        raise ValueError(f"SENSOR_BACKEND must be one of {BACKENDS}, got {name!r}")
+    print(f"Sensor backend: {name} (speed x{speed})")
+    return (EmulatedMAX31865(source, filter_hz=config.RTD_FILTER_HZ, noise=config.SYNTH_NOISE),
+            EmulatedMAX31855(source))
@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 
 # Base Directory
@@ -40,21 +41,121 @@ RADXA_PASS = ""
 FLASK_HOST = "0.0.0.0"
 FLASK_PORT = 5000
 
+# Web server runtime
+#   "dev"      -> Flask development server (local testing)
+#   "waitress" -> production WSGI server with a worker thread pool
+WEB_SERVER = os.environ.get("WEB_SERVER", "dev")
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "8"))
+STATE_CACHE_INTERVAL = 0.25  # Seconds between state-table refreshes in service_web
+
+# Command admission control (POST endpoints)
+COMMAND_RATE_PER_CLIENT = 2.0   # Sustained commands/s per client
+COMMAND_BURST_PER_CLIENT = 5    # Back-to-back commands allowed per client
+COMMAND_RATE_GLOBAL = 10.0      # Sustained commands/s across all clients
+COMMAND_BURST_GLOBAL = 20
+COMMAND_COALESCE_WINDOW = 0.3   # Seconds; slider writes inside this window collapse to the last value
+
 # GPIO / Hardware Settings
 # WiringPi Pin 10 -> Physical Pin 18 (PL2) on Orange Pi 4 Pro
 LIGHT_PIN = 10
 RTD_CS_PIN = 13  # WiringPi Pin 13 / PD23
+RTD_CONTINUOUS = True  # MAX31865 auto-convert mode (False = one-shot + 100 ms wait per read)
+RTD_FILTER_HZ = 50     # Mains notch filter: 50 or 60 Hz (max ~50 / ~60 samples/s)
+RTD_OVERSAMPLE = 16    # RTD codes per sensor cycle (median-reduced, see filters.py)
+RTD_FILTER_STAGES = [("median", 5), ("ema", 0.3)]  # Applied in order; also "moving_average"
+TC_CS_PIN = 9           # MAX31855 thermocouple, SPI3 device 1 (optional)
+TC_SAMPLE_INTERVAL = 0.25  # Seconds (MAX31855 converts every ~100 ms)
+
+# Sensor backend (see backends.py): "hardware", "replay" or "synthetic"
+SENSOR_BACKEND = os.environ.get("SENSOR_BACKEND", "hardware")
+# Replay source: "csv:<path>", "trend" or "archive:<session_id>"
+SENSOR_REPLAY_SOURCE = os.environ.get(
+    "SENSOR_REPLAY_SOURCE",
+    "csv:" + os.path.join(BASE_DIR, "..", "..", "docs", "trend_data_example.csv"))
+SENSOR_REPLAY_SPEED = float(os.environ.get("SENSOR_REPLAY_SPEED", "1.0"))  # 1.0 = real time
+# Synthetic FOPDT plant (PV = ambient + K e^-theta*s / (tau*s + 1) * MV)
+SYNTH_K = 0.6          # °C per % MV
+SYNTH_TAU = 300.0      # s
+SYNTH_THETA = 20.0     # s
+SYNTH_AMBIENT = 25.0   # °C
+SYNTH_NOISE = 0.02     # °C (1 sigma) added to emulated RTD readings
+
+# Relay boards (ESP32 relay nodes, see relays.py)
+# The default board powers this rig (/relay, /relay_status). Add more rigs with
+#   RELAY_DEVICES='{"rig2": {"ip": "192.168.8.192", "name": "Rig 2 power"}}'
+# ("api_key" per board is optional, default RELAY_API_KEY).
+RELAY_API_KEY = "esp32-secret-key-123"
+RELAY_DEFAULT_DEVICE = "main"
+RELAY_DEVICES = {
+    RELAY_DEFAULT_DEVICE: {"ip": os.environ.get("ESP32_IP", "192.168.8.191"), "name": "Rig power"},
+}
+
+def _relay_devices_from_env(raw):
+    """Boards from the RELAY_DEVICES env var. Bad entries are logged and skipped."""
+    log = logging.getLogger("config")
+    try:
+        devices = json.loads(raw)
+    except ValueError as e:
+        log.error(f"RELAY_DEVICES is not valid JSON, ignored: {e}")
+        return {}
+    if not isinstance(devices, dict):
+        log.error("RELAY_DEVICES must be a JSON object {id: {\"ip\": ...}}, ignored")
+        return {}
+    valid = {}
+    for device_id, entry in devices.items():
+        if not isinstance(entry, dict) or not isinstance(entry.get("ip"), str) or not entry["ip"]:
+            log.error(f"RELAY_DEVICES['{device_id}'] has no \"ip\", skipped")
+            continue
+        valid[device_id] = entry
+    return valid
+
+RELAY_DEVICES.update(_relay_devices_from_env(os.environ.get("RELAY_DEVICES", "{}")))
 
 # Intervals
 SENSOR_SAMPLE_INTERVAL = 1.0  # Seconds
-RELAY_POLL_INTERVAL = 1.0     # Seconds
+# ESP32 status polling is adaptive (service_relay):
+#   fast      right after an order, until the relay reports the desired state
+#   keepalive at steady state
+#   backoff   doubling from RELAY_POLL_BACKOFF_MIN while the ESP32 is unreachable
+# Keepalive + worst-case poll time (esp32_client timeouts and retries, ~4 s)
+# must stay under RELAY_STALE_AFTER, or /relay_status flaps to offline.
+RELAY_POLL_FAST = 0.25        # Seconds
+RELAY_FAST_WINDOW = 5.0       # Seconds of fast polling after an order
+RELAY_POLL_KEEPALIVE = 5.0    # Seconds
+RELAY_POLL_BACKOFF_MIN = 1.0  # Seconds
+RELAY_POLL_BACKOFF_MAX = 10.0 # Seconds
+RELAY_STALE_AFTER = 15.0      # Seconds without a successful poll -> /relay_status reports offline
+RELAY_CMD_RECHECK = 2.0       # Seconds between re-reads of the queued order without a wake-up (lost datagram)
+RELAY_ACK_TIMEOUT = 3.0       # Seconds the soft shutdown job waits for service_relay to apply an order
+RELAY_POLL_CONCURRENCY = 4    # Max ESP32 requests in flight across all relay boards
 MODBUS_UPDATE_INTERVAL = 0.1  # Seconds (Fast Polling)
 PLC_HEARTBEAT_TIMEOUT = 5.0   # Seconds
+PV_STALE_AFTER = 5.0          # Seconds without a sensor update -> pv_quality forced to 2 (bad)
+
+# Sensor -> modbus PV hand-off (Unix datagram socket, see pvlink.py)
+# Lives next to the DB: the units run with PrivateTmp, so /tmp is not shared.
+PV_SOCKET_PATH = os.environ.get("PV_SOCKET_PATH", os.path.join(os.path.dirname(DB_PATH), "pv.sock"))
+# Web -> relay service "new order" wake-ups (see relays.notify)
+RELAY_WAKE_SOCKET_PATH = os.environ.get("RELAY_WAKE_SOCKET_PATH",
+                                        os.path.join(os.path.dirname(DB_PATH), "relay.sock"))
+
+# Metrics
+# Each service flushes its in-process registry to the state table this often.
+METRICS_FLUSH_INTERVAL = 5.0  # Seconds
 
 # Trend Settings
 # 30 minutes @ 2-second sampling
 TREND_BUFFER_LENGTH = int(30 * 60 / SENSOR_SAMPLE_INTERVAL)
 
+# Trend Archive (lab sessions, see archive.py)
+ARCHIVE_CHUNK_SAMPLES = 120              # Samples per compressed chunk
+ARCHIVE_KEEP_SECONDS = 30 * 24 * 3600    # Keep closed sessions for 30 days
+
+# Streaming control KPIs (see kpi.py)
+KPI_BAND = 0.5          # °C: |SP - PV| within this counts as "in band"
+KPI_PERSIST_EVERY = 10  # Samples between writes of the running KPI segment
+KPI_KEEP_SECONDS = 30 * 24 * 3600  # Keep KPI segments for 30 days
+
 
 LOG_TO_FILE = False
 
@@ -3,10 +3,28 @@ import json
 import time
 import os
 import logging
+import functools
+import threading
 import config
+import metrics
 
 logger = logging.getLogger("gateway_db")
 
+def _timed(op):
+    """Count and time a GatewayDB operation in the process metrics registry."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.registry.observe(
+                    "gateway_db_op_seconds", time.perf_counter() - t0,
+                    help="SQLite operation duration (GatewayDB)", op=op)
+        return wrapper
+    return decorator
+
 class GatewayDB:
     def __init__(self, db_path=None):
         self.db_path = db_path or config.DB_PATH
@@ -33,6 +51,13 @@ class GatewayDB:
                         updated_at INTEGER NOT NULL
                     );
                 """)
+
+                # Migration: monotonic write version (see set_state / StateCache)
+                state_cols = {r[1] for r in conn.execute("PRAGMA table_info(state);")}
+                if "version" not in state_cols:
+                    conn.execute("ALTER TABLE state ADD COLUMN version INTEGER NOT NULL DEFAULT 0;")
+                    conn.execute("UPDATE state SET version = rowid;")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_state_version ON state(version);")
                 
                 # Trend Table
                 conn.execute("""
@@ -45,6 +70,13 @@ class GatewayDB:
                 """)
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_trend_ts ON trend(ts);")
 
+                # Migration: exact per-sample timestamps (wall clock + CLOCK_MONOTONIC)
+                trend_cols = {r[1] for r in conn.execute("PRAGMA table_info(trend);")}
+                if "ts_wall" not in trend_cols:
+                    conn.execute("ALTER TABLE trend ADD COLUMN ts_wall REAL;")
+                if "ts_mono" not in trend_cols:
+                    conn.execute("ALTER TABLE trend ADD COLUMN ts_mono REAL;")
+
                 # Reviews Table
                 conn.execute("""
                     CREATE TABLE IF NOT EXISTS reviews (
@@ -56,25 +88,87 @@ class GatewayDB:
                     );
                 """)
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_reviews_ts ON reviews(ts);")
+
+                # Trend Archive (lab sessions kept beyond the 1 h trend window)
+                # Chunks hold delta-encoded, zlib-compressed columns (see archive.py)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS archive_sessions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        started_at REAL NOT NULL,
+                        ended_at REAL,
+                        mode INTEGER,
+                        label TEXT,
+                        samples INTEGER NOT NULL DEFAULT 0
+                    );
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_sessions_started ON archive_sessions(started_at);")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS archive_chunks (
+                        session_id INTEGER NOT NULL,
+                        t0 REAL NOT NULL,
+                        t1 REAL NOT NULL,
+                        n INTEGER NOT NULL,
+                        ts_blob BLOB NOT NULL,
+                        pv_blob BLOB NOT NULL,
+                        sp_blob BLOB NOT NULL,
+                        mv_blob BLOB NOT NULL
+                    );
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_chunks_session ON archive_chunks(session_id, t0);")
+
+                # Control-quality KPIs per (mode, setpoint) segment (see kpi.py)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS kpi_segments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        started_at REAL NOT NULL,
+                        ended_at REAL NOT NULL,
+                        mode INTEGER,
+                        sp REAL,
+                        pv_start REAL,
+                        samples INTEGER NOT NULL,
+                        duration REAL NOT NULL,
+                        iae REAL NOT NULL,
+                        ise REAL NOT NULL,
+                        overshoot REAL NOT NULL,
+                        time_in_band REAL NOT NULL,
+                        mv_travel REAL NOT NULL
+                    );
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_kpi_segments_started ON kpi_segments(started_at);")
                 conn.commit()
                 
         except sqlite3.Error as e:
             logger.error(f"DB Init Failed: {e}")
 
+    @_timed("set_state")
     def set_state(self, key, value):
-        """Save a value (JSON serialized) to the state table."""
+        """
+        Save a value (JSON serialized) to the state table.
+
+        Every write gets the next table-wide version, assigned inside the
+        write transaction, so versions follow commit order across processes.
+
+        Returns:
+            int: Version of this write (None on error).
+        """
         try:
             val_str = json.dumps(value)
             now = int(time.time())
             with self._get_conn() as conn:
                 conn.execute(
-                    "INSERT INTO state (key, value, updated_at) VALUES (?, ?, ?) "
-                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at;",
+                    "INSERT INTO state (key, value, updated_at, version) "
+                    "VALUES (?, ?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM state)) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at, "
+                    "version=excluded.version;",
                     (key, val_str, now)
                 )
+                row = conn.execute("SELECT version FROM state WHERE key = ?", (key,)).fetchone()
+                return row[0]
         except Exception as e:
             logger.error(f"set_state error ({key}): {e}")
+            return None
 
+    @_timed("get_state")
     def get_state(self, key, default=None):
         """Get a value from state table."""
         try:
@@ -88,6 +182,7 @@ class GatewayDB:
             logger.error(f"get_state error ({key}): {e}")
             return default
 
+    @_timed("get_all_state")
     def get_all_state(self):
         """Return entire state as a dict."""
         res = {}
@@ -103,11 +198,34 @@ class GatewayDB:
             logger.error(f"get_all_state error: {e}")
         return res
 
-    def log_trend(self, pv, sp, mv, ts=None):
-        """Append a row to the trend table."""
+    @_timed("get_state_since")
+    def get_state_since(self, since_version):
+        """Return ({key: (value, version)}, max_version) for rows written after since_version."""
+        res = {}
+        newest = since_version
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    "SELECT key, value, version FROM state WHERE version > ?",
+                    (since_version,)
+                )
+                for key, val_str, version in cursor.fetchall():
+                    try:
+                        value = json.loads(val_str)
+                    except:
+                        value = val_str
+                    res[key] = (value, version)
+                    newest = max(newest, version)
+        except Exception as e:
+            logger.error(f"get_state_since error: {e}")
+        return res, newest
+
+    @_timed("log_trend")
+    def log_trend(self, pv, sp, mv, ts=None, ts_wall=None, ts_mono=None):
+        """Append a row to the trend table (ts_wall / ts_mono: exact sample times)."""
         try:
             if ts is None:
-                ts = int(time.time())
+                ts = int(ts_wall if ts_wall is not None else time.time())
             
             # Ensure values are float or None
             pv = float(pv) if pv is not None else None
@@ -116,29 +234,73 @@ class GatewayDB:
 
             with self._get_conn() as conn:
                 conn.execute(
-                    "INSERT INTO trend (ts, pv, sp, mv) VALUES (?, ?, ?, ?)",
-                    (ts, pv, sp, mv)
+                    "INSERT INTO trend (ts, pv, sp, mv, ts_wall, ts_mono) VALUES (?, ?, ?, ?, ?, ?)",
+                    (ts, pv, sp, mv, ts_wall, ts_mono)
                 )
         except Exception as e:
             logger.error(f"log_trend error: {e}")
 
+    @_timed("get_recent_trend")
     def get_recent_trend(self, limit=900):
         """Get the last N trend rows."""
         try:
             with self._get_conn() as conn:
                 cursor = conn.execute(
-                    "SELECT ts, pv, sp, mv FROM trend ORDER BY ts DESC LIMIT ?",
+                    "SELECT ts, pv, sp, mv, ts_wall, ts_mono FROM trend ORDER BY ts DESC LIMIT ?",
                     (limit,)
                 )
                 rows = cursor.fetchall()
                 # Sort back to ascending time for charts
                 rows.reverse()
+                # ts_mono gives exact x spacing within one sensor-service run
                 return [{"time": time.strftime("%H:%M:%S", time.localtime(r[0])), 
-                         "pv": r[1], "sp": r[2], "mv": r[3]} for r in rows]
+                         "pv": r[1], "sp": r[2], "mv": r[3],
+                         "ts": r[4] if r[4] is not None else r[0], "ts_mono": r[5]} for r in rows]
         except Exception as e:
             logger.error(f"get_recent_trend error: {e}")
             return []
 
+    def iter_trend(self, start_ts, end_ts, batch_size=500):
+        """
+        Yield (ts, pv, sp, mv) rows with start_ts <= ts <= end_ts in time order.
+
+        Streams from a server-side cursor in batches of batch_size, so memory
+        stays flat regardless of the range length.
+        """
+        conn = self._get_conn()
+        try:
+            cursor = conn.execute(
+                "SELECT ts, pv, sp, mv FROM trend WHERE ts >= ? AND ts <= ? ORDER BY ts",
+                (start_ts, end_ts)
+            )
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                metrics.registry.inc("gateway_db_rows_streamed_total", len(rows),
+                                     help="Trend rows streamed by iter_trend")
+                yield from rows
+        finally:
+            conn.close()
+
+    @_timed("trend_generation")
+    def trend_generation(self, start_ts, end_ts):
+        """
+        Cheap fingerprint of the rows in a window: (count, min ts, max ts).
+        Changes whenever rows are added to or pruned from the window.
+        """
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    "SELECT COUNT(*), MIN(ts), MAX(ts) FROM trend WHERE ts >= ? AND ts <= ?",
+                    (start_ts, end_ts)
+                )
+                return tuple(cursor.fetchone())
+        except Exception as e:
+            logger.error(f"trend_generation error: {e}")
+            return None
+
+    @_timed("prune_trend")
     def prune_trend(self, keep_seconds=3600):
         """Delete old rows."""
         try:
@@ -148,6 +310,165 @@ class GatewayDB:
         except Exception as e:
             logger.error(f"prune_trend error: {e}")
 
+    # ---------------- Trend Archive ----------------
+    @_timed("create_archive_session")
+    def create_archive_session(self, started_at, mode=None, label=None):
+        """Open an archive session. Returns its id (or None on error)."""
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO archive_sessions (started_at, mode, label) VALUES (?, ?, ?)",
+                    (started_at, mode, label)
+                )
+                return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"create_archive_session error: {e}")
+            return None
+
+    @_timed("close_archive_session")
+    def close_archive_session(self, session_id, ended_at):
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
+                    "UPDATE archive_sessions SET ended_at = ? WHERE id = ?",
+                    (ended_at, session_id)
+                )
+        except Exception as e:
+            logger.error(f"close_archive_session error: {e}")
+
+    @_timed("close_dangling_archive_sessions")
+    def close_dangling_archive_sessions(self):
+        """Close sessions left open by a crash, ending them at their last chunk."""
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
+                    "UPDATE archive_sessions SET ended_at = COALESCE("
+                    "(SELECT MAX(t1) FROM archive_chunks WHERE session_id = archive_sessions.id), started_at) "
+                    "WHERE ended_at IS NULL"
+                )
+        except Exception as e:
+            logger.error(f"close_dangling_archive_sessions error: {e}")
+
+    @_timed("add_archive_chunk")
+    def add_archive_chunk(self, session_id, t0, t1, n, ts_blob, pv_blob, sp_blob, mv_blob):
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
+                    "INSERT INTO archive_chunks (session_id, t0, t1, n, ts_blob, pv_blob, sp_blob, mv_blob) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, t0, t1, n, ts_blob, pv_blob, sp_blob, mv_blob)
+                )
+                conn.execute(
+                    "UPDATE archive_sessions SET samples = samples + ? WHERE id = ?",
+                    (n, session_id)
+                )
+        except Exception as e:
+            logger.error(f"add_archive_chunk error: {e}")
+
+    @_timed("get_archive_sessions")
+    def get_archive_sessions(self, limit=50):
+        """Most recent sessions first."""
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    "SELECT id, started_at, ended_at, mode, label, samples FROM archive_sessions "
+                    "ORDER BY started_at DESC LIMIT ?",
+                    (limit,)
+                )
+                return [{"id": r[0], "started_at": r[1], "ended_at": r[2], "mode": r[3],
+                         "label": r[4], "samples": r[5]} for r in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"get_archive_sessions error: {e}")
+            return []
+
+    @_timed("get_archive_chunks")
+    def get_archive_chunks(self, session_id, start_ts=None, end_ts=None):
+        """All chunks of a session in time order (one index range scan)."""
+        start_ts = float("-inf") if start_ts is None else start_ts
+        end_ts = float("inf") if end_ts is None else end_ts
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    "SELECT t0, t1, n, ts_blob, pv_blob, sp_blob, mv_blob FROM archive_chunks "
+                    "WHERE session_id = ? AND t1 >= ? AND t0 <= ? ORDER BY t0",
+                    (session_id, start_ts, end_ts)
+                )
+                return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"get_archive_chunks error: {e}")
+            return []
+
+    @_timed("prune_archive")
+    def prune_archive(self, keep_seconds):
+        """Delete closed sessions (and their chunks) older than keep_seconds."""
+        try:
+            cutoff = time.time() - keep_seconds
+            with self._get_conn() as conn:
+                conn.execute(
+                    "DELETE FROM archive_chunks WHERE session_id IN "
+                    "(SELECT id FROM archive_sessions WHERE ended_at IS NOT NULL AND ended_at < ?)",
+                    (cutoff,)
+                )
+                conn.execute(
+                    "DELETE FROM archive_sessions WHERE ended_at IS NOT NULL AND ended_at < ?",
+                    (cutoff,)
+                )
+        except Exception as e:
+            logger.error(f"prune_archive error: {e}")
+
+    # ---------------- KPI Segments ----------------
+    KPI_COLUMNS = ("started_at", "ended_at", "mode", "sp", "pv_start", "samples", "duration",
+                   "iae", "ise", "overshoot", "time_in_band", "mv_travel")
+
+    @_timed("save_kpi_segment")
+    def save_kpi_segment(self, seg):
+        """Insert (seg["id"] is None) or update a KPI segment. Returns its id."""
+        values = [seg[c] for c in self.KPI_COLUMNS]
+        try:
+            with self._get_conn() as conn:
+                if seg.get("id") is None:
+                    cursor = conn.execute(
+                        f"INSERT INTO kpi_segments ({', '.join(self.KPI_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(self.KPI_COLUMNS))})",
+                        values
+                    )
+                    return cursor.lastrowid
+                conn.execute(
+                    f"UPDATE kpi_segments SET {', '.join(c + ' = ?' for c in self.KPI_COLUMNS)} WHERE id = ?",
+                    values + [seg["id"]]
+                )
+                return seg["id"]
+        except Exception as e:
+            logger.error(f"save_kpi_segment error: {e}")
+            return seg.get("id")
+
+    @_timed("get_kpi_segments")
+    def get_kpi_segments(self, limit=50, since_ts=None):
+        """Most recent KPI segments first."""
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    f"SELECT id, {', '.join(self.KPI_COLUMNS)} FROM kpi_segments "
+                    "WHERE started_at >= ? ORDER BY started_at DESC LIMIT ?",
+                    (since_ts if since_ts is not None else 0, limit)
+                )
+                cols = ("id",) + self.KPI_COLUMNS
+                return [dict(zip(cols, r)) for r in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"get_kpi_segments error: {e}")
+            return []
+
+    @_timed("prune_kpi_segments")
+    def prune_kpi_segments(self, keep_seconds):
+        """Delete KPI segments that ended more than keep_seconds ago."""
+        try:
+            cutoff = time.time() - keep_seconds
+            with self._get_conn() as conn:
+                conn.execute("DELETE FROM kpi_segments WHERE ended_at < ?", (cutoff,))
+        except Exception as e:
+            logger.error(f"prune_kpi_segments error: {e}")
+
+    @_timed("add_review")
     def add_review(self, name, rating, comment):
         """Save a student review."""
         try:
@@ -160,6 +481,7 @@ class GatewayDB:
         except Exception as e:
             logger.error(f"add_review error: {e}")
 
+    @_timed("get_recent_reviews")
     def get_recent_reviews(self, limit=10):
         """Get the last N reviews."""
         try:
@@ -173,5 +495,107 @@ class GatewayDB:
             logger.error(f"get_recent_reviews error: {e}")
             return []
 
+class StateCache:
+    """
+    In-memory copy of the state table, refreshed by a single reader thread.
+
+    Lets hot GET routes answer from memory instead of opening a SQLite
+    connection per key. Writes go through to the DB and update the cache
+    immediately so a POST is visible to the next GET in the same process.
+
+    The reader thread starts on first use in each process: main.py imports
+    the services and then forks them, and threads don't survive a fork.
+    """
+
+    def __init__(self, db, interval=None):
+        self.db = db
+        self.interval = interval if interval is not None else config.STATE_CACHE_INTERVAL
+        self._data = {}
+        self._staged = set()  # keys written locally but not yet flushed to the DB
+        self._versions = {}   # key -> state.version of the cached value
+        self._since = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Fresh locks and no reader: the parent's thread is gone in a forked child
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # orders DB writes; readers never wait on it
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        changed, newest = self.db.get_state_since(self._since)
+        with self._lock:
+            for key, (value, version) in changed.items():
+                # A set() that landed after our read already holds a newer version
+                if key in self._staged or version <= self._versions.get(key, 0):
+                    continue
+                self._data[key] = value
+                self._versions[key] = version
+            self._since = max(self._since, newest)
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"StateCache refresh error: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        """Load the full table once, then start the background reader (once per process)."""
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self.refresh()
+                    self._thread = threading.Thread(target=self._run, daemon=True, name="state-cache")
+                    self._thread.start()
+        return self
+
+    def get(self, key, default=None):
+        self.start()
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        self.start()
+        with self._write_lock:
+            version = self.db.set_state(key, value)
+            with self._lock:
+                self._staged.discard(key)
+                if version is not None and version < self._versions.get(key, 0):
+                    return   # a newer write of this key is already cached
+                self._data[key] = value
+                if version is not None:
+                    self._versions[key] = version
+
+    def stage(self, key, value):
+        """Update the cache only; commit() writes it to the DB later."""
+        self.start()
+        with self._lock:
+            self._data[key] = value
+            self._staged.add(key)
+
+    def commit(self, key):
+        """Write a staged value to the DB. No-op if a direct set() superseded it."""
+        with self._write_lock:
+            with self._lock:
+                if key not in self._staged:
+                    return
+                value = self._data[key]
+            # Outside the lock: GETs keep answering while SQLite writes
+            version = self.db.set_state(key, value)
+            with self._lock:
+                if self._data.get(key) is value:
+                    self._staged.discard(key)   # else re-staged meanwhile: the next flush writes it
+                if version is not None and version > self._versions.get(key, 0):
+                    self._versions[key] = version
+
+    def snapshot(self):
+        self.start()
+        with self._lock:
+            return dict(self._data)
+
 # Global instance for easy import, but config checks happen at runtime
 db = GatewayDB()
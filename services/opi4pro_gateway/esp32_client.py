@@ -1,48 +1,117 @@
 
-import requests
+
+import logging
+import threading
 import time
 
-# Configuration
-ESP32_IP = "192.168.8.191" # Updated based on user testing
-API_KEY = "esp32-secret-key-123"
-TIMEOUT = 5.0  # seconds
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+import metrics
 
-def set_relay(on: bool):
+logger = logging.getLogger("esp32_client")
+logger.setLevel(config.LOG_LEVEL)
+logger.propagate = False
+
+if not logger.handlers:
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(console_handler)
+
+# Configuration (boards and API keys: config.RELAY_DEVICES)
+CONNECT_TIMEOUT = 1.0  # seconds (LAN: a healthy ESP32 accepts in a few ms)
+READ_TIMEOUT = 2.0     # seconds
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Histogram buckets for the ESP32 round-trip (LAN, single-threaded WebServer)
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def _make_session(api_key):
     """
-    Send POST /relay command to ESP32.
+    One keep-alive connection per board (the ESP32 WebServer serves one
+    client at a time, so more parallel sockets only queue up on the chip).
+    Idempotent GETs are retried on connect errors / 5xx, POSTs never are.
     """
-    url = f"http://{ESP32_IP}/relay"
-    headers = {
-        "X-API-Key": API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {"on": on}
-
+    retry_kwargs = dict(total=2, connect=2, read=1, backoff_factor=0.1,
+                        status_forcelist=(502, 503, 504), raise_on_status=False)
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=TIMEOUT)
-        response.raise_for_status()
-        result = response.json()
-        print(f"✅ Relay command {'ON' if on else 'OFF'} sent. Response: {result}")
-        return result
-    except requests.exceptions.RequestException as e:
-        print(f"❌ ESP32 Relay request failed: {e}")
-        return None
+        retry = Retry(allowed_methods=frozenset({"GET"}), **retry_kwargs)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset({"GET"}), **retry_kwargs)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.headers.update({"X-API-Key": api_key})
+    return session
 
-def get_status():
+class ESP32Client:
     """
-    Send GET /status request to ESP32.
+    HTTP client for one relay board.
+
+    Args:
+        device_id (str): Registry ID (metrics label).
+        ip (str): host or host:port.
+        api_key (str): X-API-Key expected by the firmware.
     """
-    url = f"http://{ESP32_IP}/status"
-    headers = {
-        "X-API-Key": API_KEY
-    }
 
-    try:
-        response = requests.get(url, headers=headers, timeout=TIMEOUT)
-        response.raise_for_status()
-        result = response.json()
-        print(f"✅ ESP32 Status: {result}")
+    def __init__(self, device_id, ip, api_key=None):
+        self.device_id = device_id
+        self.ip = ip
+        self.session = _make_session(api_key or config.RELAY_API_KEY)
+
+    def _request(self, op, method, path, **kwargs):
+        t0 = time.perf_counter()
+        result = "fail"
+        try:
+            response = self.session.request(method, f"http://{self.ip}{path}", timeout=TIMEOUT, **kwargs)
+            response.raise_for_status()
+            data = response.json()
+            result = "ok"
+            return data
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"ESP32 [{self.device_id}] {op} request failed: {e}")
+            return None
+        finally:
+            metrics.registry.observe("gateway_esp32_request_seconds", time.perf_counter() - t0,
+                                     help="ESP32 HTTP round-trip time", buckets=RTT_BUCKETS,
+                                     op=op, result=result, device=self.device_id)
+
+    def set_relay(self, on: bool):
+        """
+        Send POST /relay command to ESP32.
+        """
+        result = self._request("relay", "POST", "/relay", json={"on": on})
+        if result is not None:
+            logger.info(f"Relay [{self.device_id}] command {'ON' if on else 'OFF'} sent. Response: {result}")
+        return result
+
+    def get_status(self):
+        """
+        Send GET /status request to ESP32.
+        """
+        result = self._request("status", "GET", "/status")
+        if result is not None:
+            logger.debug(f"ESP32 [{self.device_id}] Status: {result}")
         return result
-    except requests.exceptions.RequestException as e:
-        print(f"❌ ESP32 Status request failed: {e}")
-        return None
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client(device_id=None):
+    """Shared client for a board in config.RELAY_DEVICES (default board if None)."""
+    device_id = device_id or config.RELAY_DEFAULT_DEVICE
+    with _clients_lock:
+        if device_id not in _clients:
+            device = config.RELAY_DEVICES[device_id]
+            _clients[device_id] = ESP32Client(device_id, device["ip"], device.get("api_key"))
+        return _clients[device_id]
+
+def set_relay(on: bool):
+    """POST /relay on the default board."""
+    return client().set_relay(on)
+
+def get_status():
+    """GET /status on the default board."""
+    return client().get_status()
@@ -0,0 +1,221 @@
+# filters.py
+# RTD acquisition pipeline: oversampled burst -> streaming filter stages.
+#
+# Every sensor cycle reads a burst of RTD codes, converts them in one NumPy
+# call and reduces them to one robust value (median of the valid samples).
+# That value then runs through the configured stages, each keeping its own
+# fixed-size ring buffer, so the cost per cycle is constant.
+#
+# Quality flag (published as pv_quality):
+#     0 good      - all burst samples valid, filters warmed up
+#     1 uncertain - some samples invalid/faulted, or filters still filling
+#     2 bad       - too few valid samples (e.g. open/shorted RTD); PV is held
+# A faulted read (MAX31865 fault bit) counts as an invalid sample.
+
+import time
+
+import numpy as np
+
+import config
+import metrics
+
+QUALITY_GOOD = 0
+QUALITY_UNCERTAIN = 1
+QUALITY_BAD = 2
+
+MIN_VALID_FRACTION = 0.5   # below this fraction of valid burst samples -> bad
+
+# Stage timings are in the µs..ms range
+STAGE_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0)
+# A burst is spread over the sample interval (one code per scheduler slot)
+BURST_BUCKETS = (0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 5.0)
+
+
+# ---------------- Stages ----------------
+class RingBuffer:
+    def __init__(self, size):
+        self.data = np.empty(size)
+        self.size = size
+        self.count = 0
+        self.pos = 0
+
+    def push(self, value):
+        self.data[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def values(self):
+        return self.data[:self.count]
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+
+class MedianStage:
+    """Rolling median over the last `window` values (spike rejection)."""
+    name = "median"
+
+    def __init__(self, window=5):
+        self.buf = RingBuffer(int(window))
+
+    def apply(self, x):
+        self.buf.push(x)
+        return float(np.median(self.buf.values()))
+
+    @property
+    def ready(self):
+        return self.buf.full
+
+
+class MovingAverageStage:
+    """Rolling mean over the last `window` values (running sum, O(1))."""
+    name = "moving_average"
+
+    def __init__(self, window=5):
+        self.buf = RingBuffer(int(window))
+        self.total = 0.0
+
+    def apply(self, x):
+        if self.buf.full:
+            self.total -= self.buf.data[self.buf.pos]
+        self.buf.push(x)
+        self.total += x
+        return self.total / self.buf.count
+
+    @property
+    def ready(self):
+        return self.buf.full
+
+
+class EmaStage:
+    """Exponential moving average, y += alpha * (x - y)."""
+    name = "ema"
+
+    def __init__(self, alpha=0.3):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("EMA alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.y = None
+
+    def apply(self, x):
+        self.y = x if self.y is None else self.y + self.alpha * (x - self.y)
+        return self.y
+
+    @property
+    def ready(self):
+        return self.y is not None
+
+
+STAGES = {
+    "median": MedianStage,
+    "moving_average": MovingAverageStage,
+    "ema": EmaStage,
+}
+
+
+def build_stages(spec):
+    """[("median", 5), ("ema", 0.3)] -> list of stage objects."""
+    stages = []
+    for name, param in spec:
+        if name not in STAGES:
+            raise ValueError(f"Unknown filter stage: {name}")
+        stages.append(STAGES[name](param))
+    return stages
+
+
+# ---------------- Pipeline ----------------
+class RtdPipeline:
+    """
+    Args:
+        sensor (MAX31865): RTD driver (codes_to_temps).
+        oversample (int): RTD codes read per cycle.
+        stages (list): Stage spec, default config.RTD_FILTER_STAGES.
+        budget (float): Processing budget per cycle in seconds (convert + filter; overruns are counted).
+    """
+
+    def __init__(self, sensor, oversample=None, stages=None, budget=None):
+        self.sensor = sensor
+        self.oversample = oversample or config.RTD_OVERSAMPLE
+        self.stages = build_stages(config.RTD_FILTER_STAGES if stages is None else stages)
+        self.budget = config.SENSOR_SAMPLE_INTERVAL if budget is None else budget
+        self.filtered = None
+        self.faults = []   # decoded MAX31865 faults of the last cycle
+        self._codes = []   # burst being collected by feed()
+        self._faults = []
+        self._start = None  # perf_counter() at the first code of the burst
+
+    def _observe(self, stage, t0):
+        t1 = time.perf_counter()
+        metrics.registry.observe("gateway_sensor_stage_seconds", t1 - t0,
+                                 help="RTD pipeline stage duration",
+                                 buckets=STAGE_BUCKETS, stage=stage)
+        return t1
+
+    def process(self, temps):
+        """
+        One cycle on already-converted burst temperatures (NaN = invalid).
+
+        Returns:
+            tuple: (raw, filtered, quality)
+        """
+        t0 = time.perf_counter()
+        temps = np.asarray(temps, dtype=float)
+        valid = temps[np.isfinite(temps)]
+        raw = float(valid[-1]) if valid.size else None
+
+        if valid.size < max(1, MIN_VALID_FRACTION * temps.size):
+            self._observe("reduce", t0)
+            return raw, self.filtered, QUALITY_BAD
+
+        x = float(np.median(valid))
+        t0 = self._observe("reduce", t0)
+        for stage in self.stages:
+            x = stage.apply(x)
+            t0 = self._observe(stage.name, t0)
+        self.filtered = x
+
+        warm = all(stage.ready for stage in self.stages)
+        quality = QUALITY_GOOD if valid.size == temps.size and warm else QUALITY_UNCERTAIN
+        return raw, x, quality
+
+    def feed(self, code, faults=()):
+        """
+        Add one RTD code (None = faulted read) from a time-slotted reader.
+
+        Returns (raw, filtered, quality) when the burst is complete, else None.
+        """
+        if not self._codes:
+            self._start = time.perf_counter()
+        self._codes.append(code)
+        self._faults.extend(faults)
+        if len(self._codes) < self.oversample:
+            return None
+        codes, faults = self._codes, self._faults
+        self._codes, self._faults = [], []
+        return self._finish(codes, faults, self._start)
+
+    def _finish(self, codes, faults, start):
+        self.faults = sorted(set(faults))
+        for name in faults:
+            metrics.registry.inc("gateway_sensor_faults_total", help="Sensor reads with a fault flag set",
+                                 sensor="max31865", fault=name)
+        t0 = time.perf_counter()
+        temps = self.sensor.codes_to_temps(codes)
+        self._observe("convert", t0)
+
+        result = self.process(temps)
+
+        # Budget = processing cost (convert + filter); the burst span is
+        # mostly scheduler spacing and is tracked on its own
+        t1 = time.perf_counter()
+        elapsed = t1 - t0
+        metrics.registry.observe("gateway_sensor_pipeline_seconds", elapsed,
+                                 help="RTD pipeline processing duration (convert + filter)",
+                                 buckets=STAGE_BUCKETS)
+        metrics.registry.observe("gateway_sensor_burst_seconds", t1 - start,
+                                 help="RTD burst duration, first read to filtered value", buckets=BURST_BUCKETS)
+        if elapsed > self.budget:
+            metrics.registry.inc("gateway_sensor_budget_overruns_total",
+                                 help="RTD pipeline processing over the cycle budget")
+        return result
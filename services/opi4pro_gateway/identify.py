@@ -0,0 +1,155 @@
+# identify.py
+# Incremental FOPDT (first-order-plus-dead-time) identification from MV steps.
+#
+# Model (deviation variables, sample period dt, zero-order hold):
+#     y[k+1] = a * y[k] + b * u[k-d]
+#     a = exp(-dt / tau),  K = b / (1 - a),  theta = d * dt
+#
+# For every candidate delay d = 0..max_delay-1 we keep the least-squares
+# normal-equation sums as NumPy vectors. Each new sample updates all of them
+# in O(max_delay) vector ops, and a fit is a closed-form 2x2 solve per delay -
+# no recomputation over the history.
+
+import math
+import threading
+
+import numpy as np
+
+from analysis import STEP_MIN_MV
+
+MV_TOLERANCE = 0.5        # %: MV must stay this close to the stepped value
+MIN_SEGMENT_SAMPLES = 30  # samples needed before a fit is reported
+MAX_DELAY_SAMPLES = 120   # largest dead time considered (samples)
+MAX_SEGMENTS = 20         # finished segment fits kept
+
+
+class StepSegment:
+    """Least-squares sums for one MV step, for all candidate delays at once."""
+
+    def __init__(self, t0, pv0, mv0, mv_step, max_delay=MAX_DELAY_SAMPLES):
+        self.t0 = t0
+        self.t_last = t0
+        self.pv0 = pv0
+        self.mv0 = mv0
+        self.mv_level = mv_step
+        self.n = 0
+        self.max_delay = max_delay
+        self.u_hist = np.zeros(max_delay)   # u[k], u[k-1], ... (u = 0 before the step)
+        self.y_prev = None
+        # Normal-equation sums per delay: regressors (y[k], u[k-d]), target y[k+1]
+        self.s_yy = 0.0
+        self.s_yu = np.zeros(max_delay)
+        self.s_uu = np.zeros(max_delay)
+        self.s_ty = 0.0
+        self.s_tu = np.zeros(max_delay)
+        self.s_tt = 0.0
+
+    def update(self, t, pv, mv):
+        y = pv - self.pv0
+        u = mv - self.mv0
+        if self.y_prev is not None:
+            lag = self.u_hist          # lag[d] = u[k-d] for the previous sample k
+            yp = self.y_prev
+            self.s_yy += yp * yp
+            self.s_yu += yp * lag
+            self.s_uu += lag * lag
+            self.s_ty += y * yp
+            self.s_tu += y * lag
+            self.s_tt += y * y
+        self.u_hist = np.roll(self.u_hist, 1)
+        self.u_hist[0] = u
+        self.y_prev = y
+        self.t_last = t
+        self.n += 1
+
+    def fit(self):
+        """Best (K, tau, theta) over all candidate delays, or None."""
+        if self.n < MIN_SEGMENT_SAMPLES:
+            return None
+        det = self.s_yy * self.s_uu - self.s_yu ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = (self.s_ty * self.s_uu - self.s_tu * self.s_yu) / det
+            b = (self.s_yy * self.s_tu - self.s_yu * self.s_ty) / det
+            sse = self.s_tt - a * self.s_ty - b * self.s_tu
+        valid = (det > 1e-12) & (a > 0.0) & (a < 1.0) & np.isfinite(sse)
+        # Delays longer than the data seen so far are not identifiable
+        valid[min(self.n - 1, self.max_delay):] = False
+        if not valid.any():
+            return None
+
+        d = int(np.argmin(np.where(valid, sse, np.inf)))
+        dt = (self.t_last - self.t0) / max(1, self.n - 1)
+        a_d, b_d = float(a[d]), float(b[d])
+        r2 = 1.0 - float(sse[d]) / self.s_tt if self.s_tt > 0 else None
+        return {
+            "K": b_d / (1.0 - a_d),                 # °C per % MV
+            "tau": -dt / math.log(a_d),             # s
+            "theta": d * dt,                         # s
+            "r2": r2,
+            "samples": self.n,
+            "dt": dt,
+            "step_ts": self.t0,
+            "mv_from": self.mv0,
+            "mv_to": self.mv_level,
+            "pv0": self.pv0,
+        }
+
+
+class FopdtIdentifier:
+    """
+    Detects MV step segments in a stream of trend samples and fits each one.
+
+    Feed samples with update(); the current segment is re-fitted in closed
+    form on demand, finished segments keep their last fit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_ts = None
+        self.prev_pv = None
+        self.prev_mv = None
+        self.segment = None
+        self.fits = []   # finished segments, oldest first
+
+    def _finish_segment(self):
+        if self.segment is not None:
+            fit = self.segment.fit()
+            if fit is not None:
+                self.fits.append(fit)
+                del self.fits[:-MAX_SEGMENTS]
+            self.segment = None
+
+    def update(self, ts, pv, mv):
+        if pv is None or mv is None or (isinstance(pv, float) and math.isnan(pv)) \
+                or (isinstance(mv, float) and math.isnan(mv)):
+            return
+        if self.prev_mv is not None and abs(mv - self.prev_mv) >= STEP_MIN_MV:
+            # New MV step: close the running segment and start fitting this one
+            self._finish_segment()
+            self.segment = StepSegment(ts, self.prev_pv, self.prev_mv, mv)
+        elif self.segment is not None and abs(mv - self.segment.mv_level) > MV_TOLERANCE:
+            # MV is moving (e.g. PID in control): not a clean step any more
+            self._finish_segment()
+
+        if self.segment is not None:
+            self.segment.update(ts, pv, mv)
+            if self.segment.n >= 4 * MAX_DELAY_SAMPLES:
+                self._finish_segment()
+
+        self.prev_pv = pv
+        self.prev_mv = mv
+        self.last_ts = ts
+
+    def update_many(self, rows):
+        """Feed (ts, pv, sp, mv) rows in time order."""
+        for ts, pv, _sp, mv in rows:
+            self.update(ts, pv, mv)
+
+    def result(self):
+        current = self.segment.fit() if self.segment is not None else None
+        latest = current or (self.fits[-1] if self.fits else None)
+        return {
+            "model": latest,
+            "active_segment": current,
+            "segments": list(self.fits),
+        }
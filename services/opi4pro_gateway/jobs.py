@@ -0,0 +1,171 @@
+# jobs.py
+# Single-worker background job runner for long-running gateway sequences
+# (soft shutdown, camera power-cycle).
+#
+# - Jobs run one at a time, in submission order -> power orders are serialized
+# - A job with the same dedup key as an active (queued/running) job is not
+#   queued again; the caller gets the existing job back
+# - Jobs wait with job.sleep(), which wakes immediately on cancel()
+
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled."""
+
+
+class Job:
+    def __init__(self, kind, fn, dedup_key=None, kwargs=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.dedup_key = dedup_key
+        self.fn = fn
+        self.kwargs = kwargs or {}
+        self.status = QUEUED
+        self.message = ""
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+
+    # ---- Helpers used by the job function ----
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        """Raise JobCancelled if cancellation was requested."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def sleep(self, seconds):
+        """Interruptible sleep. Raises JobCancelled if cancelled meanwhile."""
+        if self._cancel.wait(seconds):
+            raise JobCancelled()
+
+    def progress(self, message):
+        self.message = message
+        print(f"[job {self.id} {self.kind}] {message}")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "message": self.message,
+            "error": self.error,
+            "result": self.result,
+            "params": self.kwargs,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    """
+    The worker thread starts on the first submit() in each process, so a
+    runner created at import time still works after main.py forks.
+
+    Args:
+        history (int): Number of finished jobs kept for /jobs/<id> lookups.
+    """
+
+    def __init__(self, history=50):
+        self.history = history
+        self._jobs = OrderedDict()  # id -> Job (insertion order)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Fresh queue/lock and no worker: the parent's thread is gone in a forked child
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_worker(self):
+        # Called with self._lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True, name="job-runner")
+            self._thread.start()
+
+    def submit(self, kind, fn, dedup_key=None, **kwargs):
+        """
+        Queue fn(job, **kwargs).
+
+        Returns:
+            tuple: (job, created) - created is False if an active duplicate was returned.
+        """
+        with self._lock:
+            if dedup_key is not None:
+                for job in self._jobs.values():
+                    if job.dedup_key == dedup_key and job.status in ACTIVE_STATES:
+                        return job, False
+            job = Job(kind, fn, dedup_key, kwargs)
+            self._jobs[job.id] = job
+            self._trim()
+            self._ensure_worker()
+        self._queue.put(job)
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self, kind=None):
+        with self._lock:
+            return [j for j in self._jobs.values()
+                    if j.status in ACTIVE_STATES and (kind is None or j.kind == kind)]
+
+    def cancel(self, job_id):
+        """Request cancellation. Returns the job (or None if unknown)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in ACTIVE_STATES:
+                job._cancel.set()
+                if job.status == QUEUED:
+                    job.status = CANCELLED
+                    job.finished_at = time.time()
+        return job
+
+    def _trim(self):
+        finished = [jid for jid, j in self._jobs.items() if j.status not in ACTIVE_STATES]
+        for jid in itertools.islice(finished, max(0, len(finished) - self.history)):
+            del self._jobs[jid]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.status == CANCELLED:
+                    continue
+                job.status = RUNNING
+                job.started_at = time.time()
+            try:
+                job.result = job.fn(job, **job.kwargs)
+                job.status = DONE
+            except JobCancelled:
+                job.status = CANCELLED
+                job.progress("cancelled")
+            except Exception as e:
+                job.status = FAILED
+                job.error = str(e)
+                job.progress(f"failed: {e}")
+            finally:
+                job.finished_at = time.time()
@@ -0,0 +1,102 @@
+# kpi.py
+# Streaming control-quality KPIs, updated in O(1) per trend sample.
+#
+# A segment runs while the control mode and setpoint stay the same; a mode
+# change or an SP step (>= analysis.STEP_MIN_SP) closes it and opens the next.
+# Per segment we accumulate IAE, ISE, overshoot, time-in-band and MV travel,
+# and persist the running totals to the kpi_segments table.
+
+import config
+from analysis import STEP_MIN_SP
+
+
+class KpiSegment:
+    def __init__(self, ts, pv, sp, mv, mode):
+        self.id = None
+        self.started_at = ts
+        self.ended_at = ts
+        self.mode = mode
+        self.sp = sp
+        self.pv_start = pv
+        # +1 heating towards SP, -1 cooling towards SP (overshoot direction)
+        self.direction = 1.0 if sp is None or pv is None or sp >= pv else -1.0
+        self.samples = 1
+        self.iae = 0.0
+        self.ise = 0.0
+        self.overshoot = 0.0
+        self.time_in_band = 0.0
+        self.mv_travel = 0.0
+        self.last_ts = ts
+        self.last_mv = mv
+
+    def update(self, ts, pv, sp, mv, band):
+        dt = ts - self.last_ts
+        if dt > 0 and pv is not None and sp is not None:
+            e = sp - pv
+            self.iae += abs(e) * dt
+            self.ise += e * e * dt
+            if abs(e) <= band:
+                self.time_in_band += dt
+            self.overshoot = max(self.overshoot, -e * self.direction)
+        if mv is not None and self.last_mv is not None:
+            self.mv_travel += abs(mv - self.last_mv)
+        self.last_ts = ts
+        self.last_mv = mv
+        self.ended_at = ts
+        self.samples += 1
+
+    def to_dict(self):
+        duration = self.ended_at - self.started_at
+        return {
+            "id": self.id,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "mode": self.mode,
+            "sp": self.sp,
+            "pv_start": self.pv_start,
+            "samples": self.samples,
+            "duration": duration,
+            "iae": self.iae,
+            "ise": self.ise,
+            "overshoot": self.overshoot,
+            "time_in_band": self.time_in_band,
+            "time_in_band_pct": 100.0 * self.time_in_band / duration if duration > 0 else None,
+            "mv_travel": self.mv_travel,
+        }
+
+
+class KpiAccumulator:
+    """
+    Args:
+        db (GatewayDB): Database wrapper (kpi_segments table).
+        band (float): ±band around SP counted as "in band" (°C).
+        persist_every (int): Write running totals every N samples.
+    """
+
+    def __init__(self, db, band=None, persist_every=None):
+        self.db = db
+        self.band = config.KPI_BAND if band is None else band
+        self.persist_every = persist_every or config.KPI_PERSIST_EVERY
+        self.segment = None
+
+    def _persist(self):
+        self.segment.id = self.db.save_kpi_segment(self.segment.to_dict())
+
+    def update(self, ts, pv, sp, mv, mode):
+        seg = self.segment
+        sp_step = (seg is not None and sp is not None and seg.sp is not None
+                   and abs(sp - seg.sp) >= STEP_MIN_SP)
+        if seg is None or mode != seg.mode or sp_step or (seg.sp is None) != (sp is None):
+            self.close()
+            self.segment = KpiSegment(ts, pv, sp, mv, mode)
+            self._persist()
+            return
+
+        seg.update(ts, pv, sp, mv, self.band)
+        if seg.samples % self.persist_every == 0:
+            self._persist()
+
+    def close(self):
+        if self.segment is not None:
+            self._persist()
+            self.segment = None
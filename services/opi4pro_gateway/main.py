@@ -1,9 +1,9 @@
 # main.py
 from multiprocessing import Process
-from temp_reading import main as sensor_main
-from web_api import app
-from relay_service import main as relay_main
-from modbus_server import main as modbus_main  # ⬅️ DISABLED: pymodbus version incompatibility
+from service_sensor import main as sensor_main
+from service_web import main as web_main
+from service_relay import main as relay_main
+from service_modbus import main as modbus_main
 
 import time
 import logging
@@ -18,8 +18,9 @@ logging.basicConfig(
 logger = logging.getLogger("main")
 
 def run_flask():
-    print("🚀 Starting Flask server...")
-    app.run(host="0.0.0.0", port=5000)
+    # Dev server or waitress thread pool, selected by WEB_SERVER (see config.py)
+    print("🚀 Starting web server...")
+    web_main()
 
 class ProcessManager:
     def __init__(self):
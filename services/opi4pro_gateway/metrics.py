@@ -0,0 +1,163 @@
+# metrics.py
+# Lightweight in-process metrics registry (Prometheus text exposition).
+#
+# Every gateway service runs in its own process, so each one keeps a local
+# registry (cheap dict updates on the hot path) and periodically flushes a
+# snapshot into the shared state table under "metrics_<service>".
+# service_web renders its own live registry plus those snapshots on /metrics.
+
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# Default latency buckets (seconds)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+STATE_KEY_PREFIX = "metrics_"
+
+
+def _label_key(labels):
+    """Labels dict -> hashable, order-independent key."""
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms keyed by (name, labels).
+
+    Args:
+        service (str): Name used for the shared snapshot key and the `service` label.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> float
+        self._gauges = {}      # (name, labels) -> float
+        self._histograms = {}  # (name, labels) -> [bucket_counts..., sum, count]
+        self._buckets = {}     # name -> bucket bounds
+        self._help = {}        # name -> (type, help text)
+        self._last_flush = 0.0
+
+    # ---------------- Publishing ----------------
+    def inc(self, name, value=1.0, help="", **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help))
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name, value, help="", **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._help.setdefault(name, ("gauge", help))
+            self._gauges[key] = float(value)
+
+    def observe(self, name, value, help="", buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = tuple(buckets)
+                self._help[name] = ("histogram", help)
+            bounds = self._buckets[name]
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * len(bounds) + [0.0, 0]
+            for i, le in enumerate(bounds):
+                if value <= le:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name, help="", **labels):
+        """Observe the duration of the `with` block in seconds."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, help=help, **labels)
+
+    # ---------------- Sharing between processes ----------------
+    def snapshot(self):
+        """JSON-serializable copy of the registry."""
+        with self._lock:
+            return {
+                "service": self.service,
+                "ts": time.time(),
+                "help": {k: list(v) for k, v in self._help.items()},
+                "buckets": {k: list(v) for k, v in self._buckets.items()},
+                "counters": [[n, list(map(list, l)), v] for (n, l), v in self._counters.items()],
+                "gauges": [[n, list(map(list, l)), v] for (n, l), v in self._gauges.items()],
+                "histograms": [[n, list(map(list, l)), list(h)] for (n, l), h in self._histograms.items()],
+            }
+
+    def maybe_flush(self, db, interval=None):
+        """Write a snapshot to the state table at most once per `interval` seconds."""
+        interval = config.METRICS_FLUSH_INTERVAL if interval is None else interval
+        now = time.monotonic()
+        if now - self._last_flush < interval:
+            return
+        self._last_flush = now
+        db.set_state(STATE_KEY_PREFIX + self.service, self.snapshot())
+
+
+# ---------------- Text exposition ----------------
+def _fmt_labels(labels, extra=None):
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    body = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items)
+    return "{" + body + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def render(snapshots):
+    """Render a list of registry snapshots in Prometheus text format (version 0.0.4)."""
+    helps = {}
+    samples = {}  # name -> [lines]
+    for snap in snapshots:
+        service = snap.get("service", "unknown")
+        svc = {"service": service}
+        for name, (mtype, text) in snap.get("help", {}).items():
+            helps.setdefault(name, (mtype, text))
+        for name, labels, value in snap.get("counters", []):
+            samples.setdefault(name, []).append(f"{name}{_fmt_labels(labels, svc)} {_fmt_value(value)}")
+        for name, labels, value in snap.get("gauges", []):
+            samples.setdefault(name, []).append(f"{name}{_fmt_labels(labels, svc)} {_fmt_value(value)}")
+        for name, labels, h in snap.get("histograms", []):
+            bounds = snap.get("buckets", {}).get(name, [])
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for le, n in zip(bounds, h):
+                cumulative += n
+                lines.append(f"{name}_bucket{_fmt_labels(labels, dict(svc, le=_fmt_value(float(le))))} {cumulative}")
+            lines.append(f"{name}_bucket{_fmt_labels(labels, dict(svc, le='+Inf'))} {h[-1]}")
+            lines.append(f"{name}_sum{_fmt_labels(labels, svc)} {_fmt_value(float(h[-2]))}")
+            lines.append(f"{name}_count{_fmt_labels(labels, svc)} {h[-1]}")
+
+    out = []
+    for name in sorted(samples):
+        mtype, text = helps.get(name, ("untyped", ""))
+        if text:
+            out.append(f"# HELP {name} {text}")
+        out.append(f"# TYPE {name} {mtype}")
+        out.extend(samples[name])
+    return "\n".join(out) + "\n"
+
+
+# Per-process registry. Each service renames it at startup via init().
+registry = MetricsRegistry("gateway")
+
+
+def init(service):
+    """Name this process's registry (call once from the service entry point)."""
+    registry.service = service
+    return registry
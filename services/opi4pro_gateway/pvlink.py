@@ -0,0 +1,86 @@
+# pvlink.py
+# Low-latency PV hand-off: service_sensor -> service_modbus.
+#
+# A Unix datagram socket carries each new PV right after acquisition, so the
+# modbus service can write HR1-2 / HR17 immediately instead of picking the
+# value up from SQLite on its next 100 ms poll. The state table is still
+# written as before and remains the fallback if the socket is down.
+#
+# Message: seq (uint32), pv (float64, NaN = no valid PV), quality (uint8),
+# t_acq (float64, time.monotonic() at acquisition; CLOCK_MONOTONIC is shared
+# by all processes on the box, so the receiver can compute the latency).
+
+import math
+import os
+import select
+import socket
+import struct
+import time
+
+import config
+
+MSG = struct.Struct("<IdBd")
+
+
+class PvSender:
+    def __init__(self, path=None):
+        self.path = path or config.PV_SOCKET_PATH
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.seq = 0
+
+    def send(self, pv, quality, t_acq):
+        """Fire and forget: never blocks the sensor loop, drops if nobody listens."""
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        msg = MSG.pack(self.seq, math.nan if pv is None else float(pv), int(quality), t_acq)
+        try:
+            self.sock.sendto(msg, self.path)
+            return True
+        except OSError:
+            # No listener, full queue, permissions, ENOBUFS ... the state table
+            # is still written, so the socket is never allowed to break publishing
+            return False
+
+    def close(self):
+        self.sock.close()
+
+
+class PvReceiver:
+    def __init__(self, path=None):
+        self.path = path or config.PV_SOCKET_PATH
+        try:
+            os.unlink(self.path)    # stale socket from a previous run
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+
+    def wait(self, timeout):
+        """
+        Block up to `timeout` seconds for PV messages.
+
+        Returns:
+            tuple: newest (seq, pv, quality, t_acq, t_recv) or None. Older
+                   queued messages are dropped - only the latest PV matters.
+        """
+        latest = None
+        if timeout > 0:
+            ready, _, _ = select.select([self.sock], [], [], timeout)
+            if not ready:
+                return None
+        while True:
+            try:
+                data = self.sock.recv(MSG.size)
+            except BlockingIOError:
+                break
+            if len(data) == MSG.size:
+                latest = MSG.unpack(data) + (time.monotonic(),)
+        return latest
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,120 @@
+# relays.py
+# Relay board registry (config.RELAY_DEVICES) and per-device state keys.
+#
+# service_relay runs one controller per board; service_web queues orders and
+# serves status from its StateCache. The default board keeps the original
+# single-relay key names (relay_cmd, relay_actual, esp32_connected, ...), so
+# /relay, /relay_status and existing dashboards work unchanged; other boards
+# use "relay:<device_id>:<field>".
+#
+# The state table holds the orders; a Unix datagram (the board id) on
+# RELAY_WAKE_SOCKET_PATH only wakes service_relay so it reads a new order at
+# once. A lost wake-up is caught by the relay service's periodic re-check.
+
+import os
+import socket
+import time
+
+import config
+
+LEGACY_KEYS = {
+    "cmd": "relay_cmd",               # queued order {"seq", "on", "ts"} (last writer wins)
+    "ack_seq": "relay_ack_seq",       # seq of the last applied order
+    "desired": "relay_desired",       # 1/0, mirror of the newest order
+    "actual": "relay_actual",         # relay state reported by the board
+    "connected": "esp32_connected",
+    "last_seen": "esp32_last_seen",   # wall time of the last good response
+}
+
+
+def device_ids():
+    """Default board first, then the others in config order."""
+    ids = [config.RELAY_DEFAULT_DEVICE]
+    ids.extend(d for d in config.RELAY_DEVICES if d != config.RELAY_DEFAULT_DEVICE)
+    return ids
+
+
+def exists(device_id):
+    return device_id in config.RELAY_DEVICES
+
+
+def key(device_id, field):
+    """State-table key of `field` for a board."""
+    if device_id is None or device_id == config.RELAY_DEFAULT_DEVICE:
+        return LEGACY_KEYS[field]
+    return f"relay:{device_id}:{field}"
+
+
+def device_status(store, device_id=None, now=None):
+    """
+    Cached status of one board (no ESP32 request).
+
+    Args:
+        store: StateCache / anything with get(key, default).
+
+    Returns:
+        dict: alive, relay (None if stale), last_seen_s, desired, pending,
+              seq (newest order) and ack_seq (last applied order)
+    """
+    now = time.time() if now is None else now
+    age = now - (store.get(key(device_id, "last_seen"), 0) or 0)
+
+    # If data is too old, mark as offline/stale even if flag says connected
+    connected = bool(store.get(key(device_id, "connected"), False)) and age <= config.RELAY_STALE_AFTER
+
+    cmd = store.get(key(device_id, "cmd")) or {}
+    seq = int(cmd.get("seq", 0))
+    ack_seq = int(store.get(key(device_id, "ack_seq"), 0) or 0)
+    return {
+        "alive": connected,
+        "relay": store.get(key(device_id, "actual")) if connected else None, # Return null if stale
+        "last_seen_s": float(f"{age:.1f}"), # seconds since last successful poll
+        "desired": bool(store.get(key(device_id, "desired"), 0)),
+        "pending": seq > ack_seq,
+        "seq": seq,
+        "ack_seq": ack_seq,
+    }
+
+
+def fleet_status(store, now=None):
+    """Cached status of every board, plus a summary."""
+    now = time.time() if now is None else now
+    devices = []
+    for device_id in device_ids():
+        status = device_status(store, device_id, now)
+        status["id"] = device_id
+        status["name"] = config.RELAY_DEVICES[device_id].get("name", device_id)
+        devices.append(status)
+    return {
+        "default": config.RELAY_DEFAULT_DEVICE,
+        "devices": devices,
+        "alive": sum(1 for d in devices if d["alive"]),
+        "on": sum(1 for d in devices if d["relay"]),
+        "pending": sum(1 for d in devices if d["pending"]),
+    }
+
+
+# ---- New-order wake-ups ----
+def notify(device_id=None, path=None):
+    """Wake service_relay for a new order. Fire and forget: False if nobody listens."""
+    device_id = device_id or config.RELAY_DEFAULT_DEVICE
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(device_id.encode(), path or config.RELAY_WAKE_SOCKET_PATH)
+        return True
+    except OSError:
+        return False
+
+
+def wake_socket(path=None):
+    """Bound, non-blocking receiver for notify() (service_relay)."""
+    path = path or config.RELAY_WAKE_SOCKET_PATH
+    try:
+        os.unlink(path)    # stale socket from a previous run
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.setblocking(False)
+    return sock
@@ -0,0 +1,125 @@
+# scheduler.py
+# Time-slotted scheduler for the sensors sharing SPI3.
+#
+# Every device read is a short, non-blocking slot (one SPI transfer) with its
+# own period. A single thread runs the slot whose deadline is next and only
+# waits when nothing is due, so the MAX31865 oversampling reads interleave
+# with the MAX31855 reads instead of sleeping back to back. Deadlines are on
+# the monotonic clock and advance by whole periods (no drift); a slot that
+# falls more than a period behind skips ahead and counts an overrun.
+#
+# Jitter = (actual start-to-start interval) - period, tracked per slot with
+# Welford's running mean/variance and exported as a histogram of |jitter|.
+
+import math
+import time
+
+import metrics
+from filters import STAGE_BUCKETS
+
+
+class Slot:
+    def __init__(self, name, period, fn, offset=0.0):
+        self.name = name
+        self.period = period
+        self.fn = fn
+        self.next_due = time.monotonic() + offset
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.max_lag = 0.0
+        self.overruns = 0
+        self.errors = 0
+        self.last_start = None
+        self.due_mono = None  # scheduled start of the current run (monotonic, on the period grid)
+        self.due_wall = None  # the same instant on the wall clock
+        self.jitter_n = 0
+        self.jitter_mean = 0.0
+        self.jitter_m2 = 0.0
+        self.jitter_max = 0.0
+
+    def record_start(self, t0):
+        if self.last_start is not None:
+            jitter = (t0 - self.last_start) - self.period
+            self.jitter_n += 1
+            delta = jitter - self.jitter_mean
+            self.jitter_mean += delta / self.jitter_n
+            self.jitter_m2 += delta * (jitter - self.jitter_mean)
+            self.jitter_max = max(self.jitter_max, abs(jitter))
+            metrics.registry.observe("gateway_sensor_jitter_seconds", abs(jitter),
+                                     help="Sensor slot |start interval - period|",
+                                     buckets=STAGE_BUCKETS, sensor=self.name)
+        self.last_start = t0
+
+    def stats(self):
+        return {
+            "period_ms": round(self.period * 1000, 3),
+            "reads": self.count,
+            "last_ms": round(self.last * 1000, 3),
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "overruns": self.overruns,
+            "errors": self.errors,
+            "jitter_mean_ms": round(self.jitter_mean * 1000, 3),
+            "jitter_std_ms": round(math.sqrt(self.jitter_m2 / self.jitter_n) * 1000, 3) if self.jitter_n else None,
+            "jitter_max_ms": round(self.jitter_max * 1000, 3),
+        }
+
+
+class SensorScheduler:
+    def __init__(self):
+        self.slots = []
+
+    def add(self, name, period, fn, offset=0.0):
+        """Run fn() every `period` seconds, first after `offset` seconds."""
+        slot = Slot(name, period, fn, offset)
+        self.slots.append(slot)
+        return slot
+
+    def run_once(self):
+        """Wait for the next due slot and run it."""
+        slot = min(self.slots, key=lambda s: s.next_due)
+        wait = slot.next_due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        t0 = time.monotonic()
+        lag = t0 - slot.next_due
+        slot.due_mono = slot.next_due
+        slot.due_wall = time.time() - lag
+        slot.record_start(t0)
+        try:
+            slot.fn()
+        except Exception as e:
+            slot.errors += 1
+            print(f"Sensor slot '{slot.name}' error: {e}")
+        elapsed = time.monotonic() - t0
+
+        slot.count += 1
+        slot.total += elapsed
+        slot.last = elapsed
+        slot.max = max(slot.max, elapsed)
+        slot.max_lag = max(slot.max_lag, lag)
+        metrics.registry.observe("gateway_sensor_read_seconds", elapsed,
+                                 help="Sensor slot duration", buckets=STAGE_BUCKETS, sensor=slot.name)
+        metrics.registry.observe("gateway_sensor_slot_lag_seconds", max(0.0, lag),
+                                 help="Sensor slot start delay", buckets=STAGE_BUCKETS, sensor=slot.name)
+
+        slot.next_due += slot.period
+        now = time.monotonic()
+        if slot.next_due < now:
+            # More than a period behind: skip the missed slots
+            slot.overruns += 1
+            metrics.registry.inc("gateway_sensor_slot_overruns_total",
+                                 help="Sensor slots skipped", sensor=slot.name)
+            slot.next_due = now + slot.period
+            slot.last_start = None   # the gap is an overrun, not jitter
+
+    def run_forever(self):
+        while True:
+            self.run_once()
+
+    def stats(self):
+        return {slot.name: slot.stats() for slot in self.slots}
@@ -1,6 +1,7 @@
 # service_modbus.py
 # NOW ACTING AS CLIENT (MASTER)
 
+import math
 import struct
 import time
 import logging
@@ -11,7 +12,12 @@ from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder
 from pymodbus.constants import Endian
 
 from database import db  # SQLite wrapper
+from pvlink import PvReceiver
 import config
+import metrics
+
+# PV latencies are in the 0.1..10 ms range
+LATENCY_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
 
 # Setup logger
 logger = logging.getLogger("modbus_client")
@@ -43,8 +49,41 @@ def registers_to_float(regs):
     decoder = BinaryPayloadDecoder.fromRegisters(regs, byteorder=Endian.Big, wordorder=Endian.Big)
     return decoder.decode_32bit_float()
 
+def write_pushed_pv(client, payload, msg):
+    """
+    Fast path: a new PV arrived from service_sensor -> write it now.
+
+    Re-sends the last HR0..HR17 block with only HR1-2 / HR17 replaced, so the
+    sequence number and the command values are exactly what the PLC already has.
+    """
+    _seq, pv, quality, t_acq, t_recv = msg
+    payload = list(payload)
+    if not math.isnan(pv):
+        payload[1:3] = float_to_registers(pv)   # HR1-2
+    payload[17] = quality                        # HR17
+    wr = client.write_registers(0, payload, unit=1)
+    if wr.isError():
+        logger.error(f"PV write error: {wr}")
+        metrics.registry.inc("gateway_modbus_errors_total", help="Modbus read/write errors", op="pv_write")
+        return None
+    t_done = time.monotonic()
+    metrics.registry.observe("gateway_pv_ipc_seconds", t_recv - t_acq,
+                             help="PV acquisition -> modbus service (socket)", buckets=LATENCY_BUCKETS)
+    metrics.registry.observe("gateway_pv_e2e_seconds", t_done - t_acq,
+                             help="PV acquisition -> written to PLC (HR1-2)", buckets=LATENCY_BUCKETS)
+    return payload
+
 def modbus_loop():
     client = ModbusTcpClient(config.PLC_IP, port=config.PLC_PORT, timeout=config.MODBUS_TIMEOUT)
+
+    # Event-driven PV from service_sensor (falls back to polling the DB if unavailable)
+    try:
+        pv_rx = PvReceiver()
+    except OSError as e:
+        logger.warning(f"PV socket unavailable, polling DB only: {e}")
+        pv_rx = None
+    pushed = None          # newest PV message from the socket
+    last_payload = None    # last HR0..HR17 block written (base for the fast path)
     
     last_connection_attempt = 0
     
@@ -56,6 +95,7 @@ def modbus_loop():
     tune_done_latch = False
 
     while True:
+        cycle_t0 = time.perf_counter()
         try:
             # Connection Logic
             if not client.is_socket_open():
@@ -74,7 +114,7 @@ def modbus_loop():
                 time.sleep(1)
                 continue
 
-            # --- 1) WRITE GW -> PLC : HR0..HR16 (17 regs) ---
+            # --- 1) WRITE GW -> PLC : HR0..HR17 (18 regs) ---
             # Retrieve latest state from DB
             gw_tx_seq = db.get_state("gw_tx_seq", 0) # Reload in case it changed externally, though main source is here.
             
@@ -82,7 +122,8 @@ def modbus_loop():
             mode       = int(db.get_state("mode", 0))
             plc_status = int(db.get_state("plc_status", 0))
 
-            rtd_temp   = float(db.get_state("rtd_temp", 0.0)) # Note: Used to be read from PLC, now seems Gateway sends it? 
+            # HR1-2 carries the selected PV source ("pv", see service_sensor.py)
+            rtd_temp   = float(db.get_state("pv", db.get_state("rtd_temp", 0.0))) # Note: Used to be read from PLC, now seems Gateway sends it? 
             # WAIT: MODBUS_MAP says HR1-2 is rtd_temp (Process Temperature). 
             # Usually Process Temp comes FROM PLC.
             # But the map says "Block 1: Gateway to PLC (Read by PLC)" contains HR1-2 `rtd_temp`.
@@ -90,6 +131,27 @@ def modbus_loop():
             # User snippet includes: write_payload.extend(float_to_registers(rtd_temp))
             # So I will follow the snippet.
 
+            # PV quality (0 good / 1 uncertain / 2 bad). A stale sensor is bad too,
+            # so the PLC fails safe if service_sensor stops updating.
+            pv_quality = int(db.get_state("pv_quality", 0) or 0)
+            # Monotonic age when available (immune to NTP steps), wall clock otherwise.
+            # A value from before a reboot can be ahead of the clock -> use wall time.
+            last_mono = db.get_state("last_update_mono")
+            if last_mono is not None and last_mono <= time.monotonic():
+                pv_age = time.monotonic() - last_mono
+            else:
+                pv_age = time.time() - (db.get_state("last_update_ts", 0.0) or 0.0)
+            if pushed is not None:
+                # The socket is newer than the DB: never write an older PV over it
+                push_age = time.monotonic() - pushed[3]
+                if push_age < pv_age:
+                    pv_age = push_age
+                    pv_quality = pushed[2]
+                    if not math.isnan(pushed[1]):
+                        rtd_temp = pushed[1]
+            if pv_age > config.PV_STALE_AFTER:
+                pv_quality = 2
+
             mv_manual  = float(db.get_state("mv_manual", 0.0))
 
             setpoint   = float(db.get_state("setpoint", 0.0))
@@ -99,10 +161,12 @@ def modbus_loop():
             pid_ti = float(db.get_state("pid_ti", 0.0))
             pid_td = float(db.get_state("pid_td", 0.0))
 
-            # increment seq only when anything changes
+            # increment seq only when a COMMAND changes
             # We construct snapshot from the VALUES we are about to write (excluding seq itself)
-            # Note: rtd_temp is in the snapshot in user snippet.
-            snapshot = (web_status, mode, plc_status, rtd_temp, mv_manual, setpoint, tune_cmd, pid_pb, pid_ti, pid_td)
+            # rtd_temp / pv_quality are deliberately NOT in the snapshot: the PLC copies
+            # HR1-2 and HR17 every scan (CommTask.st), so a new PV must not make it
+            # re-accept the command block.
+            snapshot = (web_status, mode, plc_status, mv_manual, setpoint, tune_cmd, pid_pb, pid_ti, pid_td)
             
             if snapshot != last_snapshot:
                 gw_tx_seq = (gw_tx_seq + 1) & 0xFFFF # 0, 1, 2, 3 ... 65535, 0, 1...
@@ -121,10 +185,14 @@ def modbus_loop():
             write_payload.extend(float_to_registers(pid_pb))        # HR11-12
             write_payload.extend(float_to_registers(pid_ti))        # HR13-14
             write_payload.extend(float_to_registers(pid_td))        # HR15-16
+            write_payload.append(pv_quality)                        # HR17
 
             wr = client.write_registers(0, write_payload, unit=1)
             if wr.isError():
                 logger.error(f"Write Error: {wr}")
+                metrics.registry.inc("gateway_modbus_errors_total", help="Modbus read/write errors", op="write")
+            else:
+                last_payload = write_payload
 
             # --- 2) READ PLC -> GW : HR100..HR120 (21 regs) ---
             rr = client.read_holding_registers(100, 21, unit=1)  # HR100-HR120
@@ -190,6 +258,8 @@ def modbus_loop():
                         logger.error(f"Flush-reset write error: {fw}")
                     else:
                         logger.info("Flush-reset write sent to PLC (tune_cmd=0).")
+                    # The PV fast path must build on this block, never on the old seq
+                    last_payload = flush_payload
 
                 elif not tune_done_latch:
                     # Only update DB from raw PLC value when latch is not active
@@ -204,17 +274,34 @@ def modbus_loop():
                 
             else:
                 logger.error(f"Read Error (HR100..110): {rr}")
-                
-            # Update loop speed
-            time.sleep(config.MODBUS_UPDATE_INTERVAL)
+                metrics.registry.inc("gateway_modbus_errors_total", help="Modbus read/write errors", op="read")
+
+            metrics.registry.observe("gateway_modbus_cycle_seconds", time.perf_counter() - cycle_t0,
+                                     help="Modbus write+read cycle duration")
+            metrics.registry.maybe_flush(db)
+
+            # Update loop speed; wake up early for every new PV from service_sensor
+            deadline = time.monotonic() + config.MODBUS_UPDATE_INTERVAL
+            if pv_rx is None:
+                time.sleep(config.MODBUS_UPDATE_INTERVAL)
+            while pv_rx is not None:
+                msg = pv_rx.wait(deadline - time.monotonic())
+                if msg is None:
+                    break
+                pushed = msg
+                if last_payload is not None:
+                    last_payload = write_pushed_pv(client, last_payload, msg) or last_payload
 
         except Exception as e:
             logger.error(f"Main loop error: {e}")
+            metrics.registry.inc("gateway_modbus_errors_total", help="Modbus read/write errors", op="loop")
             client.close()
+            last_payload = None
             time.sleep(1)
 
 def main():
     logger.info("Starting Modbus TCP Client Service...")
+    metrics.init("modbus")
     modbus_loop()
 
 if __name__ == "__main__":
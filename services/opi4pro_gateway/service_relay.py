@@ -1,56 +1,292 @@
 # relay_service.py
-# Polls ESP32 and syncs state with SQLite
+# Owns the ESP32 links: applies queued relay orders and polls status.
+#
+# No other process talks to the ESP32s. Orders are written to the "relay_cmd"
+# state key ({"seq", "on", "ts"}, see service_web.submit_relay). The key is a
+# last-writer-wins register, so orders that arrive while a request is in
+# flight collapse into the newest one. Applied orders are acknowledged in
+# "relay_ack_seq". Each board in config.RELAY_DEVICES has its own keys (see
+# relays.py) and its own controller.
+#
+# One asyncio loop runs the command and status tasks of every board. Requests
+# to one board go through its lock, so a command and a poll never overlap on
+# the chip; across boards at most RELAY_POLL_CONCURRENCY requests are in
+# flight, so an offline board's timeouts don't delay the others. SQLite is
+# only touched from a single "relay-db" thread, never on the loop itself.
+#
+# The command task sleeps until service_web's wake-up datagram for its board
+# (relays.notify), a status poll that needs a re-command, the end of a retry
+# backoff, or the RELAY_CMD_RECHECK fallback.
+#
+# Polling is adaptive: fast right after an order until the relay reports the
+# desired state, a slow keepalive at steady state, and exponential backoff
+# (polls and command retries alike) while the ESP32 is unreachable.
 
+import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 from database import db
 import esp32_client
 import config
+import metrics
+import relays
 
-def main():
-    print("🔁 Starting Relay Keepalive Service...")
-    
-    last_sync_time = 0  # Track last time we synced to avoid rapid re-commands
-    MIN_SYNC_INTERVAL = 0.5  # Minimum time between sync attempts (seconds)
-    
-    while True:
+MIN_SYNC_INTERVAL = 0.5  # Minimum time between re-commands for a drifted relay (seconds)
+
+# Enqueue -> ESP32 ack latency
+CMD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RelayController:
+    """
+    Args:
+        db (GatewayDB): State table.
+        device_id (str): Board in config.RELAY_DEVICES (default board if None).
+        gate (asyncio.Semaphore): Shared in-flight request limit (RelayFleet).
+        executor (Executor): Threads for the blocking ESP32 requests.
+        db_executor (Executor): Single thread for the blocking SQLite calls.
+    """
+
+    def __init__(self, db, device_id=None, gate=None, executor=None, db_executor=None):
+        self.db = db
+        self.device_id = device_id or config.RELAY_DEFAULT_DEVICE
+        self.client = esp32_client.client(self.device_id)
+        self.gate = gate
+        self.executor = executor
+        self.db_executor = db_executor
+        self.link = None     # asyncio.Lock, created inside the running loop
+        self.acked = int(db.get_state(self.key("ack_seq"), 0) or 0)
+        self.order = (self.acked, False, None)  # newest order read by the command task
+        self.actual = None   # last relay state reported by the ESP32
+        self.last_sync = 0.0
+        self.kick = None     # asyncio.Event: an order was sent, poll fast now
+        self.wake = None     # asyncio.Event: new order / re-command needed
+        self.failures = 0    # consecutive failed ESP32 requests
+        self.retry_at = 0.0  # no command retries before this (monotonic)
+        self.fast_until = 0.0
+
+    def key(self, field):
+        return relays.key(self.device_id, field)
+
+    def desired(self):
+        """
+        Newest order.
+
+        Returns:
+            tuple: (seq, on, ts). Without a queued order, the legacy
+                   relay_desired flag is used and never counts as pending.
+        """
+        cmd = self.db.get_state(self.key("cmd"))
+        if isinstance(cmd, dict):
+            return int(cmd.get("seq", 0)), bool(cmd.get("on")), cmd.get("ts")
         try:
-            # 1. Poll Status (Keepalive)
-            status = esp32_client.get_status()
-            
-            if status:
-                db.set_state("esp32_connected", True)
-                db.set_state("esp32_last_seen", time.time())
-                db.set_state("relay_actual", status.get("relay", False))
-                
-                # 2. Consistency Check - with debouncing to prevent rapid re-commands
-                val_raw = db.get_state("relay_desired", 0)
-                try:
-                    desired = int(val_raw) == 1
-                except (ValueError, TypeError):
-                    desired = False
-
-                actual = bool(status.get("relay", False))
-                
-                print(f"[DEBUG] Raw: {val_raw} | Desired: {desired} | Actual: {actual}")
-
-                # Only attempt to sync if states differ AND enough time has passed
-                current_time = time.time()
-                if desired != actual:
-                    if current_time - last_sync_time >= MIN_SYNC_INTERVAL:
-                        print(f"⚠️ State Mismatch! Desired: {desired}, Actual: {actual}. Resending command...")
-                        esp32_client.set_relay(desired)
-                        last_sync_time = current_time
-                    else:
-                        print(f"⏳ State mismatch detected, but debouncing sync (waited {current_time - last_sync_time:.1f}s)")
-            
-            else:
-                db.set_state("esp32_connected", False)
-        
-        except Exception as e:
-            print(f"❌ Relay Service Error: {e}")
-            db.set_state("esp32_connected", False)
-        
-        time.sleep(config.RELAY_POLL_INTERVAL)
+            on = int(self.db.get_state(self.key("desired"), 0)) == 1
+        except (ValueError, TypeError):
+            on = False
+        return self.acked, on, None
+
+    async def request(self, fn, *args):
+        # esp32_client is blocking (requests); run it off the loop, one at a
+        # time per board and within the fleet-wide limit
+        async with self.link, self.gate:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def store(self, fn, *args):
+        """Run a blocking DB call on the relay-db thread."""
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, fn, *args)
+
+    def backoff(self):
+        """1, 2, 4 ... s after consecutive failures, capped at RELAY_POLL_BACKOFF_MAX."""
+        return min(config.RELAY_POLL_BACKOFF_MAX,
+                   config.RELAY_POLL_BACKOFF_MIN * 2 ** max(0, self.failures - 1))
+
+    async def _failed(self):
+        self.failures += 1
+        self.retry_at = time.monotonic() + self.backoff()
+        await self.store(self.db.set_state, self.key("connected"), False)
+
+    def _write_seen(self, actual, last_seen):
+        self.db.set_state(self.key("connected"), True)
+        self.db.set_state(self.key("last_seen"), last_seen)
+        self.db.set_state(self.key("actual"), actual)
+
+    async def _seen(self, relay):
+        self.failures = 0
+        self.retry_at = 0.0
+        self.actual = bool(relay)
+        await self.store(self._write_seen, self.actual, time.time())
+
+    async def poll_status(self):
+        t0 = time.perf_counter()
+        status = await self.request(self.client.get_status)
+        metrics.registry.observe("gateway_relay_poll_seconds", time.perf_counter() - t0,
+                                 help="ESP32 status poll round-trip time",
+                                 result="ok" if status else "fail", device=self.device_id)
+        if status:
+            await self._seen(status.get("relay", False))
+        else:
+            await self._failed()
+        return status
+
+    def needs_command(self):
+        """Newest order not acknowledged yet, or the relay drifted from it."""
+        seq, on, _ = self.order
+        return seq > self.acked or (self.actual is not None and self.actual != on)
+
+    def poll_delay(self, status):
+        """Seconds until the next status poll."""
+        if not status:
+            return self.backoff()
+        seq, on, _ = self.order
+        if self.actual == on and seq <= self.acked:
+            self.fast_until = 0.0   # converged
+        if time.monotonic() < self.fast_until:
+            return config.RELAY_POLL_FAST
+        return config.RELAY_POLL_KEEPALIVE
+
+    async def apply(self):
+        """Send the newest order if it is not acknowledged yet or the relay drifted from it."""
+        seq, on, ts = self.order
+        pending = seq > self.acked
+        if (pending or self.actual != on) and time.monotonic() < self.retry_at:
+            return   # ESP32 unreachable: wait for the backoff (or a good poll)
+        if not pending:
+            if self.actual is None or self.actual == on:
+                return
+            # Consistency check, debounced so a slow ESP32 is not hammered
+            if time.monotonic() - self.last_sync < MIN_SYNC_INTERVAL:
+                return
+            print(f"⚠️ [{self.device_id}] State Mismatch! Desired: {on}, Actual: {self.actual}. Resending command...")
+
+        self.last_sync = time.monotonic()
+        self.fast_until = self.last_sync + config.RELAY_FAST_WINDOW
+        self.kick.set()
+        result = await self.request(self.client.set_relay, on)
+        if not (result and result.get("success")):
+            await self._failed()
+            return
+
+        await self._seen(result.get("relay", on))
+        if pending:
+            if seq > self.acked + 1:
+                metrics.registry.inc("gateway_relay_cmd_coalesced_total", seq - self.acked - 1,
+                                     help="Relay orders superseded before they were sent",
+                                     device=self.device_id)
+            self.acked = seq
+            await self.store(self.db.set_state, self.key("ack_seq"), seq)
+            if ts:
+                metrics.registry.observe("gateway_relay_cmd_seconds", max(0.0, time.time() - ts),
+                                         help="Relay order enqueue to ESP32 ack", buckets=CMD_BUCKETS,
+                                         device=self.device_id)
+            print(f"Relay [{self.device_id}] order #{seq} applied: {'ON' if on else 'OFF'}")
+
+    def command_delay(self):
+        """Seconds until apply() runs again if nothing wakes the command task."""
+        if not self.needs_command():
+            return config.RELAY_CMD_RECHECK
+        # Waiting out a backoff or the re-command debounce
+        now = time.monotonic()
+        return min(config.RELAY_CMD_RECHECK,
+                   max(0.05, self.retry_at - now, self.last_sync + MIN_SYNC_INTERVAL - now))
+
+    async def command_loop(self):
+        while True:
+            # Cleared before the read, so an order queued meanwhile wakes us again
+            self.wake.clear()
+            try:
+                self.order = await self.store(self.desired)
+                await self.apply()
+            except Exception as e:
+                print(f"❌ Relay [{self.device_id}] command error: {e}")
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.command_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    async def status_loop(self):
+        while True:
+            status = None
+            try:
+                status = await self.poll_status()
+            except Exception as e:
+                print(f"❌ Relay [{self.device_id}] Service Error: {e}")
+                await self._failed()
+            if status and self.needs_command():
+                self.wake.set()   # drifted, or back online with an order queued
+
+            delay = self.poll_delay(status)
+            metrics.registry.set("gateway_relay_poll_interval_seconds", delay,
+                                 help="Current ESP32 status poll interval", device=self.device_id)
+            await self.store(metrics.registry.maybe_flush, self.db)
+
+            # Sleep until the next poll, or until an order is sent
+            self.kick.clear()
+            try:
+                await asyncio.wait_for(self.kick.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        self.link = asyncio.Lock()
+        self.kick = asyncio.Event()
+        self.wake = asyncio.Event()
+        if self.gate is None:
+            self.gate = asyncio.Semaphore(1)
+        if self.db_executor is None:
+            self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="relay-db")
+        await asyncio.gather(self.command_loop(), self.status_loop())
+
+
+class RelayFleet:
+    """Controllers for every board, sharing one loop, the in-flight limit and the DB thread."""
+
+    def __init__(self, db, device_ids=None, concurrency=None):
+        self.concurrency = concurrency or config.RELAY_POLL_CONCURRENCY
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="esp32")
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="relay-db")
+        self.controllers = [RelayController(db, device_id, executor=self.executor,
+                                            db_executor=self.db_executor)
+                            for device_id in (device_ids or relays.device_ids())]
+        self.by_id = {c.device_id: c for c in self.controllers}
+        self.sock = None
+
+    def _on_wake(self):
+        # Drain every queued datagram; each names the board with a new order
+        while True:
+            try:
+                data = self.sock.recv(256)
+            except BlockingIOError:
+                return
+            controller = self.by_id.get(data.decode(errors="replace"))
+            if controller is not None and controller.wake is not None:
+                controller.wake.set()
+
+    async def run(self):
+        gate = asyncio.Semaphore(self.concurrency)
+        for controller in self.controllers:
+            controller.gate = gate
+        try:
+            self.sock = relays.wake_socket()
+            asyncio.get_running_loop().add_reader(self.sock, self._on_wake)
+        except OSError as e:
+            print(f"⚠️ Relay wake socket unavailable, re-checking orders every "
+                  f"{config.RELAY_CMD_RECHECK}s: {e}")
+        try:
+            await asyncio.gather(*(controller.run() for controller in self.controllers))
+        finally:
+            if self.sock is not None:
+                asyncio.get_running_loop().remove_reader(self.sock)
+                self.sock.close()
+
+
+def main():
+    print("🔁 Starting Relay Controller Service...")
+    metrics.init("relay")
+    fleet = RelayFleet(db)
+    for controller in fleet.controllers:
+        print(f"  relay board '{controller.device_id}' at {controller.client.ip}")
+    asyncio.run(fleet.run())
 
 if __name__ == "__main__":
     main()
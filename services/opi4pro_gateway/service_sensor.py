@@ -1,16 +1,27 @@
 # temp_reading.py
-# Sensor loop for MAX31865, logs PV and MV to SQLite
+# Sensor loop for MAX31865 (RTD) + MAX31855 (thermocouple) on SPI3, logs PV and MV to SQLite.
+# Both chips are time-slotted by scheduler.SensorScheduler; "pv" is the selected
+# source (state "pv_source": "rtd" or "thermo") and is what goes to the PLC.
 
 import time
 from database import db
-from src.sensors import MAX31865
+from backends import open_backend
+from scheduler import SensorScheduler
+from pvlink import PvSender
+from archive import TrendArchiver
+from kpi import KpiAccumulator
+from filters import RtdPipeline, QUALITY_GOOD, QUALITY_BAD
 import config
+import metrics
 
 PROBE_INTERVAL = 60 # Prune every 60 seconds
+PV_SOURCES = ("rtd", "thermo")
 
-def log_trend_point():
+pv_link = None  # PvSender, set in main()
+
+def log_trend_point(archiver=None, kpis=None, ts_wall=None, ts_mono=None):
     try:
-        rtd = db.get_state("rtd_temp", 0.0)
+        rtd = db.get_state("pv", db.get_state("rtd_temp", 0.0))
         # mv/sp might be None in DB, default to 0.0
         mv = db.get_state("mv", 0.0)
         # Use PLC-confirmed setpoint (HR111-112 echo). Fall back to desired setpoint if not yet written.
@@ -18,42 +29,120 @@ def log_trend_point():
         sp = setpoint_out if setpoint_out is not None else db.get_state("setpoint", 0.0)
 
         # Log to SQLite
-        db.log_trend(pv=rtd, sp=sp, mv=mv)
+        now = time.time() if ts_wall is None else ts_wall
+        db.log_trend(pv=rtd, sp=sp, mv=mv, ts=int(now), ts_wall=now, ts_mono=ts_mono)
+
+        mode = db.get_state("mode", 0)
+
+        # Lab-session archive (new session on mode / label change)
+        if archiver is not None:
+            archiver.append(now, rtd, sp, mv, mode=mode, label=db.get_state("archive_label"))
+
+        # Streaming KPIs (new segment on mode / SP change)
+        if kpis is not None:
+            kpis.update(now, rtd, sp, mv, mode)
         
     except Exception as e:
         print(f"Error logging trend: {e}")
 
+def publish_pv(source, value, quality, faults, t_acq):
+    """Publish the PV if `source` is the selected PV source."""
+    if db.get_state("pv_source", "rtd") != source:
+        return
+    # Push to service_modbus first (HR1-2 within ms), then the state table
+    if pv_link is not None:
+        pv_link.send(None if quality == QUALITY_BAD else value, quality, t_acq)
+    db.set_state("pv_quality", quality)
+    if quality == QUALITY_BAD or value is None:
+        # Sensor fault: keep the last PV, the PLC fails safe on pv_quality
+        print(f"{source} PV invalid, held (fault: {', '.join(faults) or 'none'})")
+        return
+    db.set_state("pv", value)
+    db.set_state("last_update", time.strftime("%Y-%m-%d %H:%M:%S"))
+    db.set_state("last_update_ts", time.time())
+    db.set_state("last_update_mono", t_acq)
+
+def rtd_slot(rtd_sensor, pipeline):
+    """One MAX31865 read; publishes when the oversampling burst is complete."""
+    code = rtd_sensor.read_rtd_code()
+    result = pipeline.feed(code, rtd_sensor.fault)
+    if result is None:
+        return
+    t_acq = time.monotonic()
+    rtd_raw, rtd_temp, quality = result
+    db.set_state("rtd_fault", pipeline.faults)
+    if quality != QUALITY_BAD and rtd_temp is not None:
+        db.set_state("rtd_temp_raw", rtd_raw)
+        db.set_state("rtd_temp", rtd_temp)
+    publish_pv("rtd", rtd_temp, quality, pipeline.faults, t_acq)
+
+def tc_slot(tc_sensor):
+    """One MAX31855 read (thermocouple + cold-junction temperature)."""
+    thermo, internal, fault, open_circuit, short_gnd, short_vcc = tc_sensor.read_temp()
+    t_acq = time.monotonic()
+    faults = [name for name, bit in (("open_circuit", open_circuit), ("short_gnd", short_gnd),
+                                     ("short_vcc", short_vcc)) if bit]
+    db.set_state("thermo_fault", faults)
+    if not fault:
+        db.set_state("thermo_temp", thermo)
+        db.set_state("internal_temp", internal)
+    else:
+        for name in faults or ["unknown"]:
+            metrics.registry.inc("gateway_sensor_faults_total", help="Sensor reads with a fault flag set",
+                                 sensor="max31855", fault=name)
+    publish_pv("thermo", thermo, QUALITY_BAD if fault else QUALITY_GOOD, faults, t_acq)
+
 def main():
-    # Use CS pin from config
-    rtd_sensor = MAX31865(cs_pin=config.RTD_CS_PIN)
+    global pv_link
+    metrics.init("sensor")
+    pv_link = PvSender()
+    # Hardware, replay or synthetic (config.SENSOR_BACKEND)
+    rtd_sensor, tc_sensor = open_backend(db)
+    pipeline = RtdPipeline(rtd_sensor)
+    archiver = TrendArchiver(db)
+    kpis = KpiAccumulator(db)
     last_prune = 0
-    
+
+    def housekeeping():
+        nonlocal last_prune
+        # Log PV + MV to trend buffer, stamped with the slot start (fixed-rate grid)
+        log_trend_point(archiver, kpis, ts_wall=hk_slot.due_wall, ts_mono=hk_slot.due_mono)
+
+        # Prune old data periodically
+        now = time.time()
+        if now - last_prune > PROBE_INTERVAL:
+            db.prune_trend(keep_seconds=3600)
+            db.prune_archive(keep_seconds=config.ARCHIVE_KEEP_SECONDS)
+            db.prune_kpi_segments(keep_seconds=config.KPI_KEEP_SECONDS)
+            last_prune = now
+
+        db.set_state("sensor_stats", scheduler.stats())
+        metrics.registry.maybe_flush(db)
+
+    # RTD burst spread over the sample interval, never faster than a conversion
+    rtd_period = max(config.SENSOR_SAMPLE_INTERVAL / pipeline.oversample, rtd_sensor.conversion_time)
+    scheduler = SensorScheduler()
+    scheduler.add("max31865", rtd_period, lambda: rtd_slot(rtd_sensor, pipeline))
+    if tc_sensor is not None:
+        # Offset by half an RTD slot so the two chips do not contend for the bus
+        scheduler.add("max31855", config.TC_SAMPLE_INTERVAL, lambda: tc_slot(tc_sensor),
+                      offset=rtd_period / 2)
+    hk_slot = scheduler.add("housekeeping", config.SENSOR_SAMPLE_INTERVAL, housekeeping,
+                            offset=config.SENSOR_SAMPLE_INTERVAL)
+
     try:
-        while True:
-            # Read sensors
-            rtd_temp = rtd_sensor.read_temperature()
-            
-            # Save to SQLite
-            db.set_state("rtd_temp", rtd_temp)
-            db.set_state("last_update", time.strftime("%Y-%m-%d %H:%M:%S"))
-            db.set_state("last_update_ts", time.time())
-            
-            # Log PV + MV to trend buffer
-            log_trend_point()
-
-            # Prune old data periodically
-            now = time.time()
-            if now - last_prune > PROBE_INTERVAL:
-                db.prune_trend(keep_seconds=3600)
-                last_prune = now
-
-            time.sleep(config.SENSOR_SAMPLE_INTERVAL)
+        scheduler.run_forever()
 
     except KeyboardInterrupt:
         print("Sensor loop stopped.")
 
     finally:
+        kpis.close()
+        archiver.close()
         rtd_sensor.close()
+        if tc_sensor is not None:
+            tc_sensor.close()
+        pv_link.close()
 
 if __name__ == "__main__":
     main()
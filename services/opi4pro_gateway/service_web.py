@@ -1,12 +1,24 @@
 # service_web.py
-from flask import Flask, jsonify, request, send_from_directory
-from database import db
+from flask import Flask, Response, g, jsonify, request, send_from_directory
+from database import db, StateCache
+from admission import RateLimiter, CommandCoalescer, retry_after_header
+from jobs import JobRunner
+import archive
+import analysis
+from identify import FopdtIdentifier
+import simulate
+import metrics
+import relays
 import time
 import os
-import esp32_client
-import config
-import wiringpi
+import json
+import functools
 import threading
+import config
+try:
+    import wiringpi
+except ImportError:  # Off-target (no GPIO): light control is state-only
+    wiringpi = None
 import requests
 import smtplib
 from email.mime.text import MIMEText
@@ -45,6 +57,7 @@ def apply_boot_defaults(db):
     db.set_state("setpoint", 0.0)    # ensure safe start
 
 app = Flask(__name__)
+metrics.init("web")
 
 # ---- Worker-secret guard -----------------------------------------------
 # All state-changing (POST) endpoints require the X-Worker-Secret header.
@@ -64,6 +77,24 @@ def require_worker_secret():
         return jsonify({"error": "Forbidden: invalid or missing worker secret"}), 403
 # ------------------------------------------------------------------------
 
+# ---- Request latency metrics -------------------------------------------
+@app.before_request
+def start_request_timer():
+    g.request_t0 = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    t0 = g.pop("request_t0", None)
+    if t0 is not None:
+        # Label by URL rule (not raw path) to keep label cardinality bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.registry.observe(
+            "gateway_http_request_seconds", time.perf_counter() - t0,
+            help="HTTP request latency per route",
+            route=route, method=request.method, status=str(response.status_code))
+    return response
+# ------------------------------------------------------------------------
+
 # Apply defaults once per boot (prevents “last saved Tune/Web/Light” problem)
 apply_boot_defaults(db)
 
@@ -71,11 +102,61 @@ apply_boot_defaults(db)
 if db.get_state("plc_status") is None:
     db.set_state("plc_status", 0)
 
+# In-memory state cache: GET routes read from here instead of hitting SQLite.
+# Writes go through to the DB (see StateCache.set). Its reader thread starts
+# on first use in the serving process, not at import (main.py forks us).
+state = StateCache(db)
+
+# ---- Command admission control -----------------------------------------
+# Per-client + global token buckets on POST command routes, and
+# last-value-wins coalescing of slider-style writes (setpoint, MV, PID).
+limiter = RateLimiter(
+    client_rate=config.COMMAND_RATE_PER_CLIENT,
+    client_burst=config.COMMAND_BURST_PER_CLIENT,
+    global_rate=config.COMMAND_RATE_GLOBAL,
+    global_burst=config.COMMAND_BURST_GLOBAL,
+)
+commands = CommandCoalescer(state)
+
+# Background jobs (soft shutdown / power-cycle) run one at a time here,
+# so request threads never sleep and power orders never overlap.
+jobs = JobRunner()
+
+def worker_authenticated():
+    """True if the request carries the configured worker secret."""
+    return bool(GATEWAY_SECRET) and request.headers.get("X-Worker-Secret", "") == GATEWAY_SECRET
+
+def client_id():
+    # The Worker forwards the logged-in user. Only trust that header from the
+    # Worker itself, or anyone could rotate it for a fresh token bucket.
+    if worker_authenticated() and request.headers.get("X-Client-Id"):
+        return request.headers["X-Client-Id"]
+    return (request.headers.get("CF-Connecting-IP")
+            or request.remote_addr
+            or "unknown")
+
+def admission_controlled(fn):
+    """Reject with 429 + Retry-After when the client or global budget is spent."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        wait = limiter.check(client_id())
+        if wait:
+            metrics.registry.inc("gateway_http_throttled_total",
+                                 help="Command requests rejected by admission control",
+                                 route=request.url_rule.rule)
+            return jsonify({"error": "Too many requests", "retry_after": round(wait, 2)}), 429, \
+                {"Retry-After": retry_after_header(wait)}
+        return fn(*args, **kwargs)
+    return wrapper
+# ------------------------------------------------------------------------
+
 # ---------------- GPIO Setup ----------------
 # Using wiringpi for Orange Pi 4 Pro GPIO control
 # wPi pin mapping: Physical pin 18 (PL2) maps to wPi pin 10
 # wPi pin mapping: Physical pin 18 (PL2) maps to wPi pin 10
 try:
+    if wiringpi is None:
+        raise RuntimeError("wiringpi not installed")
     wiringpi.wiringPiSetup()
     wiringpi.pinMode(config.LIGHT_PIN, wiringpi.OUTPUT)
 
@@ -110,7 +191,7 @@ def heartbeat():
     current_time = time.time()
     
     # Sensor health check
-    last_update_ts = db.get_state("last_update_ts")
+    last_update_ts = state.get("last_update_ts")
     sensor_age_sec = None
     sensor_ok = False
     
@@ -119,7 +200,7 @@ def heartbeat():
         sensor_ok = sensor_age_sec <= 5.0  # 2s sampling, 5s is reasonable threshold
     
     # Modbus health check
-    modbus_last_tick_ts = db.get_state("modbus_last_tick_ts")
+    modbus_last_tick_ts = state.get("modbus_last_tick_ts")
     modbus_age_sec = None
     modbus_ok = False
     
@@ -130,10 +211,10 @@ def heartbeat():
     return jsonify({
         "status": "alive",
         "timestamp": current_time,
-        "light": db.get_state("light", 0),
-        "plc": db.get_state("plc_status", 0),
-        "mode": db.get_state("mode", 0),
-        "last_update": db.get_state("last_update"),
+        "light": state.get("light", 0),
+        "plc": state.get("plc_status", 0),
+        "mode": state.get("mode", 0),
+        "last_update": state.get("last_update"),
         "sensor_age_sec": sensor_age_sec,
         "sensor_ok": sensor_ok,
         "modbus_age_sec": modbus_age_sec,
@@ -141,51 +222,71 @@ def heartbeat():
     }), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus text exposition: this process's live registry plus the
+    snapshots flushed by the sensor / modbus / relay services.
+    """
+    snapshots = [metrics.registry.snapshot()]
+    for key, snap in state.snapshot().items():
+        if key.startswith(metrics.STATE_KEY_PREFIX) and isinstance(snap, dict) \
+                and snap.get("service") != metrics.registry.service:
+            snapshots.append(snap)
+    return Response(metrics.render(snapshots), mimetype="text/plain; version=0.0.4")
+
+
 # =========================================================
 # ---------------- Light / Web / PLC Control --------------
 # =========================================================
 @app.route('/light/on', methods=['POST'])
+@admission_controlled
 def turn_light_on():
     if GPIO_AVAILABLE:
         wiringpi.digitalWrite(config.LIGHT_PIN, 1)
-    db.set_state("light", 1)
+    state.set("light", 1)
     return jsonify({"light": 1}), 200
 
 @app.route('/light/off', methods=['POST'])
+@admission_controlled
 def turn_light_off():
     if GPIO_AVAILABLE:
         wiringpi.digitalWrite(config.LIGHT_PIN, 0)
-    db.set_state("light", 0)
+    state.set("light", 0)
     return jsonify({"light": 0}), 200
 
 @app.route('/web/on', methods=['POST'])
+@admission_controlled
 def web_start():
-    db.set_state("web", 1)
+    state.set("web", 1)
     return jsonify({"web": 1, "status": "pending"}), 200
 
 @app.route('/web/off', methods=['POST'])
+@admission_controlled
 def web_stop():
-    db.set_state("web", 0)
+    state.set("web", 0)
     return jsonify({"web": 0, "status": "pending"}), 200
 
 @app.route('/web_ack', methods=['GET'])
 def web_ack_status():
     """Return whether the latest Web Control update has been acknowledged by PLC."""
     try:
-        acknowledged = db.get_state("modbus_plc_synced", False)
+        acknowledged = state.get("modbus_plc_synced", False)
         return jsonify({"acknowledged": acknowledged}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/plc/on', methods=['POST'])
+@admission_controlled
 def plc_on():
-    db.set_state("plc_status", 1)
+    state.set("plc_status", 1)
     return jsonify({"plc": 1}), 200
 
 
 @app.route('/plc/off', methods=['POST'])
+@admission_controlled
 def plc_off():
-    db.set_state("plc_status", 0)
+    state.set("plc_status", 0)
     return jsonify({"plc": 0}), 200
 
 
@@ -193,35 +294,38 @@ def plc_off():
 # ---------------- Mode Control ---------------------------
 # =========================================================
 @app.route('/mode/manual', methods=['POST'])
+@admission_controlled
 def mode_manual():
     # Transitioning to Manual always stops the PLC Control (Start/Stop) for safety
-    db.set_state("plc_status", 0)
-    db.set_state("tune_status", 0)
-    db.set_state("mode", 0)
+    state.set("plc_status", 0)
+    state.set("tune_status", 0)
+    state.set("mode", 0)
     return jsonify({"mode": 0}), 200
 
 @app.route('/mode/auto', methods=['POST'])
+@admission_controlled
 def mode_auto():
-    old_mode = db.get_state("mode", 0)
+    old_mode = state.get("mode", 0)
     # If coming from Manual (0), reset PLC control state
     if old_mode == 0:
-        db.set_state("plc_status", 0)
-        db.set_state("tune_status", 0)
+        state.set("plc_status", 0)
+        state.set("tune_status", 0)
     
     # If coming from Tune (2), we preserve 'plc_status' state
-    db.set_state("mode", 1)
+    state.set("mode", 1)
     return jsonify({"mode": 1}), 200
 
 @app.route('/mode/tune', methods=['POST'])
+@admission_controlled
 def mode_tune():
-    old_mode = db.get_state("mode", 0)
+    old_mode = state.get("mode", 0)
     # If coming from Manual (0), reset PLC control state
     if old_mode == 0:
-        db.set_state("plc_status", 0)
-        db.set_state("tune_status", 0)
+        state.set("plc_status", 0)
+        state.set("tune_status", 0)
         
     # If coming from Auto (1), we preserve 'plc_status' state
-    db.set_state("mode", 2)
+    state.set("mode", 2)
     return jsonify({"mode": 2}), 200
 
 # =========================================================
@@ -231,30 +335,30 @@ def mode_tune():
 @app.route('/control_status', methods=['GET'])
 def get_control_status():
     # Check PLC Heartbeat
-    plc_last = db.get_state("modbus_plc_last_seen", 0)
+    plc_last = state.get("modbus_plc_last_seen", 0)
     plc_alive = (time.time() - plc_last) < config.PLC_HEARTBEAT_TIMEOUT
     
     # Only report Synced if PLC is actually Alive
-    is_synced = plc_alive and db.get_state("modbus_plc_synced", False)
+    is_synced = plc_alive and state.get("modbus_plc_synced", False)
 
     return jsonify({
-        "light": db.get_state("light"),
-        "plc": db.get_state("plc_status"),
+        "light": state.get("light"),
+        "plc": state.get("plc_status"),
         # Use acknowledged state for Web, but fallback to 0 if missing.
-        "web": 1 if is_synced and db.get_state("web", 0) == 1 else 0,
+        "web": 1 if is_synced and state.get("web", 0) == 1 else 0,
         "web_ack": is_synced, # ✅ Derived from Sync Status
         "mv_ack": is_synced, # ✅ Derived from Sync Status
         "plc_ack": is_synced, # ✅ Derived from Sync Status
-        "mv": db.get_state("mv", 0.0), # ✅ Real MV from PLC (HR102-103)
-        "setpoint_out": db.get_state("setpoint_out", 0.0), # ✅ PLC confirmed setpoint (HR111-112)
-        "pid_pb_out": db.get_state("pid_pb_out", 0.0), # ✅ PLC confirmed PB
-        "pid_ti_out": db.get_state("pid_ti_out", 0.0), # ✅ PLC confirmed Ti
-        "pid_td_out": db.get_state("pid_td_out", 0.0), # ✅ PLC confirmed Td
-        "pid_pb_at": db.get_state("pid_pb_at", 0.0), # ✅ Tuned PB
-        "pid_ti_at": db.get_state("pid_ti_at", 0.0), # ✅ Tuned Ti
-        "pid_td_at": db.get_state("pid_td_at", 0.0), # ✅ Tuned Td
-        "mode": db.get_state("mode"),
-        "web_desired": db.get_state("web", 0), # For debug/advanced UI
+        "mv": state.get("mv", 0.0), # ✅ Real MV from PLC (HR102-103)
+        "setpoint_out": state.get("setpoint_out", 0.0), # ✅ PLC confirmed setpoint (HR111-112)
+        "pid_pb_out": state.get("pid_pb_out", 0.0), # ✅ PLC confirmed PB
+        "pid_ti_out": state.get("pid_ti_out", 0.0), # ✅ PLC confirmed Ti
+        "pid_td_out": state.get("pid_td_out", 0.0), # ✅ PLC confirmed Td
+        "pid_pb_at": state.get("pid_pb_at", 0.0), # ✅ Tuned PB
+        "pid_ti_at": state.get("pid_ti_at", 0.0), # ✅ Tuned Ti
+        "pid_td_at": state.get("pid_td_at", 0.0), # ✅ Tuned Td
+        "mode": state.get("mode"),
+        "web_desired": state.get("web", 0), # For debug/advanced UI
         "plc_alive": plc_alive, # ✅ PLC Heartbeat Status
         "plc_last_seen": plc_last
     })
@@ -265,12 +369,48 @@ def get_control_status():
 def get_temperature():
     """Return both temperatures + control states"""
     return jsonify({
-        "rtd_temp": db.get_state("rtd_temp"),
-        "last_update": db.get_state("last_update"),
+        "rtd_temp": state.get("rtd_temp"),
+        "rtd_temp_raw": state.get("rtd_temp_raw"),
+        "thermo_temp": state.get("thermo_temp"),
+        "internal_temp": state.get("internal_temp"),
+        "pv": state.get("pv", state.get("rtd_temp")),
+        "pv_source": state.get("pv_source", "rtd"),
+        "pv_quality": state.get("pv_quality"),
+        "rtd_fault": state.get("rtd_fault"),
+        "thermo_fault": state.get("thermo_fault"),
+        "last_update": state.get("last_update"),
         # "light": db.get_state("light"),
         # "plc": db.get_state("plc"),
     })
 
+# ---------------- Sensors / PV Source ----------------
+@app.route('/sensors', methods=['GET'])
+def get_sensors():
+    """Per-device values, faults and read latency stats (SPI3 scheduler)."""
+    return jsonify({
+        "pv_source": state.get("pv_source", "rtd"),
+        "pv": state.get("pv", state.get("rtd_temp")),
+        "pv_quality": state.get("pv_quality"),
+        "rtd": {"temp": state.get("rtd_temp"), "raw": state.get("rtd_temp_raw"),
+                "fault": state.get("rtd_fault")},
+        "thermo": {"temp": state.get("thermo_temp"), "internal": state.get("internal_temp"),
+                   "fault": state.get("thermo_fault")},
+        "stats": state.get("sensor_stats", {}),
+    })
+
+@app.route('/pv_source', methods=['POST'])
+@admission_controlled
+def set_pv_source():
+    """Switch the PV sent to the PLC between the RTD and the thermocouple."""
+    req = request.get_json(silent=True) or {}
+    source = req.get("source")
+    if source not in ("rtd", "thermo"):
+        return jsonify({"error": "source must be 'rtd' or 'thermo'"}), 400
+    if source == "thermo" and (state.get("thermo_temp") is None or state.get("thermo_fault")):
+        return jsonify({"error": "Thermocouple not available"}), 409
+    state.set("pv_source", source)
+    return jsonify({"pv_source": source}), 200
+
 # ---------------- Trend Buffer ----------------
 @app.route('/trend', methods=['GET'])
 def get_trend_data():
@@ -279,10 +419,199 @@ def get_trend_data():
     trend_data = db.get_recent_trend(limit=limit)
     return jsonify(trend_data)
 
+# ---------------- Trend Export ----------------
+EXPORT_CSV_HEADER = "Time,PV(degC),SP(degC),MV(%)\n"  # same columns as docs/trend_data_example.csv
+EXPORT_ROWS_PER_CHUNK = 200
+
+def _export_time(ts):
+    # "7:10:10 AM" like the example CSV
+    return time.strftime("%I:%M:%S %p", time.localtime(ts)).lstrip("0")
+
+def _csv_value(v):
+    return "null" if v is None else repr(float(v))
+
+def _export_lines(rows, fmt):
+    """Turn trend rows into CSV / NDJSON text, grouped into chunks."""
+    if fmt == "csv":
+        yield EXPORT_CSV_HEADER
+    chunk = []
+    for ts, pv, sp, mv in rows:
+        if fmt == "csv":
+            chunk.append(f"{_export_time(ts)},{_csv_value(pv)},{_csv_value(sp)},{_csv_value(mv)}\n")
+        else:
+            chunk.append(json.dumps({"ts": ts, "time": _export_time(ts), "pv": pv, "sp": sp, "mv": mv}) + "\n")
+        if len(chunk) >= EXPORT_ROWS_PER_CHUNK:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+@app.route('/trend/export', methods=['GET'])
+def export_trend():
+    """
+    Stream trend rows for Lab 4/5 reports.
+    Query: from, to (epoch seconds; default = last hour), format=csv|ndjson.
+    Rows come straight from a SQLite cursor (chunked transfer, flat memory).
+    """
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    end_ts = request.args.get("to", type=float)
+    start_ts = request.args.get("from", type=float)
+    if end_ts is None:
+        end_ts = time.time()
+    if start_ts is None:
+        start_ts = end_ts - 3600
+    if start_ts > end_ts:
+        return jsonify({"error": "'from' must be <= 'to'"}), 400
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    filename = f"trend_{int(start_ts)}_{int(end_ts)}.{fmt}"
+    return Response(
+        _export_lines(db.iter_trend(start_ts, end_ts), fmt),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+# ---------------- Step-Response Analysis ----------------
+step_cache = analysis.ResultCache()
+
+@app.route('/analysis/step', methods=['GET'])
+def analysis_step():
+    """
+    Rise time, overshoot, settling time, steady-state error and IAE/ISE/ITAE
+    for the SP (or MV) step inside [from, to] (epoch seconds; default last 15 min).
+    Cached by window + data generation, so repeated views skip the computation.
+    """
+    end_ts = request.args.get("to", type=float)
+    start_ts = request.args.get("from", type=float)
+    band = request.args.get("band", default=analysis.SETTLING_BAND, type=float)
+    if end_ts is None:
+        # Floor "now" to 10 s so repeated views of the live window share a cache key
+        end_ts = float(int(time.time()) // 10 * 10)
+    if start_ts is None:
+        start_ts = end_ts - 900
+    if start_ts >= end_ts:
+        return jsonify({"error": "'from' must be < 'to'"}), 400
+
+    generation = db.trend_generation(start_ts, end_ts)
+    key = (start_ts, end_ts, band, generation)
+    result = step_cache.get(key)
+    if result is None:
+        ts, pv, sp, mv = analysis.trend_arrays(db.iter_trend(start_ts, end_ts))
+        result = analysis.analyze_window(ts, pv, sp, mv, band=band)
+        result.update({"from": start_ts, "to": end_ts})
+        step_cache.put(key, result)
+
+    status = 200 if "error" not in result else 422
+    return jsonify(result), status
+
+# ---------------- FOPDT Identification ----------------
+fopdt = FopdtIdentifier()
+
+@app.route('/analysis/fopdt', methods=['GET'])
+def analysis_fopdt():
+    """
+    First-order-plus-dead-time model (K, tau, theta) fitted to MV-step segments.
+    Only trend rows newer than the last call are fed to the identifier.
+    """
+    with fopdt.lock:
+        start_ts = fopdt.last_ts + 0.5 if fopdt.last_ts is not None else time.time() - 3600
+        fopdt.update_many(db.iter_trend(start_ts, time.time()))
+        result = fopdt.result()
+    if result["model"] is None:
+        return jsonify(dict(result, error="No MV step segment fitted yet")), 200
+    return jsonify(result), 200
+
+# ---------------- PID What-If Simulator ----------------
+@app.route('/simulate/pid', methods=['POST'])
+@admission_controlled
+def simulate_pid():
+    """
+    Simulate a grid of PB/Ti/Td candidates on a FOPDT plant before touching the heater.
+
+    Body: {"model": {"K", "tau", "theta"} (omit to use the /analysis/fopdt fit),
+           "pb": [...], "ti": [...], "td": [...],   # grid (cartesian product)
+           "sp": 50, "pv0": <current PV>, "mv0": 0, "duration": 1200, "dt": 1, "curves": true}
+    """
+    try:
+        req = request.get_json() or {}
+        model = req.get("model")
+        if model is None:
+            with fopdt.lock:
+                model = fopdt.result()["model"]
+            if model is None:
+                return jsonify({"error": "No model given and no FOPDT fit available"}), 400
+
+        pb, ti, td = simulate.candidate_grid(req.get("pb", [state.get("pid_pb", 10.0)]),
+                                             req.get("ti", [state.get("pid_ti", 180.0)]),
+                                             req.get("td", [state.get("pid_td", 0.0)]))
+        pv0 = float(req.get("pv0", state.get("pv", state.get("rtd_temp", 25.0)) or 25.0))
+        t0 = time.perf_counter()
+        result = simulate.evaluate(
+            float(model["K"]), float(model["tau"]), float(model["theta"]),
+            pb, ti, td,
+            sp=float(req.get("sp", state.get("setpoint", 50.0))),
+            pv0=pv0,
+            mv0=float(req.get("mv0", 0.0)),
+            duration=float(req.get("duration", 1200.0)),
+            dt=float(req.get("dt", 1.0)),
+            curves=bool(req.get("curves", True)),
+        )
+        result["elapsed_s"] = round(time.perf_counter() - t0, 4)
+        return jsonify(result), 200
+
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+# ---------------- Control KPIs ----------------
+@app.route('/kpi', methods=['GET'])
+def kpi_segments():
+    """Per-segment IAE/ISE/overshoot/time-in-band/MV travel (computed by service_sensor)."""
+    limit = request.args.get("limit", default=50, type=int)
+    since = request.args.get("from", type=float)
+    return jsonify(db.get_kpi_segments(limit=limit, since_ts=since)), 200
+
+# ---------------- Lab-Session Archive ----------------
+@app.route('/archive/sessions', methods=['GET'])
+def archive_sessions():
+    limit = request.args.get("limit", default=50, type=int)
+    return jsonify(db.get_archive_sessions(limit=limit)), 200
+
+@app.route('/archive/sessions/<int:session_id>', methods=['GET'])
+def archive_session_data(session_id):
+    """Whole session (or from/to slice) as column arrays, read in one index scan."""
+    chunks = db.get_archive_chunks(
+        session_id,
+        start_ts=request.args.get("from", type=float),
+        end_ts=request.args.get("to", type=float)
+    )
+    if not chunks:
+        return jsonify({"error": "Unknown or empty session"}), 404
+    return jsonify(dict(archive.decode_chunks(chunks), session_id=session_id)), 200
+
+@app.route('/archive/label', methods=['POST'])
+@admission_controlled
+def archive_label():
+    """
+    Tag the archive with a booking / group label. Changing the label closes the
+    current archive session and starts a new one (service_sensor).
+    """
+    try:
+        req = request.get_json() or {}
+        label = req.get("label")
+        label = str(label)[:64] if label else None
+        state.set("archive_label", label)
+        return jsonify({"label": label}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
 # =========================================================
 # ---------------- Setpoint Control -----------------------
 # =========================================================
 @app.route('/setpoint', methods=['POST'])
+@admission_controlled
 def update_setpoint():
     """
     Receive setpoint from browser → save to shared_data.
@@ -296,7 +625,7 @@ def update_setpoint():
             sp = 80  # clamp max 80°C
 
         # Update shared memory
-        db.set_state("setpoint", sp)
+        commands.submit("setpoint", sp)
         
         return jsonify({
             "status": "pending",
@@ -310,7 +639,7 @@ def update_setpoint():
 def setpoint_status():
     """Return whether the latest setpoint update has been acknowledged by PLC."""
     try:
-        acknowledged = db.get_state("modbus_plc_synced", False)
+        acknowledged = state.get("modbus_plc_synced", False)
         return jsonify({"acknowledged": acknowledged}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -318,12 +647,13 @@ def setpoint_status():
 
 @app.route('/setpoint_status', methods=['GET'])
 def get_setpoint():
-    return jsonify({"setpoint": db.get_state("setpoint", 0.0)})
+    return jsonify({"setpoint": state.get("setpoint", 0.0)})
 
 # =========================================================
 # ---------------- MV Manual Control ----------------------
 # =========================================================
 @app.route('/mv_manual', methods=['POST'])
+@admission_controlled
 def set_mv_manual():
     try:
         body = request.get_json()
@@ -332,7 +662,7 @@ def set_mv_manual():
         if mv_value > 100: mv_value = 100
 
         # Save MV
-        db.set_state("mv_manual", mv_value)
+        commands.submit("mv_manual", mv_value)
 
         return jsonify({
             "status": "pending",
@@ -346,19 +676,20 @@ def set_mv_manual():
 def get_mv_manual_ack():
     """Return whether the latest manual MV update has been acknowledged by PLC."""
     try:
-        acknowledged = db.get_state("modbus_plc_synced", False)
+        acknowledged = state.get("modbus_plc_synced", False)
         return jsonify({"acknowledged": acknowledged}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/mv_manual_status', methods=['GET'])
 def get_mv_manual_status():
-    return jsonify({"mv_manual": db.get_state("mv_manual", 0)})
+    return jsonify({"mv_manual": state.get("mv_manual", 0)})
 
 # =========================================================
 # ---------------- PID Control ----------------------------
 # =========================================================
 @app.route('/pid', methods=['POST'])
+@admission_controlled
 def update_pid():
     try:
         req = request.get_json()
@@ -367,9 +698,9 @@ def update_pid():
         td = float(req.get("td"))
 
         # ✅ Save into shared_data with flat keys
-        db.set_state("pid_pb", pb)
-        db.set_state("pid_ti", ti)
-        db.set_state("pid_td", td)
+        commands.submit("pid_pb", pb)
+        commands.submit("pid_ti", ti)
+        commands.submit("pid_td", td)
 
         return jsonify({
             "status": "pending",
@@ -384,16 +715,16 @@ def update_pid():
 @app.route('/pid_params', methods=['GET'])
 def get_pid():
     return jsonify({
-        "pb": db.get_state("pid_pb", 1.0),
-        "ti": db.get_state("pid_ti", 10.0),
-        "td": db.get_state("pid_td", 0.0)
+        "pb": state.get("pid_pb", 1.0),
+        "ti": state.get("pid_ti", 10.0),
+        "td": state.get("pid_td", 0.0)
     })
     
 @app.route('/pid_ack', methods=['GET'])
 def pid_status():
     """Return whether the latest PID update has been acknowledged by PLC."""
     try:
-        acknowledged = db.get_state("modbus_plc_synced", False)
+        acknowledged = state.get("modbus_plc_synced", False)
         return jsonify({"acknowledged": acknowledged}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -404,6 +735,7 @@ def pid_status():
 # but usually it shares the main setpoint logic. 
 # Modifying per user request to use simplified simplified tuning hooks if any.
 @app.route('/tune_setpoint', methods=['POST'])
+@admission_controlled
 def tune_setpoint():
     try:
         req = request.get_json()
@@ -413,7 +745,7 @@ def tune_setpoint():
         if tune_sp < 0: tune_sp = 0
 
         # Updated: Write to main setpoint key
-        db.set_state("setpoint", tune_sp)
+        commands.submit("setpoint", tune_sp)
 
         return jsonify({
             "status": "pending",
@@ -427,23 +759,25 @@ def tune_setpoint():
 def tune_setpoint_ack_status():
     """Return whether the latest tuning setpoint update has been acknowledged by PLC."""
     try:
-        acknowledged = db.get_state("modbus_plc_synced", False)
+        acknowledged = state.get("modbus_plc_synced", False)
         return jsonify({"acknowledged": acknowledged}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route('/tune_start', methods=['POST'])
+@admission_controlled
 def tune_start():
     """Tell PLC to begin tuning."""
-    db.set_state("tune_status", 1)  # 1 = Start Tuning
-    db.set_state("tune_done", False) # Clear done flag
+    state.set("tune_status", 1)  # 1 = Start Tuning
+    state.set("tune_done", False) # Clear done flag
     return jsonify({"status": "pending"}), 200
 
 
 @app.route('/tune_stop', methods=['POST'])
+@admission_controlled
 def tune_stop():
-    db.set_state("tune_status", 0) # 0 = Stop Tuning
+    state.set("tune_status", 0) # 0 = Stop Tuning
     return jsonify({"status": "pending"}), 200
 
 
@@ -451,21 +785,57 @@ def tune_stop():
 def tune_status_route():
     """Frontend polls this to update indicator."""
     return jsonify({
-        "tuning_active": db.get_state("tune_status", 0) == 1,
-        "tune_busy": db.get_state("tune_busy", False),
-        "tune_completed": db.get_state("tune_done", False),
-        "tune_err": db.get_state("tune_err", False)
+        "tuning_active": state.get("tune_status", 0) == 1,
+        "tune_busy": state.get("tune_busy", False),
+        "tune_completed": state.get("tune_done", False),
+        "tune_err": state.get("tune_err", False)
     })
 
 
 # =========================================================
 # ---------------- Relay Control (ESP32) -----------------
 # =========================================================
-
-def soft_shutdown_sequence(restart=False):
+# service_relay owns the ESP32 links; this process only queues orders in the
+# "relay_cmd" register (last writer wins) and reads back "relay_ack_seq".
+# Other relay boards use per-device keys, see relays.py.
+
+relay_lock = threading.Lock()
+
+def submit_relay(on, device_id=None):
+    """Queue a relay order for service_relay. Returns its sequence number."""
+    with relay_lock:
+        # From the DB, not the cache: the cache may not have our last order yet
+        cmd = db.get_state(relays.key(device_id, "cmd")) or {}
+        seq = int(cmd.get("seq", 0)) + 1
+        state.set(relays.key(device_id, "desired"), 1 if on else 0)
+        state.set(relays.key(device_id, "cmd"), {"seq": seq, "on": bool(on), "ts": time.time()})
+    relays.notify(device_id)
+    return seq
+
+def wait_relay_ack(seq, device_id=None, timeout=None, sleep=time.sleep):
+    """
+    Wait until service_relay has applied order `seq` (or a newer one).
+    For background jobs only; request threads answer 202 and clients poll.
+    """
+    deadline = time.monotonic() + (config.RELAY_ACK_TIMEOUT if timeout is None else timeout)
+    while True:
+        if int(state.get(relays.key(device_id, "ack_seq"), 0) or 0) >= seq:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        sleep(config.STATE_CACHE_INTERVAL)
+
+def relay_order(device_id, on):
+    """Queue an order and return at once (202); /relay_status reports it as pending until applied."""
+    seq = submit_relay(on, device_id)
+    return jsonify({"success": True, "pending": True, "relay": on, "seq": seq, "device": device_id}), 202
+
+def soft_shutdown_sequence(job, restart=False):
     """
     Orchestrate soft shutdown of Radxa before cutting power.
     If restart is True, wait and power back on (power-cycle via ESP32 relay).
+    Runs inside the job runner: waits use job.sleep() so the sequence can be
+    cancelled, and power orders never overlap.
 
     NOTE: With the new WiFi RTSP camera, there is no Linux SBC to shut down.
     The shutdown/restart sequence only controls the ESP32 relay (Radxa power).
@@ -483,15 +853,15 @@ def soft_shutdown_sequence(restart=False):
     is_local_bridge = config.RADXA_IP in ("127.0.0.1", "localhost")
     if not is_local_bridge:
         try:
-            print(f"🛑 Sending shutdown command to camera SBC at {camera_url}...")
+            job.progress(f"Sending shutdown command to camera SBC at {camera_url}")
             requests.post(f"{camera_url}/shutdown", auth=camera_auth, timeout=2)
         except Exception as e:
-            print(f"⚠️ Failed to send shutdown command: {e}")
+            job.progress(f"Failed to send shutdown command: {e}")
     else:
-        print("ℹ️  RTSP bridge is local — skipping remote shutdown command.")
+        job.progress("RTSP bridge is local - skipping remote shutdown command")
 
     # 2. Polling for 'Death' (only for remote SBC)
-    print("⏳ Waiting for camera to go offline...")
+    job.progress("Waiting for camera to go offline")
     start_wait = time.time()
     is_down = is_local_bridge  # if local, treat as already 'down' immediately
 
@@ -502,142 +872,188 @@ def soft_shutdown_sequence(restart=False):
                 pass  # still alive
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             # Connection failed -> likely down!
-            print("✅ Radxa appears to be DOWN (Connection Refused/Timeout).")
+            job.progress("Radxa appears to be DOWN (Connection Refused/Timeout)")
             is_down = True
             break
-            
-        time.sleep(2.0)
-        
+
+        job.sleep(2.0)
+
     if not is_down:
-        print("⚠️ Timeout waiting for Radxa shutdown. Proceeding to cut power anyway.")
+        job.progress("Timeout waiting for Radxa shutdown. Proceeding to cut power anyway")
 
     # 3. Final Safety Delay (allow OS to sync disks after network goes down)
-    time.sleep(5.0)
+    job.sleep(5.0)
 
     # 4. Cut Power (ESP32 Relay OFF)
-    print("🔌 Cutting Power to Radxa (ESP32 Relay OFF)...")
-    try:
-        # Update DB State to OFF so relay_service doesn't fight us
-        db.set_state("relay_desired", 0)
-        
-        esp32_client.set_relay(False)
-        db.set_state("relay_actual", False) # Assume success for UI responsiveness
-    except Exception as e:
-        print(f"❌ Failed to cut power: {e}")
-        
+    job.progress("Cutting power to Radxa (ESP32 Relay OFF)")
+    seq = submit_relay(False)
+    if not wait_relay_ack(seq, sleep=job.sleep):
+        job.progress("Relay OFF queued, ESP32 has not confirmed yet")
+
     # 5. Restart Logic (if requested)
     if restart:
-        print("⏳ Waiting 10s before powering ON (Power Cycle)...")
-        time.sleep(10.0)
-        
-        print("⚡ Powering ON Radxa...")
-        try:
-            db.set_state("relay_desired", 1)
-            esp32_client.set_relay(True)
-            db.set_state("relay_actual", True)
-            print("✅ Radxa Power ON command sent.")
-        except Exception as e:
-            print(f"❌ Failed to power on: {e}")
+        job.progress("Waiting 10s before powering ON (Power Cycle)")
+        job.sleep(10.0)
+
+        job.progress("Powering ON Radxa")
+        seq = submit_relay(True)
+        if wait_relay_ack(seq, sleep=job.sleep):
+            job.progress("Radxa Power ON confirmed")
+        else:
+            job.progress("Relay ON queued, ESP32 has not confirmed yet")
+    else:
+        job.progress("Power is OFF")
+
+def submit_power_job(restart):
+    """Queue a shutdown / power-cycle; an identical active order is reused."""
+    kind = "camera_restart" if restart else "soft_shutdown"
+    return jobs.submit(kind, soft_shutdown_sequence, dedup_key=kind, restart=restart)
 
 @app.route('/camera/restart', methods=['POST'])
+@admission_controlled
 def camera_restart():
     """
     Endpoint to trigger full camera repair cycle (Shutdown -> Off -> Wait -> On).
     """
-    threading.Thread(target=soft_shutdown_sequence, kwargs={"restart": True}, daemon=True).start()
+    job, created = submit_power_job(restart=True)
     return jsonify({
-        "status": "restart_initiated",
-        "message": "Camera is restarting. Please wait ~2 minutes."
+        "status": "restart_initiated" if created else "restart_in_progress",
+        "message": "Camera is restarting. Please wait ~2 minutes.",
+        "job_id": job.id
     }), 200
 
+RELAY_TARGET_ERROR = "'on' (or 'relay') must be true/false or 0/1"
+
+def relay_target():
+    """
+    Requested relay state from the JSON body ('on', or legacy 'relay').
+
+    Returns:
+        bool, or None if the field is missing or not a JSON bool / 0 / 1
+        (so "false" never switches a relay ON).
+    """
+    req = request.get_json(silent=True)
+    if not isinstance(req, dict):
+        return None
+    target_state = req.get("on") # true or false
+    if target_state is None:
+        target_state = req.get("relay")
+    if isinstance(target_state, bool):
+        return target_state
+    if type(target_state) is int and target_state in (0, 1):
+        return target_state == 1
+    return None
+
+def rig_power_order(target_state):
+    """Order for this rig's own power relay (the default board)."""
+    # Logic Branch:
+    # IF Turning OFF -> Start Soft Shutdown Sequence (Background)
+    # IF Turning ON -> Immediate Action
+
+    if target_state is False:
+         # Safety Reset
+         state.set("mv_manual", 0.0)
+         state.set("setpoint", 0.0)
+         state.set("web", 0)
+         state.set("plc_status", 0) # Stop PLC operation
+         state.set("tune_status", 0)
+         state.set("mode", 0)  # Revert to Manual Mode
+         state.set("light", 0) # Turn off light
+         if GPIO_AVAILABLE:
+             wiringpi.digitalWrite(config.LIGHT_PIN, 0)
+
+         # Soft Shutdown (queued behind any running power-cycle)
+         print("Initiating Soft Shutdown Sequence...")
+         job, _ = submit_power_job(restart=False)
+
+         # Return "Pending" status to UI - keep relay=1 until it actually turns off?
+         # Or let UI think it's off but hardware lags. 
+         # Better: The user asked for OFF, so we acknowledge OFF request, 
+         # but the actual power cut happens later.
+         # We set 'relay_desired' to 0 in later stage? 
+         # Use a special transient state?
+         # Simple approach: Acknowledge logic receipt. 
+         # Don't update 'relay_desired' yet to prevent `relay_service.py` from cutting power immediately!
+
+         return jsonify({
+             "status": "shutdown_initiated",
+             "message": "Soft shutdown started. Power will cut in ~30s.",
+             "relay": 1, # Report ON for now so UI doesn't look broken if it checks status
+             "job_id": job.id
+         }), 200
+
+    else:
+        # Immediate Turn ON
+        # The latest order wins: drop any pending/running soft shutdown
+        for job in jobs.active(kind="soft_shutdown"):
+            jobs.cancel(job.id)
+
+        # Queue the order; service_relay sends it and acknowledges
+        return relay_order(config.RELAY_DEFAULT_DEVICE, True)
+
 @app.route('/relay', methods=['POST'])
+@admission_controlled
 def relay_control():
     try:
-        req = request.get_json()
-        target_state = req.get("on") # true or false
-        if target_state is None:
-            target_state = req.get("relay")
-        
+        target_state = relay_target()
         if target_state is None:
-             return jsonify({"error": "Missing 'on' or 'relay' field"}), 400
+             return jsonify({"error": RELAY_TARGET_ERROR}), 400
+        return rig_power_order(target_state)
 
-        # Logic Branch:
-        # IF Turning OFF -> Start Soft Shutdown Sequence (Background)
-        # IF Turning ON -> Immediate Action
-        
-        if target_state is False:
-             # Safety Reset
-             db.set_state("mv_manual", 0.0)
-             db.set_state("setpoint", 0.0)
-             db.set_state("web", 0)
-             db.set_state("plc_status", 0) # Stop PLC operation
-             db.set_state("tune_status", 0)
-             db.set_state("mode", 0)  # Revert to Manual Mode
-             db.set_state("light", 0) # Turn off light
-             if GPIO_AVAILABLE:
-                 wiringpi.digitalWrite(config.LIGHT_PIN, 0)
-             
-             # Soft Shutdown
-             print("Initiating Soft Shutdown Sequence...")
-             threading.Thread(target=soft_shutdown_sequence, kwargs={"restart": False}, daemon=True).start()
-             
-             # Return "Pending" status to UI - keep relay=1 until it actually turns off?
-             # Or let UI think it's off but hardware lags. 
-             # Better: The user asked for OFF, so we acknowledge OFF request, 
-             # but the actual power cut happens later.
-             # We set 'relay_desired' to 0 in later stage? 
-             # Use a special transient state?
-             # Simple approach: Acknowledge logic receipt. 
-             # Don't update 'relay_desired' yet to prevent `relay_service.py` from cutting power immediately!
-             
-             return jsonify({
-                 "status": "shutdown_initiated",
-                 "message": "Soft shutdown started. Power will cut in ~30s.",
-                 "relay": 1 # Report ON for now so UI doesn't look broken if it checks status
-             }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        else:
-            # Immediate Turn ON
-            # Update Desired State
-            db.set_state("relay_desired", 1)
-
-            # Send command to ESP32
-            result = esp32_client.set_relay(True)
-            
-            if result and result.get("success"):
-                # OPTIMIZATION: Update cache immediately on success
-                db.set_state("esp32_connected", True)
-                db.set_state("esp32_last_seen", time.time())
-                db.set_state("relay_actual", True)
-                return jsonify(result), 200
-            else:
-                return jsonify({"error": "ESP32 Unavailable"}), 503
+@app.route('/relays/<device_id>', methods=['POST'])
+@admission_controlled
+def relay_device_control(device_id):
+    """Relay order by board ID; the default board gets the same handling as /relay."""
+    if not relays.exists(device_id):
+        return jsonify({"error": f"Unknown relay device '{device_id}'"}), 404
+    try:
+        target_state = relay_target()
+        if target_state is None:
+            return jsonify({"error": RELAY_TARGET_ERROR}), 400
+        if device_id == config.RELAY_DEFAULT_DEVICE:
+            return rig_power_order(target_state)
+        return relay_order(device_id, target_state)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status of a background job (soft shutdown / camera restart)."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@admission_controlled
+def job_cancel(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict()), 200
+
 @app.route('/relay_status', methods=['GET'])
 def relay_status():
     """
     Return cached status from background polling service (relay_service.py).
     Decouples frontend latency from ESP32 network latency.
     """
-    last_seen = db.get_state("esp32_last_seen", 0)
-    now = time.time()
-    age = now - last_seen
-    
-    connected = db.get_state("esp32_connected", False)
-    
-    # If data is too old (>15s), mark as offline/stale even if flag says connected
-    if age > 15:
-        connected = False
-        
-    return jsonify({
-        "alive": connected,
-        "relay": db.get_state("relay_actual") if connected else None, # Return null if stale
-        "last_seen_s": float(f"{age:.1f}"), # seconds since last successful poll
-        "desired": bool(db.get_state("relay_desired", 0))
-    }), 200
+    return jsonify(relays.device_status(state)), 200
+
+@app.route('/relays', methods=['GET'])
+def relay_fleet_status():
+    """Cached status of every relay board (no ESP32 request)."""
+    return jsonify(relays.fleet_status(state)), 200
+
+@app.route('/relays/<device_id>', methods=['GET'])
+def relay_device_status(device_id):
+    if not relays.exists(device_id):
+        return jsonify({"error": f"Unknown relay device '{device_id}'"}), 404
+    return jsonify(relays.device_status(state, device_id)), 200
 
 
 @app.route('/api/reviews', methods=['POST'])
@@ -667,7 +1083,16 @@ def get_reviews():
 
 # ---------------- Main ----------------
 def main():
-    app.run(host=config.FLASK_HOST, port=config.FLASK_PORT)
+    state.start()
+    if config.WEB_SERVER == "waitress":
+        # Production: fixed worker thread pool, so one slow request
+        # (e.g. /trend?limit=3600) no longer stalls the other routes.
+        from waitress import serve
+        print(f"🚀 Starting waitress on {config.FLASK_HOST}:{config.FLASK_PORT} "
+              f"({config.WEB_THREADS} threads)")
+        serve(app, host=config.FLASK_HOST, port=config.FLASK_PORT, threads=config.WEB_THREADS)
+    else:
+        app.run(host=config.FLASK_HOST, port=config.FLASK_PORT, threaded=True)
 
 
 if __name__ == "__main__":
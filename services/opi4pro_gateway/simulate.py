@@ -0,0 +1,135 @@
+# simulate.py
+# Batch closed-loop "what-if" simulation of PID candidates on a FOPDT plant.
+#
+# All candidates are simulated together: the time loop runs once and every
+# per-step operation is a NumPy vector op over the candidate axis, so a few
+# hundred PB/Ti/Td sets cost about as much as one.
+#
+# Controller (Omron PB/Ti/Td form, as used by the NJ PID instruction):
+#     Kc = 100 / PB                       (% MV per °C, see Lab 4: PB = 100 / Kp)
+#     MV = Kc * e + (Kc / Ti) ∫e dt - Kc * Td * dPV/dt     (Ti = 0 -> no integral)
+# Derivative acts on PV (no derivative kick on SP steps), MV is clamped to
+# 0..100 % with conditional-integration anti-windup.
+#
+# Plant (exact zero-order-hold discretization of K e^{-theta s} / (tau s + 1)):
+#     y[k+1] = a * y[k] + K * (1 - a) * (u[k-d] - mv0),   a = exp(-dt / tau)
+
+import itertools
+import math
+
+import numpy as np
+
+import analysis
+
+MAX_CANDIDATES = 2000
+MAX_STEPS = 7200
+CURVE_POINTS = 300   # response curves are downsampled to this many points
+
+
+def fopdt_coeffs(K, tau, dt):
+    """ZOH coefficients (a, gain) of the plant: y[k+1] = a*y[k] + gain*u[k-d]."""
+    a = math.exp(-dt / tau)
+    return a, K * (1.0 - a)
+
+
+def candidate_grid(pb, ti, td):
+    """Cartesian product of PB/Ti/Td lists -> three (N,) arrays."""
+    # Size check before the product, so a huge grid is never built
+    if not all(isinstance(v, (list, tuple)) for v in (pb, ti, td)):
+        raise ValueError("pb, ti and td must be lists")
+    if not 0 < len(pb) * len(ti) * len(td) <= MAX_CANDIDATES:
+        raise ValueError(f"1..{MAX_CANDIDATES} candidates allowed")
+    combos = np.array(list(itertools.product(pb, ti, td)), dtype=float).reshape(-1, 3)
+    return combos[:, 0], combos[:, 1], combos[:, 2]
+
+
+def simulate_pid_batch(K, tau, theta, pb, ti, td, sp, pv0, mv0=0.0, duration=1200.0, dt=1.0):
+    """
+    Simulate N PID candidates against one FOPDT plant for an SP step pv0 -> sp.
+
+    Returns:
+        tuple: (t (T,), pv (N, T), mv (N, T))
+    """
+    pb = np.asarray(pb, dtype=float)
+    ti = np.asarray(ti, dtype=float)
+    td = np.asarray(td, dtype=float)
+    n = pb.size
+    # Everything that sizes the buffers is checked before any allocation
+    if not (math.isfinite(dt) and dt > 0):
+        raise ValueError("dt must be a finite number > 0")
+    if not math.isfinite(duration):
+        raise ValueError("duration must be finite")
+    steps = int(round(duration / dt))
+    if steps < 2 or steps > MAX_STEPS:
+        raise ValueError(f"duration/dt must give 2..{MAX_STEPS} steps")
+    if not (math.isfinite(theta) and 0 <= theta <= duration):
+        raise ValueError("theta must be within 0..duration")
+    if n == 0 or n > MAX_CANDIDATES:
+        raise ValueError(f"1..{MAX_CANDIDATES} candidates allowed")
+    if not (math.isfinite(K) and math.isfinite(tau)) or tau <= 0 or np.any(pb <= 0):
+        raise ValueError("K and tau must be finite, tau and PB > 0")
+
+    a, gain = fopdt_coeffs(K, tau, dt)
+    delay = max(0, int(round(theta / dt)))
+
+    kc = 100.0 / pb
+    ki = np.where(ti > 0, kc * dt / np.where(ti > 0, ti, 1.0), 0.0)
+    kd = kc * td / dt
+
+    y = np.zeros(n)                              # plant state (deviation from pv0)
+    u_hist = np.full((delay + 1, n), mv0)        # ring buffer of applied MV
+    integral = np.full(n, mv0)                   # bumpless start from the operating point
+    pv_prev = np.full(n, pv0)
+
+    pv_out = np.empty((n, steps))
+    mv_out = np.empty((n, steps))
+    for k in range(steps):
+        pv = pv0 + y
+        e = sp - pv
+        p_term = kc * e
+        d_term = -kd * (pv - pv_prev)
+        mv_unsat = p_term + integral + d_term
+        mv = np.clip(mv_unsat, 0.0, 100.0)
+
+        # Anti-windup: integrate only if not saturated in the direction of e
+        windup = ((mv_unsat > 100.0) & (e > 0)) | ((mv_unsat < 0.0) & (e < 0))
+        integral = integral + np.where(windup, 0.0, ki * e)
+
+        pv_out[:, k] = pv
+        mv_out[:, k] = mv
+
+        u_hist[k % (delay + 1)] = mv
+        u_delayed = u_hist[(k - delay) % (delay + 1)] if k >= delay else mv0
+        y = a * y + gain * (u_delayed - mv0)
+        pv_prev = pv
+
+    t = np.arange(steps) * dt
+    return t, pv_out, mv_out
+
+
+def evaluate(K, tau, theta, pb, ti, td, sp, pv0, mv0=0.0, duration=1200.0, dt=1.0,
+             band=analysis.SETTLING_BAND, curves=True):
+    """Simulate a batch and score every candidate. Sorted by IAE (best first)."""
+    t, pv, mv = simulate_pid_batch(K, tau, theta, pb, ti, td, sp, pv0, mv0, duration, dt)
+    kpi = analysis.response_metrics(t, pv, np.full(pv.shape[0], float(sp)),
+                                    y0=np.full(pv.shape[0], float(pv0)), band=band)
+    kpi["mv_travel"] = np.abs(np.diff(mv, axis=-1)).sum(axis=-1)
+    kpi["mv_max"] = mv.max(axis=-1)
+
+    order = np.argsort(np.nan_to_num(kpi["iae"], nan=np.inf))
+    stride = max(1, t.size // CURVE_POINTS)
+
+    results = []
+    for i in order:
+        item = {"pb": float(pb[i]), "ti": float(ti[i]), "td": float(td[i])}
+        item["kpi"] = {k: (None if np.isnan(v[i]) else round(float(v[i]), 4)) for k, v in kpi.items()}
+        if curves:
+            item["pv"] = np.round(pv[i, ::stride], 3).tolist()
+            item["mv"] = np.round(mv[i, ::stride], 2).tolist()
+        results.append(item)
+
+    return {
+        "t": t[::stride].tolist() if curves else None,
+        "model": {"K": K, "tau": tau, "theta": theta},
+        "candidates": results,
+    }
@@ -5,8 +5,11 @@ MAX31855 Thermocouple-to-Digital Converter
 - Platform: Orange Pi 4 Pro (SPI3)
 """
 
-import spidev
-import wiringpi
+try:
+    import spidev
+    import wiringpi
+except ImportError:  # Off-target: only the emulated backends (backends.py) work
+    spidev = wiringpi = None
 
 
 class MAX31855:
@@ -21,6 +24,8 @@ class MAX31855:
     
     def __init__(self, spi_bus=3, spi_device=1, cs_pin=9):
         """Initialize MAX31855 sensor"""
+        if spidev is None:
+            raise RuntimeError("spidev/wiringpi not installed (use SENSOR_BACKEND=replay or synthetic)")
         self.cs_pin = cs_pin
         self.spi_bus = spi_bus
         self.spi_device = spi_device
@@ -5,10 +5,93 @@ MAX31865 RTD Temperature Sensor Driver
 - Platform: Orange Pi 4 Pro (SPI3)
 """
 
-import spidev
 import time
-import math
-import wiringpi
+import functools
+import numpy as np
+
+try:
+    import spidev
+    import wiringpi
+except ImportError:  # Off-target: only the emulated backends (backends.py) work
+    spidev = wiringpi = None
+
+# Configuration register (0x00) bits
+CFG_VBIAS = 0x80        # Bias voltage on
+CFG_AUTO = 0x40         # Continuous (auto) conversion
+CFG_1SHOT = 0x20        # Single conversion
+CFG_3WIRE = 0x10        # 3-wire RTD
+CFG_FAULT_CLEAR = 0x02
+CFG_FILTER_50HZ = 0x01  # 50 Hz notch (0 = 60 Hz)
+
+REG_CONFIG = 0x00
+REG_RTD_MSB = 0x01      # RTD MSB, LSB (bit 0 = fault)
+REG_HIGH_THRESHOLD = 0x03  # High fault threshold MSB, LSB, then low threshold MSB, LSB
+REG_FAULT_STATUS = 0x07
+
+CFG_ONESHOT = CFG_VBIAS | CFG_1SHOT | CFG_3WIRE | CFG_FAULT_CLEAR  # 0xB2
+
+# Fault status register (0x07) bits
+FAULT_BITS = {
+    0x80: "rtd_high",       # RTD above high threshold (open RTD)
+    0x40: "rtd_low",        # RTD below low threshold (shorted RTD)
+    0x20: "refin_high",     # REFIN- > 0.85 x VBIAS
+    0x10: "refin_low",      # REFIN- < 0.85 x VBIAS (FORCE- open)
+    0x08: "rtdin_low",      # RTDIN- < 0.85 x VBIAS (FORCE- open)
+    0x04: "over_under_voltage",
+}
+
+# PT100 / Callendar-Van Dusen (IEC 60751)
+R_REF = 430.0           # Reference resistor value (Ω)
+RES0 = 100.0            # PT100 resistance at 0°C (Ω)
+CVD_A = 3.9083e-3
+CVD_B = -5.775e-7
+CVD_C = -4.183e-12      # Only below 0°C
+CVD_T_MIN = -200.0      # Valid range of the CVD equation (°C)
+CVD_T_MAX = 850.0
+ADC_CODES = 32768       # 15-bit RTD code
+
+# Conversion time in auto mode (datasheet: 16.7 ms @ 60 Hz, 20 ms @ 50 Hz)
+CONVERSION_TIME = {50: 0.020, 60: 0.0167}
+
+
+def temp_to_code(temp_c, r_ref=R_REF, r0=RES0):
+    """Forward CVD: temperature (°C, scalar or array) -> fractional RTD code"""
+    t = np.asarray(temp_c, dtype=float)
+    ratio = 1 + CVD_A * t + CVD_B * t ** 2 + np.where(t < 0, CVD_C * (t - 100) * t ** 3, 0.0)
+    return ratio * r0 / r_ref * ADC_CODES
+
+
+def decode_fault(status):
+    """Fault status register -> list of fault names"""
+    return [name for bit, name in FAULT_BITS.items() if status & bit]
+
+
+@functools.lru_cache(maxsize=None)
+def pt100_table(r_ref=R_REF, r0=RES0):
+    """
+    Temperature (°C) for every 15-bit RTD code, built once with NumPy.
+    
+    T >= 0°C: closed-form quadratic solution of R/R0 = 1 + A*T + B*T^2.
+    T <  0°C: full CVD R/R0 = 1 + A*T + B*T^2 + C*(T-100)*T^3, solved by Newton
+              iteration started from the quadratic solution.
+    Codes outside the CVD range (-200..850°C) map to NaN.
+    """
+    ratio = np.arange(ADC_CODES) * (r_ref / ADC_CODES) / r0
+    with np.errstate(invalid="ignore"):
+        t = (-CVD_A + np.sqrt(CVD_A ** 2 - 4 * CVD_B * (1 - ratio))) / (2 * CVD_B)
+
+    neg = ratio < 1.0
+    tn = t[neg]
+    for _ in range(8):
+        f = 1 + CVD_A * tn + CVD_B * tn ** 2 + CVD_C * (tn - 100) * tn ** 3 - ratio[neg]
+        df = CVD_A + 2 * CVD_B * tn + CVD_C * (4 * tn ** 3 - 300 * tn ** 2)
+        tn = tn - f / df
+    t[neg] = tn
+
+    # 0.5°C slack so the range end points themselves survive rounding
+    t[(t < CVD_T_MIN - 0.5) | (t > CVD_T_MAX + 0.5) | ~np.isfinite(t)] = np.nan
+    t.setflags(write=False)
+    return t
 
 
 class MAX31865:
@@ -19,13 +102,26 @@ class MAX31865:
         spi_bus (int): SPI bus number (default: 3 for Orange Pi 4 Pro)
         spi_device (int): SPI device number (default: 0)
         cs_pin (int): Chip Select pin (wPi number, default: 13 for PD23)
+        continuous (bool): Auto-convert mode (config written once, reads are RTD-only)
+        filter_hz (int): Mains notch filter, 50 or 60
     """
     
-    def __init__(self, spi_bus=3, spi_device=0, cs_pin=13):
+    def __init__(self, spi_bus=3, spi_device=0, cs_pin=13, continuous=False, filter_hz=60):
         """Initialize MAX31865 sensor"""
+        if spidev is None:
+            raise RuntimeError("spidev/wiringpi not installed (use SENSOR_BACKEND=replay or synthetic)")
+        if filter_hz not in CONVERSION_TIME:
+            raise ValueError("filter_hz must be 50 or 60")
         self.cs_pin = cs_pin
         self.spi_bus = spi_bus
         self.spi_device = spi_device
+        self.continuous = continuous
+        self.filter_hz = filter_hz
+        self.conversion_time = CONVERSION_TIME[filter_hz]
+        self.table = pt100_table()
+        self.config = CFG_ONESHOT
+        self.fault = []          # Decoded faults of the last read ([] = OK)
+        self.fault_count = 0
         
         # Setup CS pin
         wiringpi.wiringPiSetup()
@@ -37,6 +133,25 @@ class MAX31865:
         self.spi.open(spi_bus, spi_device)
         self.spi.max_speed_hz = 500000
         self.spi.mode = 0b01  # SPI mode 1
+
+        # Hardware fault thresholds = the PT100 table range, so an open or
+        # shorted RTD raises the fault bit instead of a bogus temperature
+        valid = np.flatnonzero(np.isfinite(self.table))
+        self.set_thresholds(int(valid[0]), int(valid[-1]))
+
+        if self.continuous:
+            self.start_continuous()
+    
+    def start_continuous(self):
+        """Write the auto-convert config once; the chip then converts on its own"""
+        cfg = CFG_VBIAS | CFG_AUTO | CFG_3WIRE | CFG_FAULT_CLEAR
+        if self.filter_hz == 50:
+            cfg |= CFG_FILTER_50HZ
+        self.config = cfg
+        self.write_register(REG_CONFIG, cfg)
+        # First result is valid after the bias settles plus one conversion
+        time.sleep(0.01 + self.conversion_time)
+        self.continuous = True
     
     def write_register(self, reg, val):
         """Write a single register"""
@@ -44,6 +159,14 @@ class MAX31865:
         self.spi.xfer2([0x80 | reg, val])
         wiringpi.digitalWrite(self.cs_pin, wiringpi.HIGH)
     
+    def set_thresholds(self, low_code, high_code):
+        """Program the high/low RTD fault thresholds (15-bit codes) in one burst"""
+        wiringpi.digitalWrite(self.cs_pin, wiringpi.LOW)
+        self.spi.xfer2([0x80 | REG_HIGH_THRESHOLD,
+                        (high_code << 1) >> 8, (high_code << 1) & 0xFF,
+                        (low_code << 1) >> 8, (low_code << 1) & 0xFF])
+        wiringpi.digitalWrite(self.cs_pin, wiringpi.HIGH)
+
     def read_registers(self, start_reg, length):
         """Read consecutive registers"""
         wiringpi.digitalWrite(self.cs_pin, wiringpi.LOW)
@@ -53,33 +176,57 @@ class MAX31865:
     
     def calc_pt100_temp(self, rtd_adc_code):
         """
-        Calculate temperature from RTD ADC code
-        Uses Callendar-Van Dusen equation for PT100
+        Calculate temperature from RTD ADC code (table lookup, see pt100_table)
         
         Args:
-            rtd_adc_code (int): 16-bit ADC code from sensor
+            rtd_adc_code (int|float): 15-bit ADC code (fractional codes are interpolated)
             
         Returns:
-            float: Temperature in °C
+            float: Temperature in °C (NaN outside -200..850°C, e.g. open/shorted RTD)
         """
-        R_REF = 430.0  # Reference resistor value (Ω)
-        Res0 = 100.0   # PT100 resistance at 0°C (Ω)
-        a = 0.00390830
-        b = -0.0000005775
-        c = -0.00000000000418301  # For -200°C to 0°C
-        
-        Res_RTD = (rtd_adc_code * R_REF) / 32768.0
-        temp_C_line = (rtd_adc_code / 32.0) - 256.0
+        if not 0 <= rtd_adc_code <= ADC_CODES - 1:
+            return float("nan")
+        i = int(rtd_adc_code)
+        frac = rtd_adc_code - i
+        if frac == 0:
+            return float(self.table[i])
+        return float(self.table[i] + frac * (self.table[i + 1] - self.table[i]))
+
+    def codes_to_temps(self, codes):
+        """Vectorized calc_pt100_temp for a burst of codes -> ndarray of °C"""
+        codes = np.asarray(codes, dtype=float)
+        temps = np.interp(codes, np.arange(ADC_CODES), self.table)
+        return np.where((codes >= 0) & (codes <= ADC_CODES - 1), temps, np.nan)
+    
+    def read_rtd_code(self):
+        """
+        Read the 15-bit RTD ADC code (None if the fault bit is set, see self.fault)
         
-        try:
-            temp_C = (-a + math.sqrt(a**2 - 4*b*(1 - Res_RTD/Res0))) / (2*b)
-            if temp_C < 0:
-                temp_C = temp_C_line  # fallback for negative temps
-        except:
-            temp_C = -999.0
+        Continuous mode: one 3-byte burst of the RTD registers, no config write
+        and no wait. One-shot mode: trigger a conversion and wait for it.
+        """
+        if not self.continuous:
+            self.write_register(REG_CONFIG, CFG_ONESHOT)
+            time.sleep(0.1)
+        msb, lsb = self.read_registers(REG_RTD_MSB, 2)
+        if lsb & 0x01:
+            self.handle_fault()
+            return None
+        self.fault = []
+        return ((msb << 8) | lsb) >> 1
+
+    def handle_fault(self):
+        """
+        Decode the fault status register and auto-clear it
         
-        return temp_C
-    
+        Only runs when the fault bit is set, so a healthy sensor pays nothing.
+        The clear is a single config write; the current mode is kept.
+        """
+        status = self.read_registers(REG_FAULT_STATUS, 1)[0]
+        self.fault = decode_fault(status) or ["unknown"]
+        self.fault_count += 1
+        self.write_register(REG_CONFIG, (self.config & ~CFG_1SHOT) | CFG_FAULT_CLEAR)
+
     def read_temperature(self, verbose=False):
         """
         Read temperature from sensor
@@ -88,12 +235,13 @@ class MAX31865:
             verbose (bool): Print debug information
             
         Returns:
-            float: Temperature in °C
+            float: Temperature in °C (NaN on an RTD fault)
         """
-        self.write_register(0x00, 0xB2)  # single-shot config
-        time.sleep(0.1)
-        data = self.read_registers(0x00, 8)
-        rtd_adc = ((data[1] << 8) | data[2]) >> 1
+        rtd_adc = self.read_rtd_code()
+        if rtd_adc is None:
+            if verbose:
+                print(f"\n[ MAX31865 (RTD) ] FAULT: {', '.join(self.fault)}")
+            return float("nan")
         temp = self.calc_pt100_temp(rtd_adc)
         
         if verbose:
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark relay convergence against the ESP32 emulator (no hardware needed)
+- Starts test/esp32_emulator.py in-process and the service_relay controller
+  on a throwaway DB
+- Queues N alternating ON/OFF orders (like service_web.submit_relay) and
+  measures enqueue -> relay switched on the device -> order acknowledged
+- --shutdown: also times the soft shutdown / power-cycle job of service_web
+  (needs the web requirements installed)
+
+Usage:
+    ./venv/bin/python test/bench_relay.py --orders 20 --latency 30 --jitter 10 --seed 1
+    ./venv/bin/python test/bench_relay.py --loss 0.1 --crash-after 40 --downtime 3
+    ./venv/bin/python test/bench_relay.py --orders 0 --shutdown
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+GATEWAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GATEWAY_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from esp32_emulator import ESP32Emulator, CRASH_MODES
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float("nan")
+    k = min(len(sorted_vals) - 1, int(round(p / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+def wait_for(predicate, timeout, step=0.005):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(step)
+    return False
+
+
+def bench_orders(db, emu, n, gap, timeout):
+    import relays
+
+    switched, acked, failed = [], [], 0
+    seq = int((db.get_state("relay_cmd") or {}).get("seq", 0))
+    for i in range(n):
+        on = i % 2 == 0
+        seq += 1
+        t0 = time.monotonic()
+        db.set_state("relay_desired", 1 if on else 0)
+        db.set_state("relay_cmd", {"seq": seq, "on": on, "ts": time.time()})
+        relays.notify()
+        if not wait_for(lambda: emu.relay == on, timeout):
+            failed += 1
+            continue
+        switched.append(time.monotonic() - t0)
+        if wait_for(lambda: int(db.get_state("relay_ack_seq", 0) or 0) >= seq, timeout):
+            acked.append(time.monotonic() - t0)
+        time.sleep(gap)
+    return switched, acked, failed
+
+
+def bench_shutdown(emu, restart):
+    import service_web
+
+    t0 = time.monotonic()
+    start = len(emu.history)
+    job, _ = service_web.submit_power_job(restart=restart)
+    wait_for(lambda: job.status not in ("queued", "running"), 120, step=0.05)
+    total = time.monotonic() - t0
+    events = [(t - t0, "ON" if on else "OFF") for t, on in emu.history[start:]]
+    return job, total, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay convergence benchmark (ESP32 emulator)")
+    parser.add_argument("--orders", type=int, default=20)
+    parser.add_argument("--gap", type=float, default=0.5, help="Seconds between orders")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Give up on an order after N s")
+    parser.add_argument("--latency", type=float, default=20.0, help="Emulator mean delay (ms)")
+    parser.add_argument("--jitter", type=float, default=5.0, help="Emulator ± jitter (ms)")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--crash-after", type=int, default=0)
+    parser.add_argument("--crash-mode", choices=CRASH_MODES, default="reboot")
+    parser.add_argument("--downtime", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shutdown", action="store_true", help="Also time soft shutdown + power-cycle")
+    args = parser.parse_args()
+
+    emu = ESP32Emulator(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0, loss=args.loss,
+                        crash_after=args.crash_after, crash_mode=args.crash_mode,
+                        downtime=args.downtime, seed=args.seed).start()
+    # Must be set before the gateway modules are imported
+    os.environ["ESP32_IP"] = emu.address
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_relay_"), "gateway.db")
+
+    from database import db
+    import service_relay
+
+    fleet = service_relay.RelayFleet(db)
+    threading.Thread(target=lambda: asyncio.run(fleet.run()), daemon=True).start()
+    wait_for(lambda: db.get_state("esp32_connected"), 10)
+
+    print(f"Emulator at {emu.address}: latency {args.latency:.0f}±{args.jitter:.0f} ms, "
+          f"loss {args.loss:.0%}, crash after {args.crash_after or '-'} ({args.crash_mode})")
+
+    if args.orders:
+        switched, acked, failed = bench_orders(db, emu, args.orders, args.gap, args.timeout)
+        print(f"\n{args.orders} orders, {failed} not applied within {args.timeout:.0f}s")
+        print(f"{'':<22}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for name, samples in (("enqueue -> switched", switched), ("enqueue -> acked", acked)):
+            lat = sorted(s * 1000 for s in samples)
+            if lat:
+                print(f"{name:<22}{percentile(lat, 50):>10.1f}{percentile(lat, 95):>10.1f}{lat[-1]:>10.1f}")
+
+    if args.shutdown:
+        for restart in (False, True):
+            job, total, events = bench_shutdown(emu, restart)
+            steps = ", ".join(f"{state} at {t:.2f}s" for t, state in events) or "no relay change"
+            print(f"\n{job.kind}: {job.status} in {total:.2f}s ({steps})")
+
+    print(f"\nEmulator: {emu.requests} requests, {emu.lost} lost, {emu.crashes} crashes")
+    emu.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark the gateway web API (dev server vs. waitress)
+- N client threads poll the dashboard GET routes
+- One extra thread keeps requesting a slow /trend?limit=3600
+- Prints requests/s and p50/p95/max latency per route
+
+Usage:
+    # Terminal 1: start the server in the mode you want to measure
+    WEB_SERVER=dev      ./venv/bin/python run_api.py
+    WEB_SERVER=waitress ./venv/bin/python run_api.py
+
+    # Terminal 2:
+    ./venv/bin/python test/bench_web.py --url http://127.0.0.1:5000 --clients 8 --seconds 20
+"""
+
+import argparse
+import threading
+import time
+
+import requests
+
+FAST_ROUTES = ["/heartbeat", "/control_status", "/temp", "/relay_status", "/setpoint_status"]
+SLOW_ROUTE = "/trend?limit=3600"
+
+
+def worker(base_url, routes, stop_at, results, lock):
+    session = requests.Session()
+    i = 0
+    while time.time() < stop_at:
+        route = routes[i % len(routes)]
+        i += 1
+        t0 = time.perf_counter()
+        try:
+            ok = session.get(base_url + route, timeout=10).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        dt = time.perf_counter() - t0
+        with lock:
+            results.setdefault(route, []).append((dt, ok))
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float("nan")
+    k = min(len(sorted_vals) - 1, int(round(p / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway web API load test")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--no-slow", action="store_true", help="Skip the /trend?limit=3600 thread")
+    args = parser.parse_args()
+
+    results = {}
+    lock = threading.Lock()
+    stop_at = time.time() + args.seconds
+
+    threads = [threading.Thread(target=worker, args=(args.url, FAST_ROUTES, stop_at, results, lock))
+               for _ in range(args.clients)]
+    if not args.no_slow:
+        threads.append(threading.Thread(target=worker, args=(args.url, [SLOW_ROUTE], stop_at, results, lock)))
+
+    print(f"Benchmarking {args.url} with {args.clients} clients for {args.seconds:.0f}s...")
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    total = sum(len(v) for v in results.values())
+    print(f"\nTotal: {total} requests, {total / args.seconds:.1f} req/s\n")
+    print(f"{'route':<22}{'n':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for route in sorted(results):
+        samples = results[route]
+        lat = sorted(dt * 1000 for dt, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        print(f"{route:<22}{len(samples):>7}{errors:>6}"
+              f"{percentile(lat, 50):>10.1f}{percentile(lat, 95):>10.1f}{lat[-1]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Local emulator of the ESP32-S3 relay node (services/esp32s3_relay/src/main.cpp)
+- POST /relay {"on": bool} and GET /status, same status codes and bodies
+- X-API-Key check (401 like the firmware)
+- One request at a time with Connection: close, like the Arduino WebServer
+- Fault injection: latency/jitter, request loss, crash (reboot or hang)
+- Seeded RNG, so a run can be repeated exactly
+
+Usage:
+    # Terminal 1: emulator on port 8191
+    ./venv/bin/python test/esp32_emulator.py --port 8191 --latency 20 --jitter 10 --loss 0.05
+
+    # Terminal 2: point the gateway at it
+    ESP32_IP=127.0.0.1:8191 ./venv/bin/python run_relay.py
+
+    # Crash (reboot, relay back OFF) after every 50 requests, down for 5 s
+    ./venv/bin/python test/esp32_emulator.py --crash-after 50 --crash-mode reboot --downtime 5
+
+In-process (benchmarks):
+    emu = ESP32Emulator(port=0, latency=0.02).start()
+    os.environ["ESP32_IP"] = emu.address
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+API_KEY = "esp32-secret-key-123"
+CRASH_MODES = ("reboot", "hang")
+
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.0 -> Connection: close after every response, like the firmware
+    server_version = "ESP32WebServer"
+
+    def log_message(self, format, *args):
+        if self.server.emu.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, code, body, content_type="application/json"):
+        data = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        emu = self.server.emu
+        if not emu.before_request():
+            # Lost: the client gets no response (connection closed without a reply)
+            self.close_connection = True
+            return
+
+        if self.path == "/relay":
+            self._relay(method)
+        elif self.path == "/status":
+            self._status()
+        else:
+            self._send(404, "ESP32 Relay Node. Only Gateway allowed.", "text/plain")
+
+    def _auth(self):
+        return self.headers.get("X-API-Key") == self.server.emu.api_key
+
+    def _relay(self, method):
+        if not self._auth():
+            return self._send(401, '{"error":"Unauthorized: Gateway Only"}')
+        if method != "POST":
+            return self._send(405, '{"error":"Method Not Allowed"}')
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            return self._send(400, '{"error":"Missing Body"}')
+        try:
+            doc = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._send(400, '{"error":"Invalid JSON"}')
+
+        on = bool(doc.get("on")) if isinstance(doc, dict) else False
+        self.server.emu.set_relay(on)
+        # String(bool) on the ESP32 prints 1/0
+        self._send(200, '{"success":true,"relay":%d}' % int(on))
+
+    def _status(self):
+        if not self._auth():
+            return self._send(401, '{"error":"Unauthorized"}')
+        self._send(200, json.dumps(self.server.emu.status()))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+class ESP32Emulator:
+    """
+    Args:
+        host, port (int): Listen address (port 0 = pick a free port).
+        api_key (str): Expected X-API-Key.
+        latency (float): Mean added response delay (seconds).
+        jitter (float): Uniform ± jitter on the delay (seconds).
+        loss (float): Probability that a request gets no response.
+        loss_hold (float): How long a lost request holds the connection before
+            it is closed (longer than the client read timeout = a timeout).
+        crash_after (int): Crash after this many requests (0 = never), repeatedly.
+        crash_mode (str): "reboot" (port closed, then boots with the relay OFF)
+            or "hang" (accepts connections but never answers, then reboots).
+        downtime (float): Seconds until the crashed device is back.
+        seed (int): RNG seed for latency and loss.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, api_key=API_KEY, latency=0.0, jitter=0.0,
+                 loss=0.0, loss_hold=3.0, crash_after=0, crash_mode="reboot", downtime=5.0,
+                 seed=None, verbose=False):
+        if crash_mode not in CRASH_MODES:
+            raise ValueError(f"crash_mode must be one of {CRASH_MODES}")
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.loss_hold = loss_hold
+        self.crash_after = crash_after
+        self.crash_mode = crash_mode
+        self.downtime = downtime
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+
+        self.relay = False
+        self.history = []      # (time.monotonic(), on) on every relay change
+        self.requests = 0
+        self.lost = 0
+        self.crashes = 0
+        self.booted_at = time.monotonic()
+        self.hung_until = 0.0
+        self._since_boot = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        """host:port, usable as ESP32_IP."""
+        return f"{self.host}:{self.port}"
+
+    # ---- Device state ----
+    def set_relay(self, on):
+        with self._lock:
+            if on != self.relay:
+                self.history.append((time.monotonic(), on))
+            self.relay = on
+
+    def status(self):
+        return {
+            "relay": self.relay,
+            "uptime": int((time.monotonic() - self.booted_at) * 1000),
+            "free_heap": 180000,
+            "wifi_rssi": -55,
+        }
+
+    def before_request(self):
+        """Apply hang/latency/loss/crash to one request. Returns False if it is lost."""
+        hold = self.hung_until - time.monotonic()
+        if hold > 0:
+            time.sleep(hold)
+            return False
+
+        with self._lock:
+            self.requests += 1
+            self._since_boot += 1
+            crash = self.crash_after and self._since_boot >= self.crash_after
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            lost = self.rng.random() < self.loss
+
+        if crash:
+            self.crash()
+            return False
+        if lost:
+            self.lost += 1
+            time.sleep(self.loss_hold)
+            return False
+        time.sleep(delay)
+        return True
+
+    # ---- Server lifecycle ----
+    def _serve(self):
+        self._server = HTTPServer((self.host, self.port), Handler)
+        self._server.emu = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True,
+                                        name="esp32-emulator")
+        self._thread.start()
+
+    def start(self):
+        self._serve()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _boot(self):
+        # Firmware setup(): relay starts OFF
+        with self._lock:
+            self._since_boot = 0
+            self.booted_at = time.monotonic()
+            if self.relay:
+                self.history.append((self.booted_at, False))
+            self.relay = False
+
+    def crash(self):
+        """Crash now (in crash_mode) and come back after `downtime` seconds."""
+        self.crashes += 1
+        if self.crash_mode == "hang":
+            self.hung_until = time.monotonic() + self.downtime
+            threading.Timer(self.downtime, self._boot).start()
+            return
+
+        server = self._server
+        self._server = None
+
+        def reboot():
+            # shutdown() waits for serve_forever, so it cannot run on the handler thread
+            server.shutdown()
+            server.server_close()
+            time.sleep(self.downtime)
+            self._boot()
+            self._serve()
+
+        threading.Thread(target=reboot, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP32 relay node emulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8191)
+    parser.add_argument("--api-key", default=API_KEY)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean response delay (ms)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="± uniform jitter (ms)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability a request gets no response")
+    parser.add_argument("--loss-hold", type=float, default=3.0, help="Seconds a lost request holds the connection")
+    parser.add_argument("--crash-after", type=int, default=0, help="Crash every N requests (0 = never)")
+    parser.add_argument("--crash-mode", choices=CRASH_MODES, default="reboot")
+    parser.add_argument("--downtime", type=float, default=5.0, help="Seconds until a crashed device is back")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    emu = ESP32Emulator(args.host, args.port, args.api_key, args.latency / 1000.0, args.jitter / 1000.0,
+                        args.loss, args.loss_hold, args.crash_after, args.crash_mode, args.downtime,
+                        args.seed, args.verbose).start()
+    print(f"ESP32 emulator on http://{emu.address} (ESP32_IP={emu.address})")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"relay={'ON' if emu.relay else 'OFF'} requests={emu.requests} "
+                  f"lost={emu.lost} crashes={emu.crashes}")
+    except KeyboardInterrupt:
+        emu.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,10 @@
 # Endpoint: GET /video_feed  → MJPEG stream
 # Endpoint: GET /health      → JSON status
 #
+# Frames are only decoded, resized and encoded while at least one browser is
+# watching. With no viewers the RTSP session is kept warm with grab() (no
+# decode), and the first viewer gets a fresh frame within one frame period.
+#
 # ------------------------------------------------------------------
 # ⚙️  CONFIGURE THESE FOUR VALUES FOR YOUR CAMERA:
 # ------------------------------------------------------------------
@@ -36,9 +40,121 @@ logger = logging.getLogger("rtsp_bridge")
 app = Flask(__name__)
 
 # ---- Shared frame state ----
-latest_frame: bytes | None = None
-latest_frame_ts: float = 0.0
-frame_lock = threading.Lock()
+class FrameBroadcaster:
+    """
+    Fan-out of the latest encoded frame to every /video_feed client.
+
+    publish() stores the frame under a new sequence number and wakes all
+    waiting clients; wait() blocks until a frame newer than the one the
+    client already sent exists. Each client gets every frame at most once,
+    as soon as it is published; a slow client skips to the newest frame.
+    Clients register with subscribe()/unsubscribe() so the capture thread
+    knows whether anyone is watching.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.frame: bytes | None = None
+        self.seq = 0
+        self.ts = 0.0
+        self.subscribers = 0
+
+    def subscribe(self, max_age: float) -> int:
+        """
+        Register a viewer. Returns the seq to wait after: the current frame is
+        sent first only if it is younger than max_age (not left over from idle).
+        """
+        with self._cond:
+            self.subscribers += 1
+            self._cond.notify_all()  # wake an idle capture loop
+            fresh = self.frame is not None and time.time() - self.ts <= max_age
+            return self.seq - 1 if fresh else self.seq
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def wait_viewers(self, timeout: float) -> bool:
+        """Sleep up to timeout; returns early (True) as soon as someone watches."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.subscribers > 0, timeout)
+
+    def publish(self, frame: bytes):
+        with self._cond:
+            self.frame = frame
+            self.seq += 1
+            self.ts = time.time()
+            self._cond.notify_all()
+
+    def wait(self, after_seq: int, timeout: float | None = None):
+        """Return (seq, frame) newer than after_seq, or None on timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > after_seq, timeout):
+                return None
+            return self.seq, self.frame
+
+    def latest(self):
+        """(seq, frame, ts) of the newest frame."""
+        with self._cond:
+            return self.seq, self.frame, self.ts
+
+
+frames = FrameBroadcaster()
+
+
+class CpuStats:
+    """
+    CPU use per capture mode ("streaming" / "idle").
+
+    capture: capture thread only (time.thread_time), averaged over roughly
+             the last WINDOW seconds spent in that mode
+    process: whole bridge process over the last PROCESS_WINDOW seconds
+             spent entirely in that mode
+    """
+    WINDOW = 60.0
+    PROCESS_WINDOW = 5.0
+    MODES = ("streaming", "idle")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.modes = {mode: {"cpu": 0.0, "wall": 0.0, "frames": 0, "process_percent": None}
+                      for mode in self.MODES}
+        self._proc = None  # (mode, t0, process cpu at t0)
+
+    def add(self, mode: str, cpu: float, wall: float):
+        now = time.monotonic()
+        proc_cpu = sum(os.times()[:2])
+        with self._lock:
+            m = self.modes[mode]
+            m["cpu"] += cpu
+            m["wall"] += wall
+            m["frames"] += 1
+            if m["wall"] > self.WINDOW:
+                # Halve instead of keeping a buffer: still tracks recent load
+                m["cpu"] /= 2
+                m["wall"] /= 2
+
+            if self._proc is None or self._proc[0] != mode:
+                self._proc = (mode, now, proc_cpu)
+            elif now - self._proc[1] >= self.PROCESS_WINDOW:
+                m["process_percent"] = 100.0 * (proc_cpu - self._proc[2]) / (now - self._proc[1])
+                self._proc = (mode, now, proc_cpu)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                mode: {
+                    "capture_cpu_percent": round(100.0 * m["cpu"] / m["wall"], 1) if m["wall"] else None,
+                    "process_cpu_percent": round(m["process_percent"], 1) if m["process_percent"] is not None else None,
+                    "frames": m["frames"],
+                }
+                for mode, m in self.modes.items()
+            }
+
+
+cpu_stats = CpuStats()
+capture_mode = "idle"
+camera_frame_ts = 0.0  # last frame received from the camera (grabbed or decoded)
 
 
 def _open_capture() -> cv2.VideoCapture | None:
@@ -66,8 +182,8 @@ def _open_capture() -> cv2.VideoCapture | None:
 
 
 def capture_loop():
-    """Background thread: continuously read frames from the RTSP stream."""
-    global latest_frame, latest_frame_ts
+    """Background thread: read the RTSP stream; decode + encode only while someone watches."""
+    global capture_mode, camera_frame_ts
 
     backoff = 2  # reconnect delay (seconds), doubles on repeated failures
 
@@ -84,31 +200,50 @@ def capture_loop():
 
         while True:
             t0 = time.time()
-            ret, frame = cap.read()
+            c0 = time.thread_time()
+            mode = "streaming" if frames.subscribers > 0 else "idle"
+            if mode != capture_mode:
+                logger.info(f"Capture {mode} ({frames.subscribers} viewers)")
+                capture_mode = mode
+
+            if mode == "idle":
+                # Nobody watching: grab() keeps the RTSP session and its
+                # buffer current without decoding; no resize/encode
+                if not cap.grab():
+                    logger.warning("Frame grab failed — reconnecting to camera.")
+                    break  # outer loop will reconnect
+                camera_frame_ts = time.time()
+            else:
+                ret, frame = cap.read()
 
-            if not ret:
-                logger.warning("Frame read failed — reconnecting to camera.")
-                break  # outer loop will reconnect
+                if not ret:
+                    logger.warning("Frame read failed — reconnecting to camera.")
+                    break  # outer loop will reconnect
+                camera_frame_ts = time.time()
 
-            # Optional resize
-            if STREAM_WIDTH > 0 and STREAM_HEIGHT > 0:
-                frame = cv2.resize(frame, (STREAM_WIDTH, STREAM_HEIGHT))
+                # Optional resize
+                if STREAM_WIDTH > 0 and STREAM_HEIGHT > 0:
+                    frame = cv2.resize(frame, (STREAM_WIDTH, STREAM_HEIGHT))
 
-            # Encode to JPEG
-            encode_params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
-            ok, buf = cv2.imencode(".jpg", frame, encode_params)
-            if not ok:
-                continue
+                # Encode to JPEG
+                encode_params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+                ok, buf = cv2.imencode(".jpg", frame, encode_params)
+                if not ok:
+                    continue
 
-            with frame_lock:
-                latest_frame = buf.tobytes()
-                latest_frame_ts = time.time()
+                frames.publish(buf.tobytes())
 
-            # Pace ourselves to target FPS
+            # Pace ourselves to target FPS; an idle loop wakes early when a
+            # viewer connects so the first frame is not a period late
             elapsed = time.time() - t0
             sleep_time = frame_interval - elapsed
             if sleep_time > 0:
-                time.sleep(sleep_time)
+                if mode == "idle":
+                    frames.wait_viewers(sleep_time)
+                else:
+                    time.sleep(sleep_time)
+
+            cpu_stats.add(mode, time.thread_time() - c0, time.time() - t0)
 
         cap.release()
 
@@ -125,15 +260,20 @@ def health():
     Public health endpoint. Called by Orange Pi gateway to check camera status.
     Returns JSON compatible with the existing camera_health check in service_web.py.
     """
-    with frame_lock:
-        has_frame = latest_frame is not None
-        frame_age = (time.time() - latest_frame_ts) if has_frame else None
+    # Camera link health, independent of viewers: an idle bridge still grabs
+    seq, _, _ = frames.latest()
+    has_frame = camera_frame_ts > 0
+    frame_age = (time.time() - camera_frame_ts) if has_frame else None
 
     return jsonify({
         "status": "alive",
         "ts": time.time(),
         "has_frame": has_frame,
         "frame_age_sec": round(frame_age, 2) if frame_age is not None else None,
+        "frame_seq": seq,
+        "viewers": frames.subscribers,
+        "mode": capture_mode,
+        "cpu": cpu_stats.snapshot(),
         "rtsp_url": RTSP_URL.split("@")[-1]  # hide credentials in output
     }), 200
 
@@ -145,23 +285,23 @@ def video_feed():
     No authentication here — the Cloudflare Worker enforces login before proxying.
     """
     def generate():
-        while True:
-            frame_bytes = None
-            with frame_lock:
-                frame_bytes = latest_frame
-
-            if frame_bytes:
+        seq = frames.subscribe(max_age=2.0 / STREAM_FPS)
+        try:
+            while True:
+                # Sleep until the capture thread publishes a frame we haven't sent
+                got = frames.wait(seq, timeout=5.0)
+                if got is None:
+                    continue  # camera stalled / reconnecting
+                seq, frame_bytes = got
                 yield (
                     b"--frame\r\n"
                     b"Content-Type: image/jpeg\r\n\r\n" +
                     frame_bytes +
                     b"\r\n"
                 )
-            else:
-                # No frame yet — send a small delay to avoid busy-wait
-                time.sleep(0.1)
-
-            time.sleep(1.0 / STREAM_FPS)
+        finally:
+            # Client disconnected (generator closed)
+            frames.unsubscribe()
 
     return Response(
         generate(),
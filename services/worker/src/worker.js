@@ -66,7 +66,9 @@ async function validateSession(request, env) {
   }
 }
 
-// Helper: build gateway headers, always including the shared secret
+// Helper: build gateway headers, always including the shared secret.
+// Command routes also pass X-Client-Id (the logged-in user) so the gateway
+// can rate-limit per student rather than per Worker.
 function gatewayHeaders(env, extra = {}) {
   return {
     "Content-Type": "application/json",
@@ -254,17 +256,39 @@ export default {
         }
       }
 
+      // ✅ Relay boards by ID (status read-only, orders require login)
+      if ((url.pathname === "/api/relays" || url.pathname.startsWith("/api/relays/")) && request.method === "GET") {
+        const backendPath = url.pathname.replace(/^\/api/, "");
+        const r = await fetch(`https://orangepi.pidlab2026.shop${backendPath}`, {
+          headers: { "X-Worker-Secret": env.GATEWAY_SECRET || "" }
+        });
+        return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
+      }
+
+      if (url.pathname.startsWith("/api/relays/") && request.method === "POST") {
+        const session = await validateSession(request, env);
+        if (!session) return withCors(request, "Unauthorized", 401);
+        const body = await request.json();
+        const backendPath = url.pathname.replace(/^\/api/, "");
+        const r = await fetch(`https://orangepi.pidlab2026.shop${backendPath}`, {
+          method: "POST",
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
+          body: JSON.stringify(body)
+        });
+        return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
+      }
+
       // ✅ Light Control (requires login)
       if (url.pathname === "/api/light/on" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/light/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/light/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
       if (url.pathname === "/api/light/off" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/light/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/light/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -272,13 +296,13 @@ export default {
       if (url.pathname === "/api/web/on" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/web/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/web/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
       if (url.pathname === "/api/web/off" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/web/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/web/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -286,13 +310,13 @@ export default {
       if (url.pathname === "/api/plc/on" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/plc/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/plc/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
       if (url.pathname === "/api/plc/off" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/plc/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/plc/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -301,7 +325,7 @@ export default {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
         const backendPath = url.pathname.replace(/^\/api/, "");
-        const r = await fetch(`https://orangepi.pidlab2026.shop${backendPath}`, { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch(`https://orangepi.pidlab2026.shop${backendPath}`, { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -356,67 +380,86 @@ export default {
         return withCors(request, await r.text(), r.status);
       }
 
+      if (url.pathname === "/api/sensors" && request.method === "GET") {
+        const r = await fetch("https://orangepi.pidlab2026.shop/sensors", {
+          headers: { "X-Worker-Secret": env.GATEWAY_SECRET || "" }
+        });
+        return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
+      }
+
+      if (url.pathname === "/api/pv_source" && request.method === "POST") {
+        const session = await validateSession(request, env);
+        if (!session) return withCors(request, "Unauthorized", 401);
+        const body = await request.json();
+        const r = await fetch("https://orangepi.pidlab2026.shop/pv_source", {
+          method: "POST",
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
+          body: JSON.stringify(body)
+        });
+        return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
+      }
+
       // --- Legacy command aliases (requires login) ---
       if (url.pathname === "/api/start_light") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/light/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/light/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/stop_light") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/light/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/light/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/start_web") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/web/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/web/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/stop_web") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/web/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/web/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/start_plc") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/plc/on", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/plc/on", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/stop_plc") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/plc/off", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/plc/off", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/manual_mode") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/mode/manual", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/mode/manual", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/auto_mode") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/mode/auto", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/mode/auto", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
       if (url.pathname === "/api/tune_mode") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/mode/tune", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/mode/tune", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status);
       }
 
@@ -476,7 +519,7 @@ export default {
         const body = await request.json();
         const r = await fetch("https://orangepi.pidlab2026.shop/setpoint", {
           method: "POST",
-          headers: gatewayHeaders(env),
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
           body: JSON.stringify(body)
         });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
@@ -496,7 +539,7 @@ export default {
         const body = await request.json();
         const r = await fetch("https://orangepi.pidlab2026.shop/pid", {
           method: "POST",
-          headers: gatewayHeaders(env),
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
           body: JSON.stringify(body)
         });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
@@ -516,7 +559,7 @@ export default {
         const body = await request.json();
         const r = await fetch("https://orangepi.pidlab2026.shop/mv_manual", {
           method: "POST",
-          headers: gatewayHeaders(env),
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
           body: JSON.stringify(body)
         });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
@@ -538,7 +581,7 @@ export default {
         const body = await request.json();
         const r = await fetch("https://orangepi.pidlab2026.shop/tune_setpoint", {
           method: "POST",
-          headers: gatewayHeaders(env),
+          headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
           body: JSON.stringify(body)
         });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
@@ -556,7 +599,7 @@ export default {
       if (url.pathname === "/api/tune_start" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/tune_start", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/tune_start", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -572,7 +615,7 @@ export default {
       if (url.pathname === "/api/tune_stop" && request.method === "POST") {
         const session = await validateSession(request, env);
         if (!session) return withCors(request, "Unauthorized", 401);
-        const r = await fetch("https://orangepi.pidlab2026.shop/tune_stop", { method: "POST", headers: gatewayHeaders(env) });
+        const r = await fetch("https://orangepi.pidlab2026.shop/tune_stop", { method: "POST", headers: gatewayHeaders(env, { "X-Client-Id": session.user }) });
         return withCors(request, await r.text(), r.status, { "Content-Type": "application/json" });
       }
 
@@ -604,6 +647,26 @@ export default {
         }
       }
 
+      // ✅ Trend Export (CSV / NDJSON stream — read-only)
+      // Body is piped through unbuffered so long ranges stream to the browser.
+      if (url.pathname === "/api/trend/export" && request.method === "GET") {
+        try {
+          const r = await fetch(`https://orangepi.pidlab2026.shop/trend/export${url.search}`, {
+            headers: { "X-Worker-Secret": env.GATEWAY_SECRET || "" }
+          });
+          return new Response(r.body, {
+            status: r.status,
+            headers: {
+              ...getCorsHeaders(request),
+              "Content-Type": r.headers.get("Content-Type") || "text/csv",
+              "Content-Disposition": r.headers.get("Content-Disposition") || "attachment"
+            }
+          });
+        } catch (e) {
+          return withCors(request, JSON.stringify({ error: e.message }), 503, { "Content-Type": "application/json" });
+        }
+      }
+
       // ============================================
       // RELAY / HEATER Control (PROXIED TO GATEWAY)
       // ============================================
@@ -614,7 +677,7 @@ export default {
           const body = await request.clone().json();
           const r = await fetch("https://orangepi.pidlab2026.shop/relay", {
             method: "POST",
-            headers: gatewayHeaders(env),
+            headers: gatewayHeaders(env, { "X-Client-Id": session.user }),
             body: JSON.stringify(body)
           });
           const respText = await r.text();